@@ -0,0 +1,370 @@
+"""Machine-wide cache of objects, shared by all repos and storages of the user
+
+Objects are kept in `<DIR_USER_CACHE>/objects/<ab>/<rest of hash>`. A SQLite index
+records the size and the last access time of each object, so that the least
+recently used objects are evicted when the cache grows over its size cap.
+
+Many processes can use the cache at the same time: objects are written to a
+temporary file and renamed into place, the index is a WAL-mode SQLite database, and
+a reader that loses an object to a concurrent eviction treats it as a miss.
+
+A hit is checked against the size in the index and re-hashed as it is copied out. An
+object that does not match, e.g. after a write through a hardlink or a disk error, is
+evicted and read as a miss, so the storage is asked for it again.
+
+The cache is off unless `GOD_CACHE_SIZE` sets its size cap. Objects are shared with
+the cache by reflink (a copy-on-write clone) on filesystems that support it, e.g.
+btrfs and XFS, so the cache and the `.god/objects` of each clone keep 1 copy on disk
+and a change to either file leaves the other intact. Elsewhere the objects are
+copied, and the cache costs its size in disk space on top of the repos.
+
+The cache can also hardlink objects, but only into files that are never modified in
+place: a change through a hardlink corrupts the cache and every other file that
+shares it. Transfers into the `.god/objects` of a repo reflink or copy.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import god.storage.constants as c
+from god.cache.base import BaseCache
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+DIR_CACHE_OBJECTS = "objects"
+FILE_CACHE_INDEX = "objects.sqlite"
+# the size cap in bytes, set with the environment variable `GOD_CACHE_SIZE`. The
+# default 0 turns the cache off
+DEFAULT_CACHE_SIZE = 0
+# eviction removes objects until the cache is below this fraction of the size cap
+EVICT_TARGET = 0.9
+# seconds to wait for another process that writes the index
+BUSY_TIMEOUT = 60
+# number of hashes per SQL query, below the limit of SQLite on variables
+SQL_BATCH_SIZE = 500
+# size of the chunks that hits are hashed in
+CHUNK_SIZE = 1024 * 1024
+# the Linux ioctl that clones a file copy-on-write
+FICLONE = 0x40049409
+
+# the total size is kept up to date by triggers, so checking the cap is 1 row read
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, size INTEGER, atime REAL);
+CREATE INDEX IF NOT EXISTS objects_atime ON objects (atime);
+CREATE TABLE IF NOT EXISTS total (size INTEGER);
+INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM total);
+CREATE TRIGGER IF NOT EXISTS objects_insert AFTER INSERT ON objects
+    BEGIN UPDATE total SET size = size + new.size; END;
+CREATE TRIGGER IF NOT EXISTS objects_delete AFTER DELETE ON objects
+    BEGIN UPDATE total SET size = size - old.size; END;
+"""
+
+
+def _reflink(source: str, target: str) -> bool:
+    """Clone `source` into `target` copy-on-write
+
+    Returns:
+        True if cloned, False if the platform or the filesystem cannot clone, in
+            which case `target` may be left empty
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    with open(source, "rb") as fi, open(target, "wb") as fo:
+        try:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+        except OSError:
+            return False
+    return True
+
+
+def _link_or_copy(source: str, target: str, link: bool):
+    """Hardlink `source` to `target` if `link`, else reflink, else copy
+
+    The target is written to a temporary file then renamed, so readers never see a
+    partial file.
+    """
+    temp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        linked = False
+        if link:
+            try:
+                os.link(source, temp)
+                linked = True
+            except OSError:
+                pass
+        if not linked and not _reflink(source, temp):
+            shutil.copyfile(source, temp)
+        os.replace(temp, target)
+    except BaseException:
+        if os.path.lexists(temp):
+            os.unlink(temp)
+        raise
+
+
+def _hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fi:
+        for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _copy_verified(source: str, target: str, hash_value: str, link: bool) -> bool:
+    """Like `_link_or_copy`, but only if the SHA-256 of `source` is `hash_value`
+
+    The file is read once: a clone is hashed after it is made, a copy while it is
+    written.
+
+    Returns:
+        True if `source` matches and is linked or copied, False otherwise
+    """
+    if link:
+        if _hash_file(source) != hash_value:
+            return False
+        _link_or_copy(source, target, link)
+        return True
+
+    temp = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        if _reflink(source, temp):
+            actual = _hash_file(temp)
+        else:
+            hasher = hashlib.sha256()
+            with open(source, "rb") as fi, open(temp, "wb") as fo:
+                for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    fo.write(chunk)
+            actual = hasher.hexdigest()
+        if actual != hash_value:
+            os.unlink(temp)
+            return False
+        os.replace(temp, target)
+        return True
+    except BaseException:
+        if os.path.lexists(temp):
+            os.unlink(temp)
+        raise
+
+
+class _Transaction:
+    """Context manager over a connection: commit (or rollback) then close"""
+
+    def __init__(self, conn: sqlite3.Connection, write: bool):
+        self._conn = conn
+        self._write = write
+
+    def __enter__(self) -> sqlite3.Connection:
+        if self._write:
+            self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def __exit__(self, exc_type, *args):
+        if self._conn.in_transaction:
+            self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        self._conn.close()
+
+
+class ObjectCache(BaseCache):
+    """Content-addressed object cache with LRU eviction
+
+    Args:
+        config: the cache directory
+        max_size: the size cap in bytes
+    """
+
+    def __init__(self, config: Union[str, Path], max_size: int):
+        super().__init__(config)
+        self._dir = Path(config)
+        self._max_size = max_size
+        self._dir.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _transaction(self, write: bool = False) -> _Transaction:
+        """Open the index, a connection per call so it is safe across threads"""
+        conn = sqlite3.connect(
+            str(self._dir / FILE_CACHE_INDEX),
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return _Transaction(conn, write)
+
+    def _path(self, hash_value: str) -> Path:
+        return self._dir / DIR_CACHE_OBJECTS / hash_value[:2] / hash_value[2:]
+
+    def get_memory_location(self) -> str:
+        """Get the cache directory"""
+        return str(self._dir)
+
+    def size(self) -> int:
+        """The total size of cached objects in bytes"""
+        with self._transaction() as conn:
+            return conn.execute("SELECT size FROM total").fetchone()[0]
+
+    def _sizes(self, hash_values: List[str]) -> Dict[str, int]:
+        """The indexed size of each of the objects that the index has"""
+        result = {}
+        with self._transaction() as conn:
+            for start in range(0, len(hash_values), SQL_BATCH_SIZE):
+                batch = hash_values[start : start + SQL_BATCH_SIZE]
+                result.update(
+                    conn.execute(
+                        "SELECT hash, size FROM objects WHERE hash IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+        return result
+
+    def exists(self, hash_values: List[str]) -> List[bool]:
+        """Check whether the cache has the objects"""
+        return [self._path(each).exists() for each in hash_values]
+
+    def read(
+        self, hash_values: List[str], paths: List[str], link: bool = False
+    ) -> List[bool]:
+        """Copy the cached objects to `paths`
+
+        Args:
+            hash_values: the hashes of objects to read
+            paths: the corresponding target locations
+            link: hardlink instead of reflink or copy. Only for targets that are never
+                modified in place, like the objects of a storage
+
+        Returns:
+            True for each object that is read, False for cache misses and for
+                objects that do not match their hash, which are evicted
+        """
+        sizes = self._sizes(hash_values)
+        result, hit, bad = [], [], []
+        for hash_value, path in zip(hash_values, paths):
+            source = str(self._path(hash_value))
+            try:
+                size = os.path.getsize(source)
+                valid = size == sizes.get(hash_value, size)
+                valid = valid and _copy_verified(source, path, hash_value, link)
+            except FileNotFoundError:
+                result.append(False)
+                continue
+            if not valid:
+                bad.append(hash_value)
+                result.append(False)
+                continue
+            result.append(True)
+            hit.append(hash_value)
+
+        if bad:
+            self.delete(bad)
+        if hit:
+            now = time.time()
+            with self._transaction(write=True) as conn:
+                conn.executemany(
+                    "UPDATE objects SET atime = ? WHERE hash = ?",
+                    [(now, each) for each in hit],
+                )
+        return result
+
+    def write(self, hash_values: List[str], paths: List[str], link: bool = False):
+        """Add the objects to the cache, then evict if the cache is over its cap
+
+        Args:
+            hash_values: the hashes of objects
+            paths: the corresponding local files
+            link: hardlink instead of reflink or copy. Only for files that are never
+                modified in place, like the objects of a storage
+        """
+        records, now = [], time.time()
+        for hash_value, path in zip(hash_values, paths):
+            target = self._path(hash_value)
+            if not target.exists():
+                target.parent.mkdir(parents=True, exist_ok=True)
+                _link_or_copy(path, str(target), link)
+            records.append((hash_value, os.path.getsize(path), now))
+        if not records:
+            return
+
+        with self._transaction(write=True) as conn:
+            conn.executemany(
+                "INSERT INTO objects (hash, size, atime) VALUES (?, ?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET atime = excluded.atime",
+                records,
+            )
+        if self.size() > self._max_size:
+            self.evict(int(self._max_size * EVICT_TARGET))
+
+    def delete(self, hash_values: List[str]):
+        """Remove the objects from the cache"""
+        with self._transaction(write=True) as conn:
+            conn.executemany(
+                "DELETE FROM objects WHERE hash = ?", [(each,) for each in hash_values]
+            )
+            self._unlink(hash_values)
+
+    def evict(self, target_size: int) -> int:
+        """Remove the least recently used objects until the cache fits `target_size`
+
+        Args:
+            target_size: the size in bytes that the cache should fit
+
+        Returns:
+            The number of objects removed
+        """
+        with self._transaction(write=True) as conn:
+            total = conn.execute("SELECT size FROM total").fetchone()[0]
+            evicted = []
+            for hash_value, size in conn.execute(
+                "SELECT hash, size FROM objects ORDER BY atime"
+            ):
+                if total <= target_size:
+                    break
+                evicted.append(hash_value)
+                total -= size
+            conn.executemany(
+                "DELETE FROM objects WHERE hash = ?", [(each,) for each in evicted]
+            )
+            self._unlink(evicted)
+        return len(evicted)
+
+    def clean(self):
+        """Remove every cached object"""
+        self.evict(0)
+
+    def _unlink(self, hash_values: List[str]):
+        for each in hash_values:
+            try:
+                self._path(each).unlink()
+            except FileNotFoundError:
+                continue
+
+
+_caches: Dict[Tuple[str, int], ObjectCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_object_cache() -> Union[ObjectCache, None]:
+    """Get the object cache of the user, None unless `GOD_CACHE_SIZE` turns it on
+
+    The cache is created once per process (and per cache directory and size cap),
+    so its index schema is set up once rather than on every transfer.
+    """
+    max_size = int(os.environ.get("GOD_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+    if max_size <= 0:
+        return None
+    key = (str(Path(c.DIR_USER_CACHE).resolve()), max_size)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None or not (cache._dir / FILE_CACHE_INDEX).exists():
+            _caches[key] = ObjectCache(Path(key[0]), max_size=max_size)
+        return _caches[key]
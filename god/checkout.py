@@ -6,6 +6,7 @@ from god.commits.compare import transform_commit_id
 from god.core.files import get_files_tst
 from god.core.head import read_HEAD, update_HEAD
 from god.core.refs import get_ref, update_ref
+from god.core.shallow import get_shallow_commits
 from god.index.base import Index
 from god.index.trackchanges import track_staging_changes, track_working_changes
 from god.index.utils import column_index
@@ -93,11 +94,10 @@ def restore_working_one(fds, index_path, base_dir):
             (str(Path(base_dir, each[iname])), each[imhash] or each[ihash])
             for each in index.get_files(names=restore, get_remove=False, not_in=False)
         ]
-        from god.storage.commons import get_backend
+        from god.storage.promisor import get_objects
 
-        ls = get_backend()
         file_path, hash_value = zip(*restore_hashes)
-        ls.get_objects(list(hash_value), list(file_path))
+        get_objects(list(hash_value), list(file_path))
         # tsts = get_files_tst(restore, base_dir)
         # index.update(reset_tst=list(zip(restore, tsts)))
 
@@ -362,7 +362,12 @@ def reset(
     # collect the commit
     commit1 = get_ref(refs, ref_dir)
     commit2 = commit1
+    shallow = get_shallow_commits()
     for _ in range(head_past):
+        if commit2 in shallow:
+            raise OperationNotPermitted(
+                f"Cannot reset beyond shallow commit {commit2}. Fetch more history"
+            )
         commit_obj = read_commit(commit2)
         prev = commit_obj["prev"]
         commit2 = prev[0] if isinstance(prev, (list, tuple)) else prev
@@ -14,6 +14,8 @@ from god.porcelain import (
     clone_cmd,
     commit_cmd,
     fetch_cmd,
+    fsck_cmd,
+    gc_cmd,
     init_cmd,
     log_cmd,
     merge_cmd,
@@ -26,6 +28,8 @@ from god.porcelain import (
 )
 from god.remote.cli import main as remote_cli
 from god.storage.cli import main as storages_cli
+from god.storage.constants import GRACE_DAYS
+from god.storage.server import DEFAULT_HOST, DEFAULT_PORT, TOKEN_ENV
 
 
 class DynamicGroup(click.Group):
@@ -225,9 +229,12 @@ def merge(branch, include, exclude, continue_, abort):
 @main.command("fetch")
 @click.argument("branch", required=False, type=str, default="")
 @click.option("--remote", type=str, default="")
-def fetch(branch, remote):
+@click.option(
+    "--depth", type=int, default=0, help="Only fetch this many commits from the tip"
+)
+def fetch(branch, remote, depth):
     settings.set_global_settings()
-    fetch_cmd(branch, remote)
+    fetch_cmd(branch, remote, depth=depth)
 
 
 @main.command("apply")
@@ -267,13 +274,109 @@ def push(branch, remote):
 @click.argument("from_", type=str)
 @click.option("--location", type=str, default="", help="Target storage")
 @click.option("--local", is_flag=True, default=False)
-def clone(path, from_, location, local):
+@click.option(
+    "--filter",
+    "filter_",
+    is_flag=True,
+    default=False,
+    help="Partial clone: fetch commits and dirs, fetch objects on demand",
+)
+@click.option(
+    "--depth", type=int, default=0, help="Only fetch this many commits from the tip"
+)
+def clone(path, from_, location, local, filter_, depth):
     if local:
         location = "file://"
     if not location:
         location = from_
 
-    clone_cmd(path, from_, location)
+    clone_cmd(path, from_, location, filter_=filter_, depth=depth)
+
+
+@main.command("gc")
+@click.option(
+    "--dry-run", is_flag=True, default=False, help="Only report what would be removed"
+)
+@click.option(
+    "--grace-days",
+    type=float,
+    default=GRACE_DAYS,
+    help="Keep unreachable hashes modified within this many days",
+)
+@click.option(
+    "--remotes/--no-remotes",
+    default=True,
+    help="Keep the commits of remote-tracking refs",
+)
+@click.option(
+    "--allow-remote",
+    is_flag=True,
+    default=False,
+    help="Also sweep a remote storage, or the cold tier of a tiered storage",
+)
+def gc(dry_run, grace_days, remotes, allow_remote):
+    """Remove the objects, dirs and commits that no ref can reach"""
+    settings.set_global_settings()
+    gc_cmd(
+        dry_run=dry_run,
+        grace_days=grace_days,
+        remotes=remotes,
+        allow_remote=allow_remote,
+    )
+
+
+@main.command("fsck")
+@click.option(
+    "--sample",
+    type=float,
+    default=None,
+    help="Fraction of hashes to check, default to all in local storage, 1% elsewhere",
+)
+@click.option("--processes", type=int, default=None, help="Processes that hash files")
+@click.option(
+    "--bandwidth", type=float, default=None, help="Bytes per second to read at most"
+)
+@click.option(
+    "--restart", is_flag=True, default=False, help="Do not resume an interrupted check"
+)
+def fsck(sample, processes, bandwidth, restart):
+    """Verify the hashes and the references of the objects, dirs and commits"""
+    settings.set_global_settings()
+    if fsck_cmd(sample, processes, bandwidth, restart=restart):
+        sys.exit(1)
+
+
+@main.command("serve")
+@click.option("--host", type=str, default=DEFAULT_HOST, help="Address to listen on")
+@click.option("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+@click.option("--verbose", is_flag=True, default=False, help="Log every request")
+@click.option(
+    "--token",
+    type=str,
+    envvar=TOKEN_ENV,
+    default=None,
+    help=f"Token that clients send in {TOKEN_ENV}, required to push",
+)
+@click.option("--read-only", is_flag=True, default=False, help="Refuse pushes")
+def serve(host, port, verbose, token, read_only):
+    """Serve the storage and refs of the repo to `god+http://` clients
+
+    Without a token the repo is served read-only.
+    """
+    settings.set_global_settings()
+    from god.storage.commons import get_backend
+    from god.storage.server import serve as serve_storage
+
+    serve_storage(
+        get_backend(),
+        settings.DIR_REFS_HEADS,
+        host,
+        port,
+        verbose,
+        token=token,
+        read_only=read_only,
+        file_head=settings.FILE_HEAD,
+    )
 
 
 main.add_command(plugin_cli, "plugins")
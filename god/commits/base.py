@@ -10,6 +10,7 @@ from typing import Dict, List
 
 import yaml
 
+from god.core.shallow import get_shallow_commits
 from god.utils.common import get_string_hash
 from god.utils.exceptions import InvalidUserParams
 from god.utils.process import communicate
@@ -219,6 +220,7 @@ def get_latest_parent_commit(commit1: str, commit2: str) -> str:
     if not commit1:
         return ""
 
+    shallow = get_shallow_commits()
     to_check = queue.Queue()
     to_check.put(commit1)
     to_check.put(commit2)
@@ -234,6 +236,9 @@ def get_latest_parent_commit(commit1: str, commit2: str) -> str:
             return commit_id
 
         checked.add(commit_id)
+        if commit_id in shallow:
+            # parents of shallow boundary commits are not available
+            continue
         commit_obj = read_commit(commit_id)
         if isinstance(commit_obj["prev"], (list, tuple)):
             for _ in commit_obj["prev"]:
@@ -282,6 +287,7 @@ def get_in_between_commits(commit1: str, commit2: str) -> List[str]:
     if commit1 == commit2:
         return result
 
+    shallow = get_shallow_commits()
     to_check = queue.Queue()
     to_check.put(commit2)
 
@@ -297,6 +303,9 @@ def get_in_between_commits(commit1: str, commit2: str) -> List[str]:
         if commit_id != commit1:
             result.append(commit_id)
 
+        if commit_id in shallow:
+            continue
+
         commit_obj = read_commit(commit_id)
         if isinstance(commit_obj["prev"], (list, tuple)):
             for _ in commit_obj["prev"]:
@@ -0,0 +1,151 @@
+"""Read commits and dirs directly from a storage, many at a time
+
+Unlike `god.commits.base`, which reads 1 commit or dir per `god storages` subprocess,
+these functions take the storage object and read a whole batch per call.
+"""
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import yaml
+
+from god.storage.backends.base import BaseStorage
+
+
+def read_commit_file(path: str) -> Tuple[List[str], List[str]]:
+    """Read parent commits and tracked dirs from a commit file
+
+    Args:
+        path: the path to commit file
+
+    Returns:
+        List of parent commit hashes
+        List of dir hashes tracked by the commit
+    """
+    with open(path, "r") as fi:
+        commit_obj = yaml.safe_load(fi)
+
+    prevs = commit_obj["prev"]
+    prevs = [prevs] if isinstance(prevs, str) else prevs
+    prevs = [each for each in prevs if each]
+    dirs = [each for each in commit_obj["tracks"].values() if each]
+
+    return prevs, dirs
+
+
+def read_dir_file(path: str) -> Tuple[List[str], List[str]]:
+    """Read sub-dirs and objects from a dir file
+
+    Args:
+        path: the path to dir file
+
+    Returns:
+        List of sub-dir hashes
+        List of object hashes
+    """
+    with open(path, "r") as fi:
+        lines = fi.read().splitlines()
+
+    dirs, objects = [], []
+    for each_line in lines:
+        # @PRIORITY2: don't assume no ',' in filename -> more robust `dirs`
+        components = each_line.split(",")
+        if components[1] == "d":
+            dirs.append(components[-1])
+        else:
+            objects.append(components[-1])
+
+    return dirs, objects
+
+
+def read_commits(
+    storage: BaseStorage, hash_values: List[str], temp_dir: str
+) -> Dict[str, Tuple[List[str], List[str]]]:
+    """Read a batch of commits from `storage`
+
+    Args:
+        storage: the storage that contains the commits
+        hash_values: the commit hashes
+        temp_dir: the directory to temporarily hold the commit files, when the
+            storage is not in local filesystem
+
+    Returns:
+        The mapping from commit hash to its parent commits and tracked dirs
+    """
+    if not hash_values:
+        return {}
+
+    paths = storage.local_paths(hash_values, prefix=storage.COMMITS_PREFIX)
+    if paths is None:
+        paths = [str(Path(temp_dir, each)) for each in hash_values]
+        storage.get_commits(hash_values=hash_values, paths=paths)
+        temp_paths = paths
+    else:
+        temp_paths = []
+
+    result = {}
+    for hash_value, path in zip(hash_values, paths):
+        result[hash_value] = read_commit_file(path)
+    for path in temp_paths:
+        os.unlink(path)
+
+    return result
+
+
+def read_dir_contents(
+    storage: BaseStorage, hash_values: List[str], temp_dir: str
+) -> Dict[str, Tuple[List[str], List[str]]]:
+    """Read a batch of dirs from `storage`, keeping the contents of each dir
+
+    Args:
+        storage: the storage that contains the dirs
+        hash_values: the dir hashes
+        temp_dir: the directory to temporarily hold the dir files, when the storage
+            is not in local filesystem
+
+    Returns:
+        The mapping from dir hash to its sub-dirs and objects
+    """
+    if not hash_values:
+        return {}
+
+    paths = storage.local_paths(hash_values, prefix=storage.DIRS_PREFIX)
+    if paths is None:
+        paths = [str(Path(temp_dir, each)) for each in hash_values]
+        storage.get_dirs(hash_values=hash_values, paths=paths)
+        temp_paths = paths
+    else:
+        temp_paths = []
+
+    result = {}
+    for hash_value, path in zip(hash_values, paths):
+        result[hash_value] = read_dir_file(path)
+    for path in set(temp_paths):
+        os.unlink(path)
+
+    return result
+
+
+def read_dirs(
+    storage: BaseStorage, hash_values: List[str], temp_dir: str
+) -> Tuple[List[str], List[str]]:
+    """Read a batch of dirs from `storage`
+
+    Args:
+        storage: the storage that contains the dirs
+        hash_values: the dir hashes
+        temp_dir: the directory to temporarily hold the dir files, when the storage
+            is not in local filesystem
+
+    Returns:
+        List of sub-dir hashes
+        List of object hashes
+    """
+    contents = read_dir_contents(storage, hash_values, temp_dir)
+    dirs, objects = [], []
+    for hash_value in hash_values:
+        sub_dirs, sub_objects = contents[hash_value]
+        dirs += sub_dirs
+        objects += sub_objects
+
+    return dirs, objects
@@ -0,0 +1,60 @@
+from pathlib import Path
+from typing import List, Set, Union
+
+import god.utils.constants as c
+from god.core.common import get_base_dir
+
+
+def read_shallow(shallow_file: Union[str, Path]) -> Set[str]:
+    """Get the shallow boundary commits
+
+    A shallow boundary commit is a commit whose parents are not fetched.
+
+    Args:
+        shallow_file: path to the shallow file
+
+    Returns:
+        The commit ids at the shallow boundary, empty if the repo is not shallow
+    """
+    shallow_file = Path(shallow_file)
+    if not shallow_file.is_file():
+        return set()
+
+    with shallow_file.open("r") as f_in:
+        return set(each for each in f_in.read().splitlines() if each)
+
+
+def update_shallow(
+    shallow_file: Union[str, Path], add: List[str] = None, remove: List[str] = None
+):
+    """Add and remove shallow boundary commits
+
+    Args:
+        shallow_file: path to the shallow file
+        add: the commits that become shallow boundary
+        remove: the commits that are no longer shallow boundary
+    """
+    shallow = read_shallow(shallow_file)
+    shallow.update(add or [])
+    shallow.difference_update(remove or [])
+
+    shallow_file = Path(shallow_file)
+    if not shallow:
+        if shallow_file.is_file():
+            shallow_file.unlink()
+        return
+
+    with shallow_file.open("w") as f_out:
+        f_out.write("\n".join(sorted(shallow)) + "\n")
+
+
+def get_shallow_commits(base_dir: Union[str, Path] = None) -> Set[str]:
+    """Get the shallow boundary commits of the repo in `base_dir`
+
+    Args:
+        base_dir: the repository path, default to the current repository
+
+    Returns:
+        The commit ids at the shallow boundary
+    """
+    return read_shallow(Path(get_base_dir(path=base_dir), c.FILE_SHALLOW))
@@ -7,9 +7,9 @@ from typing import Dict
 import click
 
 from god.core.common import get_base_dir
+from god.storage.layout import DEFAULT_DEPTH, DEFAULT_WIDTH, LAYOUT_FILE, Layout
 
 DEFAULT_PATH = "storage"
-DEFAULT_DIR_LEVEL = 2
 
 
 class BaseDescriptor:
@@ -19,14 +19,18 @@ class BaseDescriptor:
         self._path = Path(
             config.get("PATH", Path(get_base_dir(), ".god", DEFAULT_PATH))
         )
-        self._dir_levels = config.get("DIR_LEVEL", DEFAULT_DIR_LEVEL)
+        layout_file = self._path / LAYOUT_FILE
+        if layout_file.is_file():
+            self._layout = Layout.loads(layout_file.read_text())
+        else:
+            self._layout = Layout(
+                depth=config.get("DIR_LEVEL", DEFAULT_DEPTH),
+                width=config.get("DIR_WIDTH", DEFAULT_WIDTH),
+            )
 
     def _get_hash_path(self, hash_value: str) -> str:
         """From hash value, get relative hash path"""
-        components = [
-            hash_value[idx * 2 : (idx + 1) * 2] for idx in range(self._dir_levels)
-        ]
-        return str(Path(*components, hash_value[self._dir_levels * 2 :]))
+        return str(Path(*self._layout.split(hash_value)))
 
     def store_descriptor_object(self, obj: Dict) -> str:
         content = json.dumps(obj, sort_keys=True, ensure_ascii=False)
@@ -1,22 +1,307 @@
-import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Set, Tuple, Union
 
-import yaml  # @PRIORITY3: whether to replace yaml with JSON
-
-from god.core.refs import get_ref, is_ref
+from god.commits.walk import read_commit_file, read_commits, read_dirs
+from god.core.refs import get_ref, is_ref, update_ref
+from god.core.shallow import read_shallow, update_shallow
+from god.storage.backends.base import BaseStorage
 from god.storage.callbacks import show_download_progress
 from god.storage.commons import get_backend
+from god.storage.journal import TransferJournal
+from god.storage.transfer import transfer
+from god.utils.common import get_string_hash
+
+# number of frontier rounds to walk commit history before listing all remote commits
+N_WALK_ROUNDS = 4
+# number of dirs to fetch per request when walking the trees
+DIR_BATCH_SIZE = 1000
+# the journal kinds that record the dirs and the shallow boundary of stored commits
+JOURNAL_TRACKED_DIRS = "tracked-dirs"
+JOURNAL_SHALLOW = "shallow"
+
+
+def _prefetch_commits(
+    remote_storage: BaseStorage, local_storage: BaseStorage, temp_dir: str
+) -> Dict[str, str]:
+    """Get all remote commits that local storage does not have in 1 batch
+
+    Walking a long history one frontier at a time costs 1 round trip per commit
+    generation. Listing the remote commits costs 1 round trip per 1000 commits.
+
+    Returns:
+        The mapping from commit hash to downloaded commit file
+    """
+    try:
+        commits = list(remote_storage.list_commits())
+    except NotImplementedError:
+        return {}
+
+    exists = local_storage.have_commits(commits)
+    missing = [commits[idx] for idx in range(len(commits)) if not exists[idx]]
+    if not missing:
+        return {}
+
+    paths = [str(Path(temp_dir, "commits", each)) for each in missing]
+    remote_storage.get_commits(hash_values=missing, paths=paths)
+    return dict(zip(missing, paths))
+
+
+def _fetch_commits(
+    remote_storage: BaseStorage,
+    local_storage: BaseStorage,
+    latest_commit: str,
+    current_commit: str,
+    depth: int,
+    temp_dir: str,
+    shallow_commits: Union[Set[str], None] = None,
+    journal: Union[TransferJournal, None] = None,
+) -> Tuple[List[str], List[str], List[str]]:
+    """Fetch the commits from `latest_commit` back, 1 frontier per round trip
+
+    The walk stops at commits that local storage already has, at `current_commit`
+    and at `depth` commit generations if `depth` is positive.
+
+    To deepen a shallow history, pass its boundary commits as `shallow_commits`: the
+    walk then goes through the commits that local storage has, down to `depth`
+    generations, and fetches the parents of the boundary commits it reaches.
+
+    With a journal, the dirs and the boundary of each batch of commits are recorded
+    before the commits are stored. A resumed walk stops at the commits that the
+    interrupted walk stored, and returns their records too.
+
+    Returns:
+        List of dir hashes tracked by the fetched commits
+        List of commits that become shallow boundary
+        List of boundary commits of `shallow_commits` whose parents are now fetched
+    """
+    shallow_commits = shallow_commits or set()
+    deepen = bool(shallow_commits)
+    dirs, shallow, deepened = [], [], []
+    prefetched: Dict[str, str] = {}
+    checked = set()
+    frontier = [latest_commit]
+    commit_depth = 1
+    while frontier:
+        frontier = [
+            each
+            for each in set(frontier)
+            if each and (deepen or each != current_commit) and each not in checked
+        ]
+        checked.update(frontier)
+        if not frontier:
+            break
+
+        at_limit = depth and commit_depth >= depth
+        exists = local_storage.have_commits(frontier)
+        missing = [frontier[idx] for idx in range(len(frontier)) if not exists[idx]]
+        present = []
+        if deepen and not at_limit:
+            present = [frontier[idx] for idx in range(len(frontier)) if exists[idx]]
+        if not missing and not present:
+            break
+
+        to_get = [each for each in missing if each not in prefetched]
+        if to_get:
+            paths = [str(Path(temp_dir, "commits", each)) for each in to_get]
+            remote_storage.get_commits(hash_values=to_get, paths=paths)
+            prefetched.update(zip(to_get, paths))
+
+        frontier, boundary, round_dirs = [], {}, []
+        for commit in missing:
+            prevs, commit_dirs = read_commit_file(prefetched[commit])
+            round_dirs += commit_dirs
+            if at_limit:
+                boundary[commit] = prevs
+                continue
+            frontier += prevs
+        for commit, (prevs, _) in read_commits(
+            local_storage, present, temp_dir
+        ).items():
+            if commit in shallow_commits:
+                deepened.append(commit)
+            frontier += prevs
+
+        # the commits at the depth limit are boundary if some parents are absent
+        prevs = list(
+            {each for commit_prevs in boundary.values() for each in commit_prevs}
+        )
+        prev_exists = dict(zip(prevs, local_storage.have_commits(prevs)))
+        prev_exists.update((each, True) for each in missing)
+        round_shallow = [
+            commit
+            for commit, commit_prevs in boundary.items()
+            if not all(prev_exists[each] for each in commit_prevs)
+        ]
+
+        if journal is not None:
+            journal.done(JOURNAL_TRACKED_DIRS, round_dirs)
+            journal.done(JOURNAL_SHALLOW, round_shallow)
+        local_storage.store_commits(
+            paths=[prefetched[each] for each in missing], hash_values=missing
+        )
+        dirs += round_dirs
+        shallow += round_shallow
+
+        if (
+            commit_depth == N_WALK_ROUNDS
+            and frontier
+            and (not depth or depth - commit_depth > N_WALK_ROUNDS)
+        ):
+            prefetched.update(
+                _prefetch_commits(remote_storage, local_storage, temp_dir)
+            )
+        commit_depth += 1
+
+    if journal is not None:
+        dirs += journal.finished(JOURNAL_TRACKED_DIRS)
+        shallow = sorted(set(shallow).union(journal.finished(JOURNAL_SHALLOW)))
+    return list(set(dirs)), shallow, deepened
+
+
+def _fetch_dirs(
+    remote_storage: BaseStorage,
+    local_storage: BaseStorage,
+    hash_values: List[str],
+    temp_dir: str,
+    journal: Union[TransferJournal, None] = None,
+) -> Tuple[List[str], List[str]]:
+    """Fetch dirs and read their content
+
+    Returns:
+        List of sub-dir hashes
+        List of object hashes
+    """
+    transfer(
+        remote_storage,
+        local_storage,
+        hash_values,
+        prefix=local_storage.DIRS_PREFIX,
+        journal=journal,
+    )
+    return read_dirs(local_storage, hash_values, temp_dir)
+
+
+def _fetch_objects(
+    remote_storage: BaseStorage,
+    local_storage: BaseStorage,
+    hash_values: List[str],
+    journal: Union[TransferJournal, None] = None,
+):
+    """Fetch the objects that local storage does not have"""
+    exists = local_storage.have_objects(hash_values)
+    to_migrate = [
+        hash_values[idx] for idx in range(len(hash_values)) if not exists[idx]
+    ]
+    transfer(
+        remote_storage,
+        local_storage,
+        to_migrate,
+        prefix=local_storage.OBJECTS_PREFIX,
+        progress_callback=show_download_progress,
+        journal=journal,
+    )
+
+
+def _fetch_trees(
+    remote_storage: BaseStorage,
+    local_storage: BaseStorage,
+    dirs: List[str],
+    temp_dir: str,
+    filter_objects: bool,
+    journal: Union[TransferJournal, None] = None,
+):
+    """Fetch the dirs level by level, and the objects as soon as they are found
+
+    Dirs of a level are fetched in batches of `DIR_BATCH_SIZE`, each batch is read as
+    soon as it arrives, while the objects it references are downloaded in background.
+
+    The dirs that local storage has are not walked, unless the journal resumes an
+    interrupted fetch, which may have stored a dir but not its content.
+    """
+    walk_present = journal is not None and journal.resumed
+    seen_dirs, seen_objects = set(), set()
+    object_jobs = []
+    with ThreadPoolExecutor() as dir_executor, ThreadPoolExecutor() as obj_executor:
+        level = dirs
+        while level:
+            level = [each for each in set(level) if each not in seen_dirs]
+            seen_dirs.update(level)
+            if not level:
+                break
+
+            exists = local_storage.have_dirs(level)
+            missing = [level[idx] for idx in range(len(level)) if not exists[idx]]
+            jobs = [
+                dir_executor.submit(
+                    _fetch_dirs,
+                    remote_storage,
+                    local_storage,
+                    missing[idx : idx + DIR_BATCH_SIZE],
+                    temp_dir,
+                    journal,
+                )
+                for idx in range(0, len(missing), DIR_BATCH_SIZE)
+            ]
+            if walk_present:
+                present = [level[idx] for idx in range(len(level)) if exists[idx]]
+                jobs += [
+                    dir_executor.submit(
+                        read_dirs,
+                        local_storage,
+                        present[idx : idx + DIR_BATCH_SIZE],
+                        temp_dir,
+                    )
+                    for idx in range(0, len(present), DIR_BATCH_SIZE)
+                ]
+
+            level = []
+            for job in as_completed(jobs):
+                sub_dirs, objects = job.result()
+                level += sub_dirs
+                if filter_objects:
+                    continue
+                objects = [each for each in set(objects) if each not in seen_objects]
+                seen_objects.update(objects)
+                if objects:
+                    object_jobs.append(
+                        obj_executor.submit(
+                            _fetch_objects,
+                            remote_storage,
+                            local_storage,
+                            objects,
+                            journal,
+                        )
+                    )
+
+        for job in object_jobs:
+            job.result()
 
 
 def fetch_object_storage(
-    branch: str, ref_remotes_dir: Union[Path, str], remote_path: str, local_path: str
+    branch: str,
+    ref_remotes_dir: Union[Path, str],
+    remote_path: str,
+    local_path: str,
+    filter_objects: bool = False,
+    depth: int = 0,
+    shallow_file: Union[Path, str, None] = None,
+    journal_dir: Union[Path, str, None] = None,
 ) -> bool:
     """Fetch the remote branch from central repository to local remote
 
     Args:
         branch: the name of the remote branch to fetch
         ref_remotes_dir: the local directory that store remote ref
+        remote_path: the remote storage location
+        local_path: the local storage location
+        filter_objects: if True, only fetch commits and dirs, objects are fetched on
+            demand later from the promisor remote
+        depth: if positive, only fetch `depth` commits from the tip of remote branch
+        shallow_file: the file that records shallow boundary commits
+        journal_dir: the directory of transfer journals, to resume an interrupted
+            fetch of the same branch
 
     Returns:
         True if remote is different than local, False otherwise
@@ -36,94 +321,60 @@ def fetch_object_storage(
         get_ref(branch, ref_remotes_dir) if is_ref(branch, ref_remotes_dir) else ""
     )
 
-    local_remote_branch = Path(ref_remotes_dir, branch)
-    local_remote_branch.parent.mkdir(parents=True, exist_ok=True)
-    remote_storage.get_refs([branch], [str(local_remote_branch)])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        Path(temp_dir, "commits").mkdir()
 
-    # get the latest commit
-    latest_commit = (
-        get_ref(branch, ref_remotes_dir) if is_ref(branch, ref_remotes_dir) else ""
-    )
+        # get the latest commit. The local remote ref only moves to it after the
+        # history is fetched, so an interrupted fetch resumes when it is run again
+        Path(temp_dir, "refs").mkdir()
+        remote_storage.get_refs([branch], [str(Path(temp_dir, "refs", "latest"))])
+        latest_commit = get_ref("latest", Path(temp_dir, "refs"))
 
-    if current_commit == latest_commit:
-        return False
+        # a deeper fetch walks back from the tip to the current shallow boundary
+        shallow_commits = set()
+        if depth and shallow_file:
+            shallow_commits = read_shallow(shallow_file)
 
-    if remote_path == local_path:
-        if current_commit == latest_commit:
+        if current_commit == latest_commit and not shallow_commits:
             return False
-        return True
-
-    local_storage = get_backend(local_path)
-
-    dirs, objects = [], []
-    commit = latest_commit
-    commit_branches = []
-    while commit and commit != current_commit:
-        if local_storage.have_commits(hash_values=[commit])[0]:
-            if commit_branches:
-                commit = commit_branches[0]
-                commit_branches = commit_branches[1:]
-                continue
-            else:
-                break
 
-        tmp_path = str(Path("/tmp", commit))  # @PRIORITY2: support cache
-        remote_storage.get_commits(hash_values=[commit], paths=[tmp_path])
-        local_storage.store_commits(paths=[tmp_path], hash_values=[commit])
-        with open(tmp_path, "r") as fi:
-            commit_obj = yaml.safe_load(fi)
-            if isinstance(commit_obj["prev"], str):
-                commit = commit_obj["prev"]
-            else:
-                commit = commit_obj["prev"][0]
-                commit_branches += commit_obj["prev"][1:]
-
-            for _, dir_hash in commit_obj["tracks"].items():
-                if dir_hash:
-                    dirs.append(dir_hash)
-        os.unlink(tmp_path)
-
-    dirs = list(set(dirs))
-    while dirs:
-        new_dirs = []
-
-        exists = local_storage.have_dirs(dirs)
-        to_migrate = [dirs[idx] for idx in range(len(dirs)) if not exists[idx]]
-        if not to_migrate:
-            break
+        if remote_path != local_path:
+            local_storage = get_backend(local_path)
+            journal = None
+            if journal_dir:
+                key = get_string_hash(f"{remote_path}:{branch}")
+                journal = TransferJournal(journal_dir, f"fetch-{key}")
 
-        # @PRIORITY2: support cache to not relying on `/tmp`
-        tmp_paths = [str(Path("/tmp", each)) for each in to_migrate]
-        remote_storage.get_dirs(hash_values=to_migrate, paths=tmp_paths)
-        local_storage.store_dirs(paths=tmp_paths, hash_values=to_migrate)
-
-        for each in tmp_paths:
-            # @PRIORIT2 more dedicated dirs function. This is basically a modification
-            # of god.commits.base.get_files_hashes_in_commit_dir
-            with open(each, "r") as fi:
-                lines = fi.read().splitlines()
-            for each_line in lines:
-                components = each_line.split(",")
-                if components[1] == "d":
-                    new_dirs.append(components[-1])
-                else:
-                    objects.append(components[-1])
-            os.unlink(each)
-
-        dirs = list(set(new_dirs))
-
-    objects = list(set(objects))
-    exists = local_storage.have_objects(objects)
-    to_migrate = [objects[idx] for idx in range(len(objects)) if not exists[idx]]
-    if to_migrate:
-        tmp_paths = [str(Path("/tmp", each)) for each in to_migrate]
-        remote_storage.get_objects(
-            hash_values=to_migrate,
-            paths=tmp_paths,
-            progress_callback=show_download_progress,
-        )
-        local_storage.store_objects(paths=tmp_paths, hash_values=to_migrate)
-        for each in tmp_paths:
-            os.unlink(each)
+            dirs, shallow, deepened = _fetch_commits(
+                remote_storage,
+                local_storage,
+                latest_commit=latest_commit,
+                current_commit=current_commit,
+                depth=depth,
+                temp_dir=temp_dir,
+                shallow_commits=shallow_commits,
+                journal=journal,
+            )
+            if shallow_file:
+                update_shallow(shallow_file, add=shallow)
+
+            _fetch_trees(
+                remote_storage,
+                local_storage,
+                dirs=dirs,
+                temp_dir=temp_dir,
+                filter_objects=filter_objects,
+                journal=journal,
+            )
 
-    return True
+            # the boundary moves only after the trees of the deepened history are
+            # fetched
+            if shallow_file:
+                update_shallow(shallow_file, remove=deepened)
+            if journal:
+                journal.close()
+
+    local_remote_branch = Path(ref_remotes_dir, branch)
+    local_remote_branch.parent.mkdir(parents=True, exist_ok=True)
+    update_ref(branch, latest_commit, ref_remotes_dir)
+    return current_commit != latest_commit
@@ -0,0 +1,339 @@
+"""Verify the integrity of the objects, dirs and commits in a storage
+
+`fsck` lists the storage shard by shard, and re-hashes the files in a process pool:
+objects and dirs are named by the SHA-256 of their content, commits by
+`calculate_commit_hash` of their content. The entries of each dir (sub-dirs and
+objects) and the pointers of each commit (parents and tracked dirs) must exist in
+the storage.
+
+Storages outside local filesystem are sampled by default: a hash is checked if the
+leading 32 bits of the SHA-256 of a per-run salt and the hash fall in the sampled
+fraction. The salt is recorded in the journal, so a resumed run checks the same
+hashes, and a new run checks different hashes.
+
+The problems are reported as dicts, so they can be dumped as JSON:
+
+    - {"kind": ..., "hash": ..., "problem": "corrupt", "actual": <the content hash>}
+    - {"kind": ..., "hash": ..., "problem": "unreadable", "error": <message>}
+    - {"kind": ..., "hash": ..., "problem": "missing", "referrer": <kind/hash>}
+"""
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple, Union
+
+import yaml
+
+import god.storage.constants as c
+from god.commits.base import calculate_commit_hash
+from god.commits.walk import read_commit_file, read_dir_file
+from god.storage.backends.base import CHUNK_SIZE, BaseStorage
+from god.storage.engine import TokenBucket
+from god.storage.journal import TransferJournal
+
+# the fraction of hashes to check in storages outside local filesystem
+DEFAULT_REMOTE_SAMPLE = 0.01
+# number of files to verify at a time
+FSCK_BATCH_SIZE = 1000
+# the journal kind that records the problems found in finished shards
+PROBLEMS = "problems"
+
+
+def in_sample(hash_value: str, sample: float, salt: str = "") -> bool:
+    """Whether `hash_value` is in the sampled fraction `sample` of all hashes
+
+    Args:
+        hash_value: the hash to check
+        sample: the fraction of hashes to check
+        salt: the salt of the run, each salt samples different hashes. Without salt,
+            the leading bits of the hash itself are used
+    """
+    if sample >= 1:
+        return True
+    if salt:
+        hash_value = hashlib.sha256(f"{salt}:{hash_value}".encode()).hexdigest()
+    try:
+        return int(hash_value[:8], 16) < sample * 16**8
+    except ValueError:
+        return True
+
+
+def verify_file(task: Tuple[str, str]) -> Tuple[Union[str, None], Dict, str]:
+    """Hash a file and read its references, run in the process pool
+
+    Args:
+        task: the kind of hash (objects, dirs or commits), and the file path
+
+    Returns:
+        The hash of the content, None if the file cannot be read
+        The referenced hashes by kind
+        The error message if the file cannot be read
+    """
+    kind, path = task
+    try:
+        if kind == c.DIR_COMMITS:
+            with open(path, "r") as fi:
+                actual = calculate_commit_hash(yaml.safe_load(fi))
+            prevs, dirs = read_commit_file(path)
+            return actual, {c.DIR_COMMITS: prevs, c.DIR_DIRS: dirs}, ""
+
+        hasher = hashlib.sha256()
+        with open(path, "rb") as fi:
+            for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        actual = hasher.hexdigest()
+        if kind == c.DIR_DIRS:
+            dirs, objects = read_dir_file(path)
+            return actual, {c.DIR_DIRS: dirs, c.DIR_OBJECTS: objects}, ""
+        return actual, {}, ""
+    except Exception as e:
+        return None, {}, f"{type(e).__name__}: {e}"
+
+
+class Fsck:
+    """Check a storage, a batch of files at a time
+
+    Args:
+        storage: the storage to check
+        report: called with each problem as it is found
+        sample: the fraction of hashes to check, default to all hashes in local
+            filesystem and DEFAULT_REMOTE_SAMPLE elsewhere
+        n_processes: the number of processes that hash files, default to the
+            number of CPUs
+        bandwidth: the cap in bytes per second of the files read, None for no cap
+        journal: the journal to record finished shards in, to resume an interrupted
+            check
+        shallow: the shallow boundary commits, whose parents may be absent
+        check_objects: if False, the objects that dirs point to may be absent, as in
+            partial clones
+        salt: the salt that picks the sampled hashes, default to the salt recorded
+            in the journal, or a new random salt
+    """
+
+    def __init__(
+        self,
+        storage: BaseStorage,
+        report: Callable[[Dict], None],
+        sample: Union[float, None] = None,
+        n_processes: Union[int, None] = None,
+        bandwidth: Union[float, None] = None,
+        journal: Union[TransferJournal, None] = None,
+        shallow: Union[Set[str], None] = None,
+        check_objects: bool = True,
+        salt: Union[str, None] = None,
+    ):
+        self.storage = storage
+        self._report = report
+        self._local = (
+            storage._local_path(storage._hash_path("", prefix=storage.OBJECTS_PREFIX))
+            is not None
+        )
+        if sample is None:
+            sample = 1.0 if self._local else DEFAULT_REMOTE_SAMPLE
+        self.sample = sample
+        self._n_processes = n_processes
+        self._bucket = TokenBucket(bandwidth)
+        self._journal = journal
+        self._shallow = shallow or set()
+        self._check_objects = check_objects
+        plan = journal.get_plan() if journal is not None else None
+        if plan is not None and plan.get("salt"):
+            salt = plan["salt"]
+        self.salt = salt or uuid.uuid4().hex
+        if journal is not None and plan is None:
+            journal.set_plan({"salt": self.salt})
+        self.checked: Dict[str, int] = defaultdict(int)
+        self.n_problems = 0
+        self._shard_problems: List[Dict] = []
+
+    def _problem(self, problem: Dict):
+        self.n_problems += 1
+        self._shard_problems.append(problem)
+        self._report(problem)
+
+    def run(self, roots: Union[List[str], None] = None) -> Dict:
+        """Check every (sampled) hash of the storage
+
+        Args:
+            roots: the commits that the refs point to, they must exist
+
+        Returns:
+            The number of hashes checked by kind ("checked"), and the number of
+                problems found ("problems"), including those of an interrupted run
+        """
+        storage = self.storage
+        if self._journal is not None:
+            for problem in self._journal.finished(PROBLEMS):
+                self._problem(json.loads(problem))
+        if roots:
+            self._check_exists(
+                {storage.COMMITS_PREFIX: {each: "refs" for each in roots}}
+            )
+
+        with ProcessPoolExecutor(max_workers=self._n_processes) as executor:
+            for kind in [
+                storage.OBJECTS_PREFIX,
+                storage.DIRS_PREFIX,
+                storage.COMMITS_PREFIX,
+            ]:
+                storage_prefix = storage._hash_path("", prefix=kind)
+                shards = storage._shards()
+                if self._journal is not None:
+                    shards = self._journal.pending(kind, shards)
+                for shard in shards:
+                    self._check_shard(executor, kind, storage_prefix, shard)
+
+        if self._journal is not None:
+            self._journal.close()
+        return {"checked": dict(self.checked), "problems": self.n_problems}
+
+    def _check_shard(
+        self, executor: ProcessPoolExecutor, kind: str, storage_prefix: str, shard: str
+    ):
+        """Check the (sampled) hashes of a shard, and record the shard as finished"""
+        self._shard_problems = []
+        batch = []
+        for name, size, _ in self.storage._scan_hashes(storage_prefix, shard):
+            hash_value = name.replace("/", "")
+            if not in_sample(hash_value, self.sample, self.salt):
+                continue
+            batch.append((hash_value, posixpath.join(storage_prefix, name), size))
+            if len(batch) >= FSCK_BATCH_SIZE:
+                self._check_batch(executor, kind, batch)
+                batch = []
+        if batch:
+            self._check_batch(executor, kind, batch)
+
+        if self._journal is not None:
+            if self._shard_problems:
+                self._journal.done(
+                    PROBLEMS,
+                    [json.dumps(each, sort_keys=True) for each in self._shard_problems],
+                )
+            self._journal.done(kind, [shard])
+
+    def _check_batch(
+        self,
+        executor: ProcessPoolExecutor,
+        kind: str,
+        batch: List[Tuple[str, str, int]],
+    ):
+        """Re-hash a batch of (hash, storage path, size), and check their references"""
+        time.sleep(self._bucket.reserve(sum(size for _, _, size in batch)))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = self._fetch(kind, batch, temp_dir)
+            tasks = [(kind, path) for path in paths if path is not None]
+            results = iter(
+                executor.map(
+                    verify_file,
+                    tasks,
+                    chunksize=max(1, len(tasks) // (4 * (os.cpu_count() or 1))),
+                )
+            )
+
+            references = defaultdict(dict)
+            for (hash_value, _, _), path in zip(batch, paths):
+                self.checked[kind] += 1
+                if path is None:
+                    continue
+                actual, refs, error = next(results)
+                if actual is None:
+                    self._problem(
+                        {
+                            "kind": kind,
+                            "hash": hash_value,
+                            "problem": "unreadable",
+                            "error": error,
+                        }
+                    )
+                    continue
+                if actual != hash_value:
+                    self._problem(
+                        {
+                            "kind": kind,
+                            "hash": hash_value,
+                            "problem": "corrupt",
+                            "actual": actual,
+                        }
+                    )
+                    continue
+                if kind == self.storage.COMMITS_PREFIX and hash_value in self._shallow:
+                    refs.pop(self.storage.COMMITS_PREFIX, None)
+                if not self._check_objects:
+                    refs.pop(self.storage.OBJECTS_PREFIX, None)
+                for ref_kind, hash_values in refs.items():
+                    for each in hash_values:
+                        references[ref_kind][each] = f"{kind}/{hash_value}"
+
+        self._check_exists(references)
+
+    def _fetch(
+        self, kind: str, batch: List[Tuple[str, str, int]], temp_dir: str
+    ) -> List[Union[str, None]]:
+        """Get the local path of each file in `batch`, downloaded if necessary
+
+        Returns:
+            The local paths, None for the files that cannot be downloaded
+        """
+        storage = self.storage
+        storage_paths = [storage_path for _, storage_path, _ in batch]
+        if self._local:
+            return [storage._local_path(each) for each in storage_paths]
+
+        # download without verification, to hash the files as they are stored
+        paths = [str(Path(temp_dir, hash_value)) for hash_value, _, _ in batch]
+        try:
+            storage._get(storage_paths=storage_paths, paths=paths)
+            return paths  # type: ignore
+        except Exception:
+            pass
+
+        result = []
+        for (hash_value, storage_path, _), path in zip(batch, paths):
+            try:
+                storage._get(storage_paths=[storage_path], paths=[path])
+                result.append(path)
+            except Exception as e:
+                self._problem(
+                    {
+                        "kind": kind,
+                        "hash": hash_value,
+                        "problem": "unreadable",
+                        "error": f"{type(e).__name__}: {e}",
+                    }
+                )
+                result.append(None)
+        return result
+
+    def _check_exists(self, references: Dict[str, Dict[str, str]]):
+        """Report the referenced hashes that the storage does not have
+
+        Args:
+            references: for each kind, the mapping from the referenced hash to the
+                hash that refers to it
+        """
+        storage = self.storage
+        for kind, referrers in references.items():
+            hash_values = list(referrers)
+            for start in range(0, len(hash_values), FSCK_BATCH_SIZE):
+                batch = hash_values[start : start + FSCK_BATCH_SIZE]
+                # ask the storage itself, its presence index may be wrong too
+                exists = storage._have(storage._read_paths(batch, prefix=kind))
+                for hash_value, exist in zip(batch, exists):
+                    if not exist:
+                        self._problem(
+                            {
+                                "kind": kind,
+                                "hash": hash_value,
+                                "problem": "missing",
+                                "referrer": referrers[hash_value],
+                            }
+                        )
@@ -0,0 +1,355 @@
+"""Remove the objects, dirs and commits that no ref can reach
+
+`gc` is a mark-and-sweep collector:
+
+    - mark: walk the history from the root commits (the refs, the detached HEAD),
+        then the trees a level at a time, and record every reachable hash in an
+        on-disk `HashSet`, so memory does not grow with the size of the repo. A
+        commit or dir already in the set is not expanded again
+    - sweep: list the storage, and delete in batches the hashes that are not in the
+        set. Commits are swept before dirs and dirs before objects, so an interrupted
+        sweep never leaves a stored commit or dir that points to a deleted hash
+
+Hashes that were modified within the grace period are kept, since they may belong to
+an `add`, `commit` or `fetch` that has not updated its refs or index yet.
+
+Only storages in local filesystem are swept by default: a remote storage may be
+shared with repos whose refs this repo does not know. For a tiered storage, only the
+hot tier is swept and the cold tier keeps every hash.
+"""
+import os
+import sqlite3
+import tempfile
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Union
+
+from god.commits.walk import read_commits, read_dirs
+from god.core.head import read_HEAD
+from god.core.refs import get_ref
+from god.storage.backends.base import BaseStorage
+from god.storage.backends.tiered import TieredStorage
+from god.storage.constants import GRACE_DAYS
+
+# number of hashes to read or delete at a time
+GC_BATCH_SIZE = 1000
+# index columns that hold object hashes
+INDEX_HASH_COLUMNS = ["hash", "mhash", "ctheirs", "cbase"]
+
+
+def _key(hash_value: str) -> bytes:
+    """The compact key of a hash: its digest if it is hex, else its text"""
+    try:
+        return bytes.fromhex(hash_value)
+    except ValueError:
+        return hash_value.encode()
+
+
+class HashSet:
+    """On-disk set of hashes, a table per kind of hash
+
+    Args:
+        path: the SQLite database file
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self._con = sqlite3.connect(str(path))
+        self._con.execute("PRAGMA journal_mode = OFF")
+        self._con.execute("PRAGMA synchronous = OFF")
+        self._tables: Set[str] = set()
+
+    def _table(self, kind: str) -> str:
+        if kind not in self._tables:
+            self._con.execute(
+                f'CREATE TABLE IF NOT EXISTS "{kind}" (key BLOB PRIMARY KEY) '
+                "WITHOUT ROWID"
+            )
+            self._tables.add(kind)
+        return f'"{kind}"'
+
+    def add(self, kind: str, hash_values: Iterable[str]) -> List[str]:
+        """Add hashes to the set
+
+        Args:
+            kind: the kind of hashes (objects, dirs or commits)
+            hash_values: the hashes to add
+
+        Returns:
+            The hashes that were not in the set, each once
+        """
+        table = self._table(kind)
+        added = []
+        with self._con:
+            for hash_value in hash_values:
+                cursor = self._con.execute(
+                    f"INSERT OR IGNORE INTO {table} VALUES (?)", (_key(hash_value),)
+                )
+                if cursor.rowcount:
+                    added.append(hash_value)
+        return added
+
+    def contains(self, kind: str, hash_values: List[str]) -> List[bool]:
+        """Check whether hashes are in the set
+
+        Args:
+            kind: the kind of hashes (objects, dirs or commits)
+            hash_values: the hashes to check
+
+        Returns:
+            True if the hash is in the set, False otherwise
+        """
+        table = self._table(kind)
+        query = f"SELECT 1 FROM {table} WHERE key = ?"
+        return [
+            self._con.execute(query, (_key(each),)).fetchone() is not None
+            for each in hash_values
+        ]
+
+    def close(self):
+        self._con.close()
+
+
+def _batches(items: List, size: int = GC_BATCH_SIZE) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def root_commits(ref_dirs: List[Union[str, Path]], file_head: Union[str, Path]):
+    """Get the commits that the refs and HEAD point to
+
+    Args:
+        ref_dirs: the directories of refs, searched recursively
+        file_head: the HEAD file, its commit is a root when HEAD is detached
+
+    Returns:
+        List of commit hashes
+    """
+    commits = set()
+    for ref_dir in ref_dirs:
+        ref_dir = Path(ref_dir)
+        if not ref_dir.is_dir():
+            continue
+        for path in ref_dir.rglob("*"):
+            if path.is_file():
+                commits.add(get_ref(str(path.relative_to(ref_dir)), ref_dir))
+
+    if Path(file_head).is_file():
+        commits.add(read_HEAD(file_head).commit())
+
+    return sorted(each for each in commits if each)
+
+
+def index_objects(index_dir: Union[str, Path]) -> List[str]:
+    """Get the objects that the indices of all plugins hold, staged or not
+
+    Args:
+        index_dir: the directory of the index databases
+
+    Returns:
+        List of object hashes
+    """
+    objects = set()
+    index_dir = Path(index_dir)
+    if not index_dir.is_dir():
+        return []
+
+    columns = ", ".join(INDEX_HASH_COLUMNS)
+    for path in sorted(index_dir.iterdir()):
+        if not path.is_file():
+            continue
+        con = sqlite3.connect(str(path))
+        try:
+            for row in con.execute(f"SELECT {columns} FROM main"):
+                objects.update(each for each in row if each)
+        finally:
+            con.close()
+
+    return sorted(objects)
+
+
+def mark(
+    storage: BaseStorage,
+    hash_set: HashSet,
+    commits: List[str],
+    objects: List[str],
+    shallow: Union[Set[str], None] = None,
+):
+    """Record every hash reachable from `commits` and `objects` in `hash_set`
+
+    Args:
+        storage: the storage that contains the commits and dirs
+        hash_set: the set to record the reachable hashes in
+        commits: the root commits
+        objects: the root objects, e.g. the objects in the index
+        shallow: the shallow boundary commits, whose parents are not walked
+    """
+    shallow = shallow or set()
+    hash_set.add(storage.OBJECTS_PREFIX, objects)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # walk the history
+        dirs = []
+        frontier = hash_set.add(storage.COMMITS_PREFIX, commits)
+        while frontier:
+            parents = []
+            for batch in _batches(frontier):
+                for commit, (prevs, commit_dirs) in read_commits(
+                    storage, batch, temp_dir
+                ).items():
+                    dirs += hash_set.add(storage.DIRS_PREFIX, commit_dirs)
+                    if commit not in shallow:
+                        parents += prevs
+            frontier = hash_set.add(storage.COMMITS_PREFIX, parents)
+
+        # walk the trees, a level at a time
+        while dirs:
+            sub_dirs = []
+            for batch in _batches(dirs):
+                level, sub_objects = read_dirs(storage, batch, temp_dir)
+                sub_dirs += hash_set.add(storage.DIRS_PREFIX, level)
+                hash_set.add(storage.OBJECTS_PREFIX, sub_objects)
+            dirs = sub_dirs
+
+
+def _sweep_batch(
+    hash_set: HashSet,
+    kind: str,
+    delete: Callable,
+    candidates: List[Tuple[str, int]],
+    dry_run: bool,
+) -> Tuple[int, int, Dict[str, str]]:
+    """Delete the unreachable hashes among `candidates`, a list of (hash, size)
+
+    Args:
+        hash_set: the reachable hashes
+        kind: the kind of hashes (objects, dirs or commits)
+        delete: the `delete_*` method of the storage for `kind`
+        candidates: the hashes and their sizes
+        dry_run: if True, do not delete anything
+
+    Returns:
+        The number of unreachable hashes
+        Their total size in bytes
+        The error message of each hash that cannot be deleted
+    """
+    reachable = hash_set.contains(kind, [each for each, _ in candidates])
+    unreachable = [
+        candidate for candidate, keep in zip(candidates, reachable) if not keep
+    ]
+    errors = delete([each for each, _ in unreachable], dry_run=dry_run)
+    return len(unreachable), sum(size for _, size in unreachable), errors
+
+
+def sweep(
+    storage: BaseStorage,
+    hash_set: HashSet,
+    grace_days: float = GRACE_DAYS,
+    dry_run: bool = False,
+) -> Dict[str, Dict]:
+    """Delete the hashes of `storage` that are not in `hash_set`
+
+    Args:
+        storage: the storage to sweep
+        hash_set: the reachable hashes
+        grace_days: keep the unreachable hashes modified within this many days
+        dry_run: if True, only report what would be deleted
+
+    Returns:
+        For each kind: the number ("count") and total size ("bytes") of the
+            unreachable hashes, and the error message of each hash that cannot be
+            deleted ("errors")
+    """
+    cutoff = time.time() - grace_days * 24 * 3600
+    report = {}
+    for kind, delete in [
+        (storage.COMMITS_PREFIX, storage.delete_commits),
+        (storage.DIRS_PREFIX, storage.delete_dirs),
+        (storage.OBJECTS_PREFIX, storage.delete_objects),
+    ]:
+        result = {"count": 0, "bytes": 0, "errors": {}}
+        storage_prefix = storage._hash_path("", prefix=kind)
+        scanned = (
+            (name.replace("/", ""), size)
+            for name, size, mtime in storage._scan_shards(
+                storage_prefix, storage._shards()
+            )
+            if mtime <= cutoff  # recent hashes
+        )
+        while True:
+            candidates = list(islice(scanned, GC_BATCH_SIZE))
+            if not candidates:
+                break
+            count, size, errors = _sweep_batch(
+                hash_set, kind, delete, candidates, dry_run
+            )
+            result["count"] += count
+            result["bytes"] += size
+            result["errors"].update(errors)
+        report[kind] = result
+
+    return report
+
+
+def sweep_target(storage: BaseStorage, allow_remote: bool = False) -> BaseStorage:
+    """Get the storage that `gc` deletes from
+
+    Args:
+        storage: the storage of the repo
+        allow_remote: if True, sweep storages outside local filesystem, and both
+            tiers of a tiered storage
+
+    Returns:
+        The hot tier of a tiered storage, else `storage`
+    """
+    if allow_remote:
+        return storage
+    if isinstance(storage, TieredStorage):
+        return storage._hot
+    if storage._local_path(storage._hash_path("", prefix=storage.OBJECTS_PREFIX)):
+        return storage
+    raise RuntimeError(
+        "The storage is not in local filesystem and may be shared with other repos, "
+        "pass --allow-remote to collect its garbage"
+    )
+
+
+def gc(
+    storage: BaseStorage,
+    commits: List[str],
+    objects: List[str],
+    shallow: Union[Set[str], None] = None,
+    grace_days: float = GRACE_DAYS,
+    dry_run: bool = False,
+    allow_remote: bool = False,
+) -> Dict[str, Dict]:
+    """Delete the objects, dirs and commits that `commits` and `objects` cannot reach
+
+    Args:
+        storage: the storage to collect
+        commits: the root commits, e.g. from `root_commits`
+        objects: the root objects, e.g. from `index_objects`
+        shallow: the shallow boundary commits, whose parents are not walked
+        grace_days: keep the unreachable hashes modified within this many days
+        dry_run: if True, only report what would be deleted
+        allow_remote: if True, sweep storages outside local filesystem, and both
+            tiers of a tiered storage
+
+    Returns:
+        Same as `sweep`
+    """
+    target = sweep_target(storage, allow_remote=allow_remote)
+    layout = getattr(storage, "_layout", None)
+    if layout is not None and layout.previous is not None:
+        raise RuntimeError(
+            "The storage is being re-laid out, continue `god storages relayout` "
+            "before collecting garbage"
+        )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        hash_set = HashSet(os.path.join(temp_dir, "reachable.sqlite"))
+        try:
+            mark(storage, hash_set, commits, objects, shallow=shallow)
+            return sweep(target, hash_set, grace_days=grace_days, dry_run=dry_run)
+        finally:
+            hash_set.close()
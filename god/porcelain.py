@@ -6,6 +6,7 @@ cli right into porcelain.
 import json
 import sys
 from pathlib import Path
+from typing import Union
 
 from rich import print as rprint
 
@@ -25,6 +26,7 @@ from god.core.refs import get_ref, is_ref, update_ref
 from god.core.status import status
 from god.init import init, repo_exists
 from god.merge import merge, merge_continue
+from god.storage.constants import GRACE_DAYS
 from god.utils.exceptions import InvalidUserParams
 
 
@@ -139,16 +141,24 @@ def commit_cmd(message):
 
 def log_cmd():
     """Print out repository history"""
+    from god.core.shallow import read_shallow
+
     refs = read_HEAD(settings.FILE_HEAD).get("REFS", None)
     commit_id = get_ref(refs, settings.DIR_REFS_HEADS)
+    shallow = read_shallow(settings.FILE_SHALLOW)
 
     while commit_id:
         commit_obj = read_commit(commit_id)
-        rprint(f"[yellow]commit {commit_id}[/]")
+        if commit_id in shallow:
+            rprint(f"[yellow]commit {commit_id} (shallow)[/]")
+        else:
+            rprint(f"[yellow]commit {commit_id}[/]")
         rprint(f"Author: {commit_obj['user']} <{commit_obj['email']}>")
         rprint()
         rprint(f"\t{commit_obj['message']}")
         rprint()
+        if commit_id in shallow:
+            break
         prev = commit_obj["prev"]
         commit_id = prev[0] if isinstance(prev, (list, int)) else prev
 
@@ -307,7 +317,7 @@ def merge_cmd(branch, include, exclude, continue_, abort):
         merge_file.unlink()
 
 
-def fetch_cmd(branch: str, remote: str):
+def fetch_cmd(branch: str, remote: str, depth: int = 0):
     """Fetch commits from remote to local
 
     Args:
@@ -315,6 +325,7 @@ def fetch_cmd(branch: str, remote: str):
             has the same branch name as current active local branch
         remote: the specific remote repository that we will fetch from. If blank, use
             the default remote. If default remote has not been set, raise error
+        depth: if positive, only fetch `depth` commits from the remote tip
     """
     from pathlib import Path
 
@@ -322,7 +333,7 @@ def fetch_cmd(branch: str, remote: str):
 
     from god.fetch import fetch_object_storage
     from god.remote import get_remote_declaration_config_path
-    from god.remote.base import get_default_remote, get_remote
+    from god.remote.base import get_default_remote, get_promisor_remote, get_remote
 
     remote_config_path = get_remote_declaration_config_path()
     if not remote:
@@ -347,6 +358,10 @@ def fetch_cmd(branch: str, remote: str):
         ref_remotes_dir=Path(settings.DIR_REFS_REMOTES, remote),
         remote_path=remote_loc[remote],
         local_path=local_path,
+        filter_objects=get_promisor_remote(remote_config_path) == remote,
+        depth=depth,
+        shallow_file=settings.FILE_SHALLOW,
+        journal_dir=settings.DIR_TRANSFERS,
     )
     if need_apply:
         print(f'"Fetched latest commit of "{branch}". Run `god apply` to merge')
@@ -409,8 +424,20 @@ def pull_cmd(branch: str, remote: str, method: int):
     apply_cmd(branch, remote, method)
 
 
-def clone_cmd(path, from_: str, location: str):
-    """Clone from remote storage to current storage"""
+def clone_cmd(path, from_: str, location: str, filter_: bool = False, depth: int = 0):
+    """Clone from remote storage to current storage
+
+    Args:
+        path: the directory to clone into
+        from_: the remote storage location
+        location: the storage location of the new repo
+        filter_: if True, do a partial clone: only fetch commits and dirs, and fetch
+            objects on demand from "origin"
+        depth: if positive, do a shallow clone of `depth` commits
+
+    The clone is journaled: running the same clone again into the directory of an
+    interrupted clone resumes it.
+    """
     import os
 
     import yaml
@@ -422,17 +449,29 @@ def clone_cmd(path, from_: str, location: str):
     from god.plugins.base import installed_plugins
     from god.plugins.manager import awake_passive_plugin
     from god.remote import get_remote_declaration_config_path
-    from god.remote.base import set_default_remote, set_remote
+    from god.remote.base import set_default_remote, set_promisor_remote, set_remote
+    from god.storage.journal import TransferJournal
 
-    # initialize the repo
+    # initialize the repo, or resume the interrupted clone in it
     path = Path(path).resolve()
-    if path.is_dir():
-        repo_exists(path)
-    elif path.is_file():
-        raise RuntimeError(f'"{path}" is file')
+    plan = {"from": from_, "location": location, "filter": filter_, "depth": depth}
+    journal = TransferJournal(path / c.DIR_TRANSFERS, "clone")
+    if journal.resumed:
+        if journal.get_plan() != plan:
+            raise RuntimeError(
+                f'"{path}" has an interrupted clone with other arguments: '
+                f"{journal.get_plan()}"
+            )
+        print(f'=> Resume the clone in "{path.name}"', file=sys.stderr)
     else:
-        path.mkdir(parents=True, exist_ok=True)
-    init(path)
+        if path.is_dir():
+            repo_exists(path)
+        elif path.is_file():
+            raise RuntimeError(f'"{path}" is file')
+        else:
+            path.mkdir(parents=True, exist_ok=True)
+        init(path)
+        journal.set_plan(plan)
 
     # edit to correct endpoints
     remote_config_path = get_remote_declaration_config_path(str(path))
@@ -453,6 +492,10 @@ def clone_cmd(path, from_: str, location: str):
         new_location = "file://" + str(path / ".god")
     else:
         new_location = location
+
+    filter_ = filter_ and new_location != from_
+    if filter_:
+        set_promisor_remote(name="origin", remote_config_path=remote_config_path)
     print(f'=> Create directory "{path.name}"', file=sys.stderr)
 
     # fetch
@@ -461,6 +504,10 @@ def clone_cmd(path, from_: str, location: str):
         ref_remotes_dir=str(path / c.DIR_REFS_REMOTES / "origin"),
         remote_path=from_,
         local_path=new_location,
+        filter_objects=filter_,
+        depth=depth,
+        shallow_file=str(path / c.FILE_SHALLOW),
+        journal_dir=str(path / c.DIR_TRANSFERS),
     )
 
     # apply
@@ -471,6 +518,7 @@ def clone_cmd(path, from_: str, location: str):
     for plugin in installed_plugins():
         awake_passive_plugin(plugin)
     update_ref("main", commit2, path / c.DIR_REFS_HEADS)
+    journal.close()
 
 
 def push_cmd(branch: str, remote: str):
@@ -511,4 +559,103 @@ def push_cmd(branch: str, remote: str):
         remote_ref_path=str(Path(settings.DIR_REFS_REMOTES, remote)),
         remote_path=remote_loc,
         local_path=local_path,
+        journal_dir=settings.DIR_TRANSFERS,
+    )
+
+
+def gc_cmd(
+    dry_run: bool = False,
+    grace_days: float = GRACE_DAYS,
+    remotes: bool = True,
+    allow_remote: bool = False,
+):
+    """Delete the objects, dirs and commits that no ref can reach
+
+    Args:
+        dry_run: if True, only report what would be deleted
+        grace_days: keep the unreachable hashes modified within this many days
+        remotes: if True, the remote-tracking refs also keep their commits
+        allow_remote: if True, sweep a storage outside local filesystem, and the
+            cold tier of a tiered storage
+    """
+    from god.core.shallow import get_shallow_commits
+    from god.gc import gc, index_objects, root_commits
+    from god.storage.commons import get_backend
+
+    ref_dirs = [settings.DIR_REFS_HEADS]
+    if remotes:
+        ref_dirs.append(settings.DIR_REFS_REMOTES)
+
+    report = gc(
+        get_backend(),
+        commits=root_commits(ref_dirs, settings.FILE_HEAD),
+        objects=index_objects(settings.DIR_INDICES),
+        shallow=get_shallow_commits(),
+        grace_days=grace_days,
+        dry_run=dry_run,
+        allow_remote=allow_remote,
     )
+
+    action = "Would remove" if dry_run else "Removed"
+    for kind, result in report.items():
+        print(f"{action} {result['count']} {kind}, {result['bytes']} bytes")
+        for hash_value, message in result["errors"].items():
+            print(f"  Cannot remove {hash_value}: {message}", file=sys.stderr)
+
+
+def fsck_cmd(
+    sample: Union[float, None] = None,
+    n_processes: Union[int, None] = None,
+    bandwidth: Union[float, None] = None,
+    restart: bool = False,
+) -> int:
+    """Verify the storage, print each problem and the summary as a line of JSON
+
+    An interrupted check is resumed from its last finished shard.
+
+    Args:
+        sample: the fraction of hashes to check, default to all hashes in local
+            filesystem and a sample elsewhere
+        n_processes: the number of processes that hash files
+        bandwidth: the cap in bytes per second of the files read
+        restart: if True, discard the interrupted check and start over
+
+    Returns:
+        The number of problems found
+    """
+    import yaml
+
+    from god.core.shallow import get_shallow_commits
+    from god.fsck import Fsck
+    from god.gc import root_commits
+    from god.remote import get_remote_declaration_config_path
+    from god.remote.base import get_promisor_remote
+    from god.storage.commons import get_backend
+    from god.storage.journal import TransferJournal
+    from god.utils.common import get_string_hash
+
+    remote_config_path = get_remote_declaration_config_path()
+    with open(remote_config_path, "r") as fi:
+        storage_path = yaml.safe_load(fi)["storage"]
+    storage = get_backend(storage_path)
+
+    journal_name = f"fsck-{get_string_hash(f'{storage_path}:{sample}')}"
+    if restart:
+        TransferJournal(settings.DIR_TRANSFERS, journal_name).close()
+    journal = TransferJournal(settings.DIR_TRANSFERS, journal_name)
+
+    def report(problem):
+        print(json.dumps(problem), flush=True)
+
+    summary = Fsck(
+        storage,
+        report,
+        sample=sample,
+        n_processes=n_processes,
+        bandwidth=bandwidth,
+        journal=journal,
+        shallow=get_shallow_commits(),
+        check_objects=not get_promisor_remote(remote_config_path),
+    ).run(roots=root_commits([settings.DIR_REFS], settings.FILE_HEAD))
+    print(json.dumps(summary))
+    return summary["problems"]
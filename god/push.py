@@ -1,15 +1,142 @@
-import os
+import tempfile
 from pathlib import Path
+from typing import Dict, List, Set, Tuple, Union
 
-from god.commits.base import (
-    get_dir_hashes_in_commit,
-    get_files_hashes_in_commit,
-    get_in_between_commits,
-    get_latest_parent_commit,
-    get_plugins_in_commit,
-)
+from god.commits.base import get_latest_parent_commit
+from god.commits.walk import read_commits, read_dir_contents
 from god.core.refs import get_ref, update_ref
+from god.core.shallow import get_shallow_commits
+from god.storage.backends.base import BaseStorage
 from god.storage.commons import get_backend
+from god.storage.journal import TransferJournal
+from god.storage.manifest import (
+    MAX_SEGMENTS,
+    compact_manifest,
+    init_manifest,
+    sync_manifest,
+)
+from god.storage.transfer import transfer
+from god.utils.common import get_string_hash
+
+
+def plan_push(
+    local_storage: BaseStorage,
+    remote_storage: BaseStorage,
+    local_commit: str,
+    parent_commit: str,
+    shallow: Set[str] = None,
+) -> Tuple[List[str], List[List[str]], List[str]]:
+    """Find the exact objects, dirs and commits that remote storage lacks
+
+    The history and the trees are walked once, a frontier at a time, and each dir is
+    visited once no matter how many commits contain it. A commit or dir that remote
+    already has is not expanded: `push_ref` uploads objects before dirs, dirs bottom
+    up, and commits last, so everything under it is also in remote.
+
+    Args:
+        local_storage: the storage that contains the commits to push
+        remote_storage: the storage to push to
+        local_commit: the commit to push
+        parent_commit: the latest commit that remote has, the walk stops there
+        shallow: the shallow boundary commits, whose parents are not walked
+
+    Returns:
+        List of object hashes to upload
+        List of dir hashes to upload, grouped by height in the trees, from top to
+            bottom
+        List of commit hashes to upload
+    """
+    shallow = shallow or set()
+    commits, dirs = [], []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # walk the history
+        seen = set()
+        frontier = [local_commit]
+        while frontier:
+            frontier = [
+                each
+                for each in set(frontier)
+                if each and each != parent_commit and each not in seen
+            ]
+            seen.update(frontier)
+            if not frontier:
+                break
+
+            exists = remote_storage.have_commits(frontier)
+            missing = [frontier[idx] for idx in range(len(frontier)) if not exists[idx]]
+            commits += missing
+
+            frontier = []
+            for commit, (prevs, commit_dirs) in read_commits(
+                local_storage, missing, temp_dir
+            ).items():
+                dirs += commit_dirs
+                if commit not in shallow:
+                    frontier += prevs
+
+        # walk the trees
+        children, objects = {}, set()
+        seen = set()
+        level = dirs
+        while level:
+            level = [each for each in set(level) if each not in seen]
+            seen.update(level)
+            if not level:
+                break
+
+            exists = remote_storage.have_dirs(level)
+            missing = [level[idx] for idx in range(len(level)) if not exists[idx]]
+            if not missing:
+                break
+
+            level = []
+            for dir_hash, (sub_dirs, sub_objects) in read_dir_contents(
+                local_storage, missing, temp_dir
+            ).items():
+                children[dir_hash] = sub_dirs
+                level += sub_dirs
+                objects.update(sub_objects)
+
+    objects = list(objects)
+    exists = remote_storage.have_objects(objects)
+    objects = [objects[idx] for idx in range(len(objects)) if not exists[idx]]
+
+    return objects, _dir_levels(children), commits
+
+
+def _dir_levels(children: Dict[str, List[str]]) -> List[List[str]]:
+    """Group the dirs to upload by height, so that a dir comes after its sub-dirs
+
+    A subtree shared by several commits can sit at different depths, so the level at
+    which the walk first meets a dir does not order it. The height of a dir is 0 if
+    none of its sub-dirs is uploaded, else 1 + the highest height of those sub-dirs.
+
+    Args:
+        children: the sub-dirs of each dir to upload
+
+    Returns:
+        The dirs grouped by height, from the highest to 0
+    """
+    heights: Dict[str, int] = {}
+    for root in children:
+        stack = [(root, False)]
+        while stack:
+            dir_hash, expanded = stack.pop()
+            if dir_hash in heights:
+                continue
+            subs = [each for each in children[dir_hash] if each in children]
+            if expanded:
+                heights[dir_hash] = 1 + max(
+                    (heights[each] for each in subs), default=-1
+                )
+            else:
+                stack.append((dir_hash, True))
+                stack += [(each, False) for each in subs if each not in heights]
+
+    levels = [[] for _ in range(max(heights.values(), default=-1) + 1)]
+    for dir_hash, height in heights.items():
+        levels[height].append(dir_hash)
+    return levels[::-1]
 
 
 def push_ref(
@@ -18,8 +145,19 @@ def push_ref(
     remote_ref_path: str,
     remote_path: str,
     local_path: str,
+    journal_dir: Union[str, None] = None,
 ):
-    """Put the ref from local to remote storage, transfer any necessary files"""
+    """Put the ref from local to remote storage, transfer any necessary files
+
+    Args:
+        ref_name: the name of the ref to push
+        local_ref_path: the local directory that stores the ref
+        remote_ref_path: the local directory that stores the remote ref
+        remote_path: the remote storage location
+        local_path: the local storage location
+        journal_dir: the directory of transfer journals, to resume an interrupted
+            push of the same commit without planning again
+    """
     remote_storage = get_backend(remote_path)
 
     # check if the ref exists on remote
@@ -43,57 +181,82 @@ def push_ref(
         raise RuntimeError("Local and remote diverge. Run `god pull`")
 
     # 3. the remote tip is a parent of local tip, perform upload
-    local_storage = get_backend(local_path)
-
-    # get intermediate commits
-    commits = list(set(get_in_between_commits(parent_commit, local_commit)))
+    # answer remote existence checks from its manifest when possible
+    init_manifest(remote_storage)
+    sync_manifest(remote_storage)
 
-    # get directories and objects
-    dirs, objects = [], []
-    for commit in commits:
-        plugins = get_plugins_in_commit(commit_id=commit)
-        for plugin in plugins:
-            objects += list(
-                get_files_hashes_in_commit(commit_id=commit, plugin=plugin).values()
-            )
-            dirs += list(
-                get_dir_hashes_in_commit(commit_id=commit, plugin=plugin).values()
+    local_storage = get_backend(local_path)
+    journal = (
+        TransferJournal(
+            journal_dir,
+            f"push-{get_string_hash(f'{remote_path}:{ref_name}:{local_commit}')}",
+        )
+        if journal_dir
+        else None
+    )
+    plan = journal.get_plan() if journal else None
+    if plan is not None:
+        objects, dir_levels, commits = (
+            plan["objects"],
+            plan["dir_levels"],
+            plan["commits"],
+        )
+    else:
+        objects, dir_levels, commits = plan_push(
+            local_storage,
+            remote_storage,
+            local_commit=local_commit,
+            parent_commit=parent_commit,
+            shallow=get_shallow_commits(),
+        )
+        if journal:
+            journal.set_plan(
+                {"objects": objects, "dir_levels": dir_levels, "commits": commits}
             )
-    objects = list(set(objects))
-    dirs = list(set(dirs).difference(["", None]))
 
-    # upload objects
-    exists = remote_storage.have_objects(objects)
-    to_migrate = [objects[idx] for idx in range(len(objects)) if not exists[idx]]
-    if to_migrate:
-        tmp_paths = [str(Path("/tmp", each)) for each in to_migrate]
-        local_storage.get_objects(hash_values=to_migrate, paths=tmp_paths)
-        remote_storage.store_objects(paths=tmp_paths, hash_values=to_migrate)
-        for each in tmp_paths:
-            os.unlink(each)
-
-    # upload dirs
-    exists = remote_storage.have_dirs(dirs)
-    to_migrate = [dirs[idx] for idx in range(len(dirs)) if not exists[idx]]
-    if to_migrate:
-        tmp_paths = [str(Path("/tmp", each)) for each in to_migrate]
-        local_storage.get_dirs(hash_values=to_migrate, paths=tmp_paths)
-        remote_storage.store_dirs(paths=tmp_paths, hash_values=to_migrate)
-        for each in tmp_paths:
-            os.unlink(each)
-
-    # upload commits
-    exists = remote_storage.have_commits(commits)
-    to_migrate = [commits[idx] for idx in range(len(commits)) if not exists[idx]]
-    if to_migrate:
-        tmp_paths = [str(Path("/tmp", each)) for each in to_migrate]
-        local_storage.get_commits(hash_values=to_migrate, paths=tmp_paths)
-        remote_storage.store_commits(paths=tmp_paths, hash_values=to_migrate)
-        for each in tmp_paths:
-            os.unlink(each)
+    # upload objects, then dirs from the deepest level, then commits
+    transfer(
+        local_storage,
+        remote_storage,
+        objects,
+        prefix=local_storage.OBJECTS_PREFIX,
+        journal=journal,
+    )
+    for dirs in reversed(dir_levels):
+        transfer(
+            local_storage,
+            remote_storage,
+            dirs,
+            prefix=local_storage.DIRS_PREFIX,
+            journal=journal,
+        )
+    transfer(
+        local_storage,
+        remote_storage,
+        commits,
+        prefix=local_storage.COMMITS_PREFIX,
+        journal=journal,
+    )
+
+    # each stored batch appended a manifest segment, merge them
+    for kind in [
+        local_storage.OBJECTS_PREFIX,
+        local_storage.DIRS_PREFIX,
+        local_storage.COMMITS_PREFIX,
+    ]:
+        compact_manifest(remote_storage, kind, max_segments=MAX_SEGMENTS)
 
     # update the index above
-    remote_storage.store_refs(
-        paths=[str(Path(local_ref_path, ref_name))], refs=[ref_name]
-    )
+    if hasattr(remote_storage, "swap_ref"):
+        # the remote tip must still be the one that the push was planned from
+        if not remote_storage.swap_ref(
+            ref_name, old=remote_commit or None, new=local_commit
+        ):
+            raise RuntimeError("The remote ref moved during the push. Run `god pull`")
+    else:
+        remote_storage.store_refs(
+            paths=[str(Path(local_ref_path, ref_name))], refs=[ref_name]
+        )
     update_ref(ref_name, local_commit, remote_ref_path)
+    if journal:
+        journal.close()
@@ -37,6 +37,28 @@ def get_default_remote(remote_config_path: Union[str, Path]) -> str:
     return data.get("default_remote", "")
 
 
+def set_promisor_remote(name: str, remote_config_path: Union[str, Path]):
+    """Mark remote as promisor, from which missing objects are fetched on demand"""
+    with open(remote_config_path, "r") as fi:
+        data = yaml.safe_load(fi)
+        remotes = data.get("remotes", {})
+
+    if name not in remotes:
+        raise RuntimeError(f'Remote "{name}" does not exist')
+
+    data["promisor_remote"] = name
+    with open(remote_config_path, "w") as fo:
+        yaml.dump(data, fo)
+
+
+def get_promisor_remote(remote_config_path: Union[str, Path]) -> str:
+    """Get the promisor remote, empty string if the repo is not a partial clone"""
+    with open(remote_config_path, "r") as fi:
+        data = yaml.safe_load(fi)
+
+    return data.get("promisor_remote", "")
+
+
 def get_remote(remote_config_path: Union[str, Path], name: str = "") -> Dict[str, str]:
     """Get registered remote repository"""
     with open(remote_config_path, "r") as fi:
@@ -91,6 +113,8 @@ def unset_remote(
 
     remotes.pop(name)
     data["remotes"] = remotes
+    if data.get("promisor_remote", "") == name:
+        data["promisor_remote"] = ""
     with open(remote_config_path, "w") as fo:
         yaml.dump(data, fo)
 
@@ -1,7 +1,92 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
 from abc import ABCMeta, abstractmethod
-from typing import Callable, List, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
 
 import god.storage.constants as c
+from god.cache.objects import ObjectCache, get_object_cache
+from god.storage.layout import LAYOUT_FILE, LAYOUT_RELOAD_INTERVAL, Layout
+from god.storage.presence import PresenceIndex
+from god.utils.exceptions import IntegrityError
+
+# number of threads to list the storage shards
+N_LIST_THREADS = 16
+# downloads are written to `<path><PARTIAL_SUFFIX>`, then renamed to `<path>`
+PARTIAL_SUFFIX = ".part"
+# size of the chunks that verified downloads are streamed in
+CHUNK_SIZE = 1024 * 1024
+# number of times to download a file again when its content does not match its hash
+VERIFY_RETRIES = 2
+
+
+def partial_path(path: str) -> str:
+    """The temporary path that a download to `path` is written to"""
+    return f"{path}{PARTIAL_SUFFIX}"
+
+
+def remove_partial(path: str):
+    """Remove the partial files left by an interrupted download to `path`"""
+    path_ = Path(partial_path(path))
+    for each in [path_, *path_.parent.glob(f"{path_.name}.*")]:
+        try:
+            each.unlink()
+        except FileNotFoundError:
+            continue
+
+
+def write_verified(
+    path: str,
+    chunks: Iterable[bytes],
+    hash_value: str,
+    on_bytes: Union[Callable[[int], None], None] = None,
+):
+    """Write the chunks to `path`, hashing them on the way to disk
+
+    The chunks are written to the partial path of `path`. If their SHA-256 matches
+    `hash_value` the file is moved into place, otherwise it is quarantined. If the
+    chunks fail or the write is interrupted, the partial file is removed.
+
+    Args:
+        path: the local file to write
+        chunks: the content of the file
+        hash_value: the expected SHA-256 of the content
+        on_bytes: called with the size of each chunk written
+
+    Raises:
+        IntegrityError: the content does not match `hash_value`
+    """
+    temp_path = partial_path(path)
+    hasher = hashlib.sha256()
+    try:
+        with open(temp_path, "wb") as fo:
+            for chunk in chunks:
+                hasher.update(chunk)
+                fo.write(chunk)
+                if on_bytes:
+                    on_bytes(len(chunk))
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    digest = hasher.hexdigest()
+    if digest != hash_value:
+        quarantine = Path(c.DIR_USER_CACHE, c.DIR_QUARANTINE, hash_value, digest)
+        quarantine.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(temp_path, quarantine)
+        raise IntegrityError(
+            f"{path} should have hash {hash_value} but has {digest}, "
+            f"quarantined at {quarantine}"
+        )
+    os.replace(temp_path, path)
 
 
 class BaseStorage(metaclass=ABCMeta):
@@ -14,21 +99,129 @@ class BaseStorage(metaclass=ABCMeta):
     OBJECTS_PREFIX = c.DIR_OBJECTS
     DIRS_PREFIX = c.DIR_DIRS
     COMMITS_PREFIX = c.DIR_COMMITS
+    # whether every write to the storage goes through this machine, so that a
+    # complete presence index can also answer that a hash is absent
+    PRESENCE_EXCLUSIVE = False
+    # whether objects got from the storage are read through the user object cache
+    USE_OBJECT_CACHE = True
+    # the fan-out layout of hash paths, backends read it with `_read_layout`
+    _layout = Layout()
+    # when the layout was last read, see `_reload_layout`
+    _layout_read_at = float("-inf")
 
     @abstractmethod
     def __init__(self, config: str):
         pass
 
     @abstractmethod
-    def _hash_path(self, hash_value: str, prefix: str = "") -> str:
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
         """Get the hash to path
 
         Args:
             hash_value: the hash of the object to be retrieved
             prefix: any prefix to attach before hash_value
+            layout: the fan-out layout, default to the layout of the storage
         """
         raise NotImplementedError("Should implement `_hash_path`")
 
+    def _read_paths(self, hash_values: List[str], prefix: str) -> List[str]:
+        """Get the storage paths to read hashes from
+
+        While the storage is re-laid out, hashes that are not at their path yet are
+        read from their path in the previous layout.
+
+        Args:
+            hash_values: list of hashes
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+
+        Returns:
+            The storage paths
+        """
+        paths = [self._hash_path(each, prefix=prefix) for each in hash_values]
+        previous = self._layout.previous
+        if previous is None or not paths:
+            return paths
+
+        for idx, exists in enumerate(self._have(paths)):
+            if not exists:
+                paths[idx] = self._hash_path(
+                    hash_values[idx], prefix=prefix, layout=previous
+                )
+        return paths
+
+    def _layout_path(self) -> Union[str, None]:
+        """The storage path of the layout file, None if the storage has none"""
+        return None
+
+    def _read_layout(self) -> Layout:
+        """Read the layout of the storage, the default layout if it is not recorded"""
+        path = self._layout_path()
+        if path is None:
+            return Layout()
+        try:
+            return Layout.loads(b"".join(self._read_chunks(path)).decode())
+        except FileNotFoundError:
+            return Layout()
+
+    def _write_layout(self, layout: Layout):
+        """Record the layout of the storage, and use it from now on"""
+        path = self._layout_path()
+        if path is None:
+            raise RuntimeError("The storage does not record a layout")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_path = Path(temp_dir, LAYOUT_FILE)
+            temp_path.write_text(layout.dumps())
+            self._store(storage_paths=[path], paths=[str(temp_path)], overwrite=True)
+        self._layout = layout
+
+    def _reload_layout(self, max_age: float = 0) -> bool:
+        """Read the layout again, in case another process re-lays the storage out
+
+        Args:
+            max_age: do not read if the layout was read less than `max_age` seconds
+                ago
+
+        Returns:
+            True if the layout changed
+        """
+        now = time.monotonic()
+        if now - self._layout_read_at < max_age:
+            return False
+        self._layout_read_at = now
+        if self._layout_path() is None:
+            return False
+        layout = self._read_layout()
+        if layout.dumps() == self._layout.dumps():
+            return False
+        self._layout = layout
+        return True
+
+    def _layout_storages(self) -> List["BaseStorage"]:
+        """The storages that record a layout and are re-laid out: itself by default,
+        its parts for storages made of other storages"""
+        return [self]
+
+    def _move(self, source_paths: List[str], storage_paths: List[str]):
+        """Move files inside the storage
+
+        The files are copied inside the storage provider if it can, otherwise they are
+        staged locally. The sources are deleted once copied.
+
+        Args:
+            source_paths: the paths to move
+            storage_paths: the corresponding new paths
+        """
+        if not self._copy(self, source_paths, storage_paths):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                paths = [
+                    str(Path(temp_dir, str(idx))) for idx in range(len(source_paths))
+                ]
+                self._get(storage_paths=source_paths, paths=paths)
+                self._store(storage_paths=storage_paths, paths=paths)
+        self._delete(source_paths)
+
     @abstractmethod
     def _get(
         self,
@@ -36,6 +229,7 @@ class BaseStorage(metaclass=ABCMeta):
         paths: List[str],
         progress_callback: Union[Callable, None] = None,
         n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
     ):
         """Get objects from `storage_paths` to local `paths`
 
@@ -44,24 +238,453 @@ class BaseStorage(metaclass=ABCMeta):
             paths: corresponding target local locations
             progress_callback: it is passed total_files (int) and total_bytes (int)
             n_processes: number of processes to handle getting objects
+            hash_values: the SHA-256 of each file, to verify while it is written
+                (see `_get_verified`). None to skip verification
         """
         raise NotImplementedError("Should implement `_get`")
 
+    def _read_chunks(self, storage_path: str) -> Iterator[bytes]:
+        """Stream the content of `storage_path`
+
+        Storages that verify downloads with `_get_verified` should implement this.
+
+        Args:
+            storage_path: the path in the storage
+
+        Yields:
+            The content, in order
+        """
+        raise NotImplementedError("Should implement `_read_chunks`")
+
+    def _get_verified(
+        self,
+        storage_path: str,
+        path: str,
+        hash_value: str,
+        on_bytes: Union[Callable[[int], None], None] = None,
+    ):
+        """Stream `storage_path` to `path` and verify its hash on the way
+
+        The content is hashed as it is written, so verification does not read the
+        file again. A mismatching download is quarantined and downloaded again.
+
+        Args:
+            storage_path: the path in the storage
+            path: the local file to write
+            hash_value: the expected SHA-256 of the content
+            on_bytes: called with the number of bytes just written
+
+        Raises:
+            IntegrityError: the content still mismatches after `VERIFY_RETRIES`
+        """
+        for attempt in range(VERIFY_RETRIES + 1):
+            try:
+                write_verified(
+                    path, self._read_chunks(storage_path), hash_value, on_bytes
+                )
+                return
+            except IntegrityError:
+                if attempt == VERIFY_RETRIES:
+                    raise
+
     @abstractmethod
-    def _store(self, storage_paths: List[str], paths: List[str]):
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        """Store local `paths` to `storage_paths`
+
+        Args:
+            storage_paths: the paths in the storage
+            paths: corresponding local files to store
+            overwrite: if False, the storage can skip `storage_paths` that already
+                exist. Content-addressed objects, dirs and commits never change, refs do
+        """
         raise NotImplementedError("Should implement `_store`")
 
     @abstractmethod
-    def _delete(self, storage_paths: List[str]):
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete `storage_paths` from the storage
+
+        Args:
+            storage_paths: the paths in the storage
+
+        Returns:
+            The error message of each storage path that cannot be deleted
+        """
         raise NotImplementedError("Should implement `_delete`")
 
+    def _delete_hashes(
+        self, hash_values: List[str], prefix: str, dry_run: bool = False
+    ) -> Dict[str, str]:
+        """Delete hashes, and report the errors by hash
+
+        Args:
+            hash_values: list of hashes to delete
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+            dry_run: if True, do not delete anything
+
+        Returns:
+            The error message of each hash that cannot be deleted
+        """
+        if dry_run or not hash_values:
+            return {}
+
+        targets = {self._hash_path(each, prefix=prefix): each for each in hash_values}
+        errors = self._delete(storage_paths=list(targets.keys()))
+        errors = {targets[key]: value for key, value in errors.items()}
+
+        from god.storage.manifest import append_manifest  # avoid circular import
+
+        deleted = [each for each in hash_values if each not in errors]
+        index = self.presence(prefix)
+        if index is not None:
+            index.remove(deleted)
+        append_manifest(self, prefix, removed=deleted)
+        return errors
+
+    def _store_hashes(self, paths: List[str], hash_values: List[str], prefix: str):
+        """Store hashes, and record them in the presence index and the manifest
+
+        Args:
+            paths: the local files to store
+            hash_values: the corresponding hashes
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+        """
+        from god.storage.manifest import append_manifest  # avoid circular import
+
+        # a process that has not seen a re-layout would store at the old paths
+        self._reload_layout(LAYOUT_RELOAD_INTERVAL)
+        index = self.presence(prefix)
+        targets = [self._hash_path(each, prefix=prefix) for each in hash_values]
+        self._store(storage_paths=targets, paths=paths)
+        if index is not None:
+            index.add(hash_values)
+        append_manifest(self, prefix, added=hash_values)
+
+    def _have_hashes(self, hash_values: List[str], prefix: str) -> List[bool]:
+        """Check hashes against the presence index, then ask the storage for the rest
+
+        Args:
+            hash_values: list of hashes to check
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+
+        Returns:
+            True if the hash exists, False otherwise
+        """
+        index = self.presence(prefix)
+        if index is None:
+            result = self._have(storage_paths=self._read_paths(hash_values, prefix))
+            return self._have_moved(hash_values, prefix, result)
+
+        result = index.contains(hash_values)
+        if index.complete and (
+            self.PRESENCE_EXCLUSIVE
+            or prefix in self.__dict__.get("_trusted_presence", set())
+        ):
+            return result
+
+        unknown = [idx for idx, exists in enumerate(result) if not exists]
+        if unknown:
+            exists = self._have(
+                storage_paths=self._read_paths(
+                    [hash_values[idx] for idx in unknown], prefix
+                )
+            )
+            for idx, each in zip(unknown, exists):
+                result[idx] = each
+            result = self._have_moved(hash_values, prefix, result)
+            index.add([hash_values[idx] for idx in unknown if result[idx]])
+        return result
+
+    def _have_moved(
+        self, hash_values: List[str], prefix: str, result: List[bool]
+    ) -> List[bool]:
+        """Check the missing hashes again if the layout changed since it was read"""
+        missing = [idx for idx, exists in enumerate(result) if not exists]
+        if not missing or not self._reload_layout(LAYOUT_RELOAD_INTERVAL):
+            return result
+        exists = self._have(
+            storage_paths=self._read_paths(
+                [hash_values[idx] for idx in missing], prefix
+            )
+        )
+        result = list(result)
+        for idx, each in zip(missing, exists):
+            result[idx] = each
+        return result
+
+    def _copy(
+        self, source: "BaseStorage", source_paths: List[str], storage_paths: List[str]
+    ) -> bool:
+        """Copy files from `source` inside the storage provider, without downloading
+
+        Args:
+            source: the storage to copy from
+            source_paths: the paths in `source`
+            storage_paths: the corresponding paths in this storage
+
+        Returns:
+            True if copied, False if the storage cannot copy from `source`
+        """
+        return False
+
+    def copy_hashes(
+        self, source: "BaseStorage", hash_values: List[str], prefix: str
+    ) -> bool:
+        """Copy hashes from `source` inside the storage provider, if supported
+
+        Args:
+            source: the storage to copy from
+            hash_values: list of hashes to copy
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+
+        Returns:
+            True if copied, False if the storage cannot copy from `source`
+        """
+        index = self.presence(prefix)
+        copied = self._copy(
+            source,
+            source_paths=source._read_paths(hash_values, prefix),
+            storage_paths=[
+                self._hash_path(each, prefix=prefix) for each in hash_values
+            ],
+        )
+        if copied:
+            from god.storage.manifest import append_manifest  # avoid circular import
+
+            if index is not None:
+                index.add(hash_values)
+            append_manifest(self, prefix, added=hash_values)
+        return copied
+
+    def _presence_dir(self) -> Union[str, None]:
+        """The directory of presence index, None if the storage does not keep one"""
+        return None
+
+    def presence(self, prefix: str) -> Union[PresenceIndex, None]:
+        """Get the presence index of a kind of hashes
+
+        Args:
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+
+        Returns:
+            The presence index, or None if the storage does not keep one
+        """
+        indices = self.__dict__.setdefault("_presence_indices", {})
+        if prefix in indices:
+            return indices[prefix]
+
+        index_dir = self._presence_dir()
+        index = None if index_dir is None else PresenceIndex(index_dir, prefix)
+        if (
+            index is not None
+            and self.PRESENCE_EXCLUSIVE
+            and not index.exists()
+            and next(self._scan(self._hash_path("", prefix=prefix)), None) is None
+        ):
+            # nothing is stored yet, so the empty index is complete
+            index.rebuild([])
+        indices[prefix] = index
+        return index
+
+    def trust_presence(self, prefix: str):
+        """Let the complete presence index of `prefix` answer that hashes are absent
+
+        Call this after the index is synced with a complete manifest of the storage.
+
+        Args:
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+        """
+        self.__dict__.setdefault("_trusted_presence", set()).add(prefix)
+
+    def rebuild_index(self, prefix: str) -> int:
+        """Rebuild the presence index of a kind of hashes from storage listing
+
+        Args:
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+
+        Returns:
+            The number of hashes in the index
+        """
+        index = self.presence(prefix)
+        if index is None:
+            return 0
+
+        hash_values = list(self._list(self._hash_path("", prefix=prefix)))
+        index.rebuild(hash_values)
+        return len(hash_values)
+
     @abstractmethod
     def _have(self, storage_paths: List[str]) -> List[bool]:
         raise NotImplementedError("Should implement `_have`")
 
     @abstractmethod
-    def _list(self, storage_prefix: str) -> List[str]:
-        raise NotImplementedError("Should implement `_list`")
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over all files inside a shard of `storage_prefix`
+
+        Args:
+            storage_prefix: the storage path to scan
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
+
+        Yields:
+            The file path relative to `storage_prefix`, in posix format
+            The file size in bytes
+            The file last modified time, in seconds since epoch
+        """
+        raise NotImplementedError("Should implement `_scan`")
+
+    def _scan_hashes(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over the hash files inside a shard of `storage_prefix`
+
+        Hash paths never contain ".", so the temporary files (partial downloads,
+        moves in progress) that a storage may hold next to them are skipped.
+
+        Args:
+            storage_prefix: the storage path to scan, laid out by hash prefix
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
+
+        Yields:
+            Same as `_scan`
+        """
+        for name, size, mtime in self._scan(storage_prefix, shard):
+            if "." not in name:
+                yield name, size, mtime
+
+    def _shards(self) -> List[str]:
+        """The top-level hash prefix directories, which can be listed independently"""
+        return self._layout.shards()
+
+    def _scan_shards(
+        self, storage_prefix: str, shards: List[str]
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Scan the hash files of shards in parallel, stream result shard by shard
+
+        At most 2 * N_LIST_THREADS shards are held in memory at a time.
+
+        Args:
+            storage_prefix: the storage path to scan, laid out by hash prefix
+            shards: the sub-directories of `storage_prefix` to scan
+
+        Yields:
+            Same as `_scan_hashes`
+        """
+
+        def scan(shard):
+            return list(self._scan_hashes(storage_prefix, shard))
+
+        jobs = deque()
+        with ThreadPoolExecutor(max_workers=N_LIST_THREADS) as executor:
+            try:
+                for shard in shards:
+                    jobs.append(executor.submit(scan, shard))
+                    if len(jobs) >= 2 * N_LIST_THREADS:
+                        yield from jobs.popleft().result()
+                while jobs:
+                    yield from jobs.popleft().result()
+            finally:
+                for job in jobs:
+                    job.cancel()
+
+    def _list(self, storage_prefix: str, sharded: bool = True) -> Iterator[str]:
+        """Iterate over the files inside `storage_prefix`
+
+        Args:
+            storage_prefix: the storage path to list
+            sharded: if True, `storage_prefix` is laid out by hash prefix, the shards
+                are listed in parallel and the hash values are yielded
+
+        Yields:
+            The hash values if `sharded`, otherwise the relative file paths
+        """
+        if not sharded:
+            for name, _, _ in self._scan(storage_prefix):
+                yield name
+            return
+
+        for name, _, _ in self._scan_shards(storage_prefix, self._shards()):
+            yield name.replace("/", "")
+
+    def _local_path(self, storage_path: str) -> Union[str, None]:
+        """Get the path in local filesystem that holds `storage_path`
+
+        Storages that keep their content in local filesystem should override this, so
+        that other storages can read from and write into it directly.
+
+        Args:
+            storage_path: the path in the storage
+
+        Returns:
+            The local path, or None if the storage is not in local filesystem
+        """
+        return None
+
+    def local_paths(
+        self, hash_values: List[str], prefix: str, read: bool = False
+    ) -> Union[List[str], None]:
+        """Get the local filesystem paths of hashes
+
+        Args:
+            hash_values: list of hashes
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+            read: if True, get the paths to read the hashes from (see `_read_paths`),
+                otherwise the paths to write them to
+
+        Returns:
+            The local paths, or None if the storage is not in local filesystem
+        """
+        if self._local_path(self._hash_path("", prefix=prefix)) is None:
+            return None
+
+        if read:
+            storage_paths = self._read_paths(hash_values, prefix)
+        else:
+            storage_paths = [
+                self._hash_path(each, prefix=prefix) for each in hash_values
+            ]
+        return [self._local_path(each) for each in storage_paths]  # type: ignore
+
+    def _object_cache(self) -> Union[ObjectCache, None]:
+        """The user object cache, None if the storage does not read through it"""
+        if not self.USE_OBJECT_CACHE:
+            return None
+        return get_object_cache()
+
+    def _get_hashes(
+        self,
+        hash_values: List[str],
+        paths: List[str],
+        prefix: str,
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        verify: bool = True,
+    ):
+        """Get hashes from their read paths, looking again if the layout changed
+
+        Args:
+            hash_values: the hashes to get
+            paths: the corresponding target locations
+            prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: number of processes to get the files
+            verify: whether the content hashes to the hash, False for commits
+        """
+        for attempt in range(2):
+            try:
+                return self._get(
+                    storage_paths=self._read_paths(hash_values, prefix),
+                    paths=paths,
+                    progress_callback=progress_callback,
+                    n_processes=n_processes,
+                    hash_values=hash_values if verify else None,
+                )
+            except FileNotFoundError:
+                # another process may have re-laid the storage out
+                if attempt or not self._reload_layout():
+                    raise
 
     ### objects
     def get_objects(
@@ -71,7 +694,10 @@ class BaseStorage(metaclass=ABCMeta):
         progress_callback: Union[Callable, None] = None,
         n_processes: Union[int, None] = None,
     ):
-        """Get the objects to a local file
+        """Get the objects to a local file, verifying their hashes as they are written
+
+        If the user object cache is turned on, objects in the cache are not
+        downloaded, and downloaded objects are added to the cache.
 
         Args:
             hash_values: list of object hashes we wish to get
@@ -79,15 +705,23 @@ class BaseStorage(metaclass=ABCMeta):
             progress_callback: it is passed total_files (int) and total_bytes (int)
             n_processes: number of processes to handle getting objects
         """
-        sources = [
-            self._hash_path(each, prefix=self.OBJECTS_PREFIX) for each in hash_values
-        ]
-        return self._get(
-            storage_paths=sources,
-            paths=paths,
+        cache = self._object_cache()
+        if cache is not None:
+            hits = cache.read(hash_values, paths)
+            hash_values = [each for each, hit in zip(hash_values, hits) if not hit]
+            paths = [each for each, hit in zip(paths, hits) if not hit]
+            if not hash_values:
+                return
+
+        self._get_hashes(
+            hash_values,
+            paths,
+            self.OBJECTS_PREFIX,
             progress_callback=progress_callback,
             n_processes=n_processes,
         )
+        if cache is not None:
+            cache.write(hash_values, paths)
 
     def store_objects(self, paths: List[str], hash_values: List[str]):
         """Store local object to storage
@@ -96,21 +730,23 @@ class BaseStorage(metaclass=ABCMeta):
             paths: corresponding target locations that store the objects
             hash_values: list of object hashes we wish to store
         """
-        targets = [
-            self._hash_path(each, prefix=self.OBJECTS_PREFIX) for each in hash_values
-        ]
-        return self._store(storage_paths=targets, paths=paths)
+        return self._store_hashes(paths, hash_values, prefix=self.OBJECTS_PREFIX)
 
-    def delete_objects(self, hash_values: List[str]):
+    def delete_objects(
+        self, hash_values: List[str], dry_run: bool = False
+    ) -> Dict[str, str]:
         """Delete the objects with specified hash values from storage
 
         Args:
             hash_values: list of object hashes we wish to delete
+            dry_run: if True, do not delete anything
+
+        Returns:
+            The error message of each hash that cannot be deleted
         """
-        targets = [
-            self._hash_path(each, prefix=self.OBJECTS_PREFIX) for each in hash_values
-        ]
-        return self._delete(storage_paths=targets)
+        return self._delete_hashes(
+            hash_values, prefix=self.OBJECTS_PREFIX, dry_run=dry_run
+        )
 
     def have_objects(self, hash_values: List[str]) -> List[bool]:
         """Check if objects with specified hash values exist
@@ -118,12 +754,9 @@ class BaseStorage(metaclass=ABCMeta):
         Args:
             hash_values: list of object hashes we wish to check
         """
-        targets = [
-            self._hash_path(each, prefix=self.OBJECTS_PREFIX) for each in hash_values
-        ]
-        return self._have(storage_paths=targets)
+        return self._have_hashes(hash_values, prefix=self.OBJECTS_PREFIX)
 
-    def list_objects(self) -> List[str]:
+    def list_objects(self) -> Iterator[str]:
         """List objects, in the path format"""
         return self._list(
             storage_prefix=self._hash_path("", prefix=self.OBJECTS_PREFIX)
@@ -137,18 +770,16 @@ class BaseStorage(metaclass=ABCMeta):
         progress_callback: Union[Callable, None] = None,
         n_processes: Union[int, None] = None,
     ):
-        """Get the directory to local
+        """Get the directory to local, verifying their hashes as they are written
 
         Args:
             hash_values: list of directory hashes we wish to get
             paths: corresponding target locations that store the directory files
         """
-        sources = [
-            self._hash_path(each, prefix=self.DIRS_PREFIX) for each in hash_values
-        ]
-        return self._get(
-            storage_paths=sources,
-            paths=paths,
+        return self._get_hashes(
+            hash_values,
+            paths,
+            self.DIRS_PREFIX,
             progress_callback=progress_callback,
             n_processes=n_processes,
         )
@@ -160,21 +791,23 @@ class BaseStorage(metaclass=ABCMeta):
             paths: corresponding target locations that store the directores
             hash_values: list of directory hashes we wish to store
         """
-        targets = [
-            self._hash_path(each, prefix=self.DIRS_PREFIX) for each in hash_values
-        ]
-        return self._store(storage_paths=targets, paths=paths)
+        return self._store_hashes(paths, hash_values, prefix=self.DIRS_PREFIX)
 
-    def delete_dirs(self, hash_values: List[str]):
+    def delete_dirs(
+        self, hash_values: List[str], dry_run: bool = False
+    ) -> Dict[str, str]:
         """Delete the directories with specified hash values from storage
 
         Args:
             hash_values: list of directory hashes we wish to delete
+            dry_run: if True, do not delete anything
+
+        Returns:
+            The error message of each hash that cannot be deleted
         """
-        targets = [
-            self._hash_path(each, prefix=self.DIRS_PREFIX) for each in hash_values
-        ]
-        return self._delete(storage_paths=targets)
+        return self._delete_hashes(
+            hash_values, prefix=self.DIRS_PREFIX, dry_run=dry_run
+        )
 
     def have_dirs(self, hash_values: List[str]) -> List[bool]:
         """Check if directories with specified hash values exist
@@ -182,12 +815,9 @@ class BaseStorage(metaclass=ABCMeta):
         Args:
             hash_values: list of directory hashes we wish to check
         """
-        targets = [
-            self._hash_path(each, prefix=self.DIRS_PREFIX) for each in hash_values
-        ]
-        return self._have(storage_paths=targets)
+        return self._have_hashes(hash_values, prefix=self.DIRS_PREFIX)
 
-    def list_dirs(self) -> List[str]:
+    def list_dirs(self) -> Iterator[str]:
         """List directories, in the path format"""
         return self._list(storage_prefix=self._hash_path("", prefix=self.DIRS_PREFIX))
 
@@ -205,14 +835,13 @@ class BaseStorage(metaclass=ABCMeta):
             hash_values: list of commit hashes we wish to get
             paths: corresponding target locations that store the commit files
         """
-        sources = [
-            self._hash_path(each, prefix=self.COMMITS_PREFIX) for each in hash_values
-        ]
-        return self._get(
-            storage_paths=sources,
-            paths=paths,
+        return self._get_hashes(
+            hash_values,
+            paths,
+            self.COMMITS_PREFIX,
             progress_callback=progress_callback,
             n_processes=n_processes,
+            verify=False,
         )
 
     def store_commits(self, paths: List[str], hash_values: List[str]):
@@ -222,21 +851,23 @@ class BaseStorage(metaclass=ABCMeta):
             paths: corresponding target locations that store the commits
             hash_values: list of commit hashes we wish to store
         """
-        targets = [
-            self._hash_path(each, prefix=self.COMMITS_PREFIX) for each in hash_values
-        ]
-        return self._store(storage_paths=targets, paths=paths)
+        return self._store_hashes(paths, hash_values, prefix=self.COMMITS_PREFIX)
 
-    def delete_commits(self, hash_values: List[str]):
+    def delete_commits(
+        self, hash_values: List[str], dry_run: bool = False
+    ) -> Dict[str, str]:
         """Delete the commits with specified hash values from storage
 
         Args:
             hash_values: list of commit hashes we wish to delete
+            dry_run: if True, do not delete anything
+
+        Returns:
+            The error message of each hash that cannot be deleted
         """
-        targets = [
-            self._hash_path(each, prefix=self.COMMITS_PREFIX) for each in hash_values
-        ]
-        return self._delete(storage_paths=targets)
+        return self._delete_hashes(
+            hash_values, prefix=self.COMMITS_PREFIX, dry_run=dry_run
+        )
 
     def have_commits(self, hash_values: List[str]) -> List[bool]:
         """Check if commits with specified hash values exist
@@ -244,12 +875,9 @@ class BaseStorage(metaclass=ABCMeta):
         Args:
             hash_values: list of commit hashes we wish to check
         """
-        targets = [
-            self._hash_path(each, prefix=self.COMMITS_PREFIX) for each in hash_values
-        ]
-        return self._have(storage_paths=targets)
+        return self._have_hashes(hash_values, prefix=self.COMMITS_PREFIX)
 
-    def list_commits(self) -> List[str]:
+    def list_commits(self) -> Iterator[str]:
         """List commits, in the path format"""
         return self._list(
             storage_prefix=self._hash_path("", prefix=self.COMMITS_PREFIX)
@@ -287,7 +915,9 @@ class RemoteRefsMixin(metaclass=ABCMeta):
         targets = [
             self._ref_path(each, prefix=self.REMOTE_REFS_PREFIX) for each in refs
         ]
-        return self._store(storage_paths=targets, paths=paths)  # type: ignore
+        return self._store(  # type: ignore
+            storage_paths=targets, paths=paths, overwrite=True
+        )
 
     def delete_refs(self, refs: List[str]):
         """Delete the refs with specified name
@@ -311,8 +941,9 @@ class RemoteRefsMixin(metaclass=ABCMeta):
         ]
         return self._have(storage_paths=targets)  # type: ignore
 
-    def list_refs(self) -> List[str]:
+    def list_refs(self) -> Iterator[str]:
         """List refs, in the path format"""
         return self._list(  # type: ignore
-            storage_prefix=self._ref_path("", prefix=self.REMOTE_REFS_PREFIX)
+            storage_prefix=self._ref_path("", prefix=self.REMOTE_REFS_PREFIX),
+            sharded=False,
         )
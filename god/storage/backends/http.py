@@ -0,0 +1,434 @@
+"""Read-only storage served over HTTP(S), e.g. by a CDN or a static file server
+
+Configured as `http://host/path` or `https://host/path`: the URL of the root of a
+storage laid out like `LocalStorage`, e.g. `python -m http.server` serving it.
+
+    - Connections are kept alive and reused by all threads of the storage.
+    - Files are downloaded in parallel by the transfer engine. Files larger than
+        RANGE_SIZE are requested in ranges, RANGE_CONCURRENCY at a time, when the
+        server supports HTTP Range, otherwise in 1 request.
+    - Existence is checked with HEAD requests.
+    - Listing reads the directory index pages that servers like `http.server`,
+        nginx `autoindex` or Apache generate. Servers without them cannot list.
+    - Writes raise `OperationNotPermitted`.
+"""
+import http.client
+import os
+import posixpath
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+from urllib.parse import quote, unquote, urlsplit
+
+import god.storage.constants as c
+from god.storage.backends.base import (
+    CHUNK_SIZE,
+    N_LIST_THREADS,
+    BaseStorage,
+    RemoteRefsMixin,
+    partial_path,
+)
+from god.storage.engine import PRIORITIES, PRIORITY_OBJECTS, get_engine
+from god.storage.layout import LAYOUT_FILE, Layout
+from god.utils.exceptions import OperationNotPermitted
+
+# maximum number of idle connections kept alive
+N_CONNECTIONS = 32
+# seconds to wait for the server
+TIMEOUT = 60
+# files larger than RANGE_SIZE are requested in ranges of that size in parallel
+RANGE_SIZE = 8 * 1024 * 1024
+# number of ranges of a file requested at a time
+RANGE_CONCURRENCY = 4
+# status codes of requests that the server throttles
+_THROTTLE_STATUSES = (429, 503)
+# errors of a kept-alive connection that the server closed in the meantime
+_STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class HTTPStatusError(Exception):
+    """The server answers with an unexpected status"""
+
+    def __init__(self, status: int, method: str, path: str):
+        super().__init__(f"{method} {path} answered with status {status}")
+        self.status = status
+
+
+def _is_throttle(e: Exception) -> bool:
+    """Whether the error means that the server asks to slow down"""
+    return isinstance(e, HTTPStatusError) and e.status in _THROTTLE_STATUSES
+
+
+def parse_config(config: str) -> Tuple[str, str, str]:
+    """Parse http(s)://host[:port]/[path]
+
+    Returns:
+        - the scheme, "http" or "https"
+        - the host and port
+        - the absolute path of the storage root
+    """
+    parts = urlsplit(config)
+    if parts.scheme not in ("http", "https") or not parts.netloc:
+        raise ValueError(f'Expect "http://" or "https://" but receive {config} instead')
+    return parts.scheme, parts.netloc, "/" + parts.path.strip("/")
+
+
+class HTTPConnectionPool:
+    """Kept-alive connections to 1 server, shared by all threads
+
+    A connection is used by 1 request at a time. Connections are created when none
+    is idle, and at most `max_connections` idle connections are kept.
+
+    Args:
+        scheme: "http" or "https"
+        netloc: the host and port of the server
+        max_connections: the maximum number of idle connections kept
+    """
+
+    def __init__(self, scheme: str, netloc: str, max_connections: int = N_CONNECTIONS):
+        self._cls = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self._netloc = netloc
+        self._idle: queue.LifoQueue = queue.LifoQueue(maxsize=max_connections)
+
+    def _checkout(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """Get an idle connection, or a new one. Also tell if it is reused"""
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._cls(self._netloc, timeout=TIMEOUT), False
+
+    def _checkin(self, conn: http.client.HTTPConnection):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def request(
+        self,
+        method: str,
+        path: str,
+        headers: Union[Dict[str, str], None] = None,
+        body: Union[bytes, Callable[[], Iterable[bytes]], None] = None,
+    ) -> Iterator[http.client.HTTPResponse]:
+        """Send a request, and give its response
+
+        The connection is kept alive for other requests once the response is read.
+        A kept-alive connection that the server closed is replaced once.
+
+        Args:
+            method: the HTTP method
+            path: the URL path, not quoted
+            headers: the request headers
+            body: the request body, or a function that gives the body in chunks, so
+                that it can be sent again
+
+        Yields:
+            The response
+        """
+        for attempt in range(2):
+            conn, reused = self._checkout()
+            try:
+                conn.request(
+                    method,
+                    quote(path),
+                    body=body() if callable(body) else body,
+                    headers=headers or {},
+                )
+                response = conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            break
+
+        try:
+            yield response
+            response.read()  # drain what the caller did not read
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+
+
+class _IndexParser(HTMLParser):
+    """Collect the links of a directory index page"""
+
+    def __init__(self):
+        super().__init__()
+        self.links: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        href = dict(attrs).get("href")
+        if href and not href.startswith(("?", "#", "/", "..")) and "://" not in href:
+            self.links.append(unquote(href))
+
+
+class HTTPStorage(BaseStorage, RemoteRefsMixin):
+    """Read objects from a storage served over HTTP"""
+
+    def __init__(self, config: str):
+        scheme, self._netloc, self._path = parse_config(config)
+        self._pool = HTTPConnectionPool(scheme, self._netloc)
+        self._engine = get_engine()
+        self._layout = self._read_layout()
+
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
+        """From hash value, get the URL path"""
+        layout = layout or self._layout
+        return posixpath.join(self._path, prefix, *layout.split(hash_value))
+
+    def _layout_path(self) -> str:
+        return posixpath.join(self._path, LAYOUT_FILE)
+
+    def _ref_path(self, ref: str, prefix: str = "") -> str:
+        """Construct the URL path to ref file
+
+        Args:
+            ref: the name of the ref
+            prefix: the object prefix
+        """
+        return posixpath.join(self._path, prefix, ref)
+
+    def _presence_dir(self) -> str:
+        """Keep the presence index in user cache, it only records known hashes"""
+        return str(
+            Path(
+                c.DIR_USER_CACHE,
+                c.DIR_PRESENCE,
+                self._netloc.replace(":", "_"),
+                self._path.lstrip("/"),
+            )
+        )
+
+    def _priority(self, storage_paths: List[str]) -> int:
+        """The transfer priority class of a batch of paths, from its first path"""
+        if not storage_paths:
+            return PRIORITY_OBJECTS
+        kind = posixpath.relpath(storage_paths[0], self._path).split("/")[0]
+        return PRIORITIES.get(kind, PRIORITY_OBJECTS)
+
+    def _get(
+        self,
+        storage_paths: List[str],
+        paths: List[str],
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
+    ):
+        """Download the files in parallel
+
+        Args:
+            storage_paths: the URL paths
+            paths: the file paths to copy to
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: ignored, the transfer engine adapts the concurrency
+            hash_values: the SHA-256 of each file to verify, None to skip verification
+        """
+        if len(storage_paths) != len(paths):
+            raise AttributeError(f"Inconsistent {len(storage_paths)} , {len(paths)}")
+
+        def _download(task, on_bytes):
+            storage_path, path, hash_value = task
+            if hash_value is not None:
+                self._get_verified(storage_path, path, hash_value, on_bytes)
+                return
+            temp_path = partial_path(path)
+            with open(temp_path, "wb") as fo:
+                for chunk in self._read_chunks(storage_path):
+                    fo.write(chunk)
+                    on_bytes(len(chunk))
+            os.replace(temp_path, path)
+
+        self._engine.map(
+            _download,
+            list(zip(storage_paths, paths, hash_values or [None] * len(paths))),
+            priority=self._priority(storage_paths),
+            progress_callback=progress_callback,
+            is_throttle=_is_throttle,
+        )
+
+    def _read_range(self, storage_path: str, start: int, end: int) -> bytes:
+        """Read the bytes from `start` to `end` (inclusive) of a file"""
+        headers = {"Range": f"bytes={start}-{end}"}
+        with self._pool.request("GET", storage_path, headers) as response:
+            if response.status != 206:
+                raise HTTPStatusError(response.status, "GET", storage_path)
+            return response.read()
+
+    def _read_chunks(self, storage_path: str) -> Iterator[bytes]:
+        """Stream the content of `storage_path`
+
+        The first range also tells the file size. The rest is requested in ranges of
+        RANGE_SIZE, RANGE_CONCURRENCY at a time, and yielded in order. A server that
+        does not support ranges sends the whole file instead.
+        """
+        headers = {"Range": f"bytes=0-{RANGE_SIZE - 1}"}
+        with self._pool.request("GET", storage_path, headers) as response:
+            if response.status == 404:
+                raise FileNotFoundError(storage_path)
+            if response.status == 416:
+                return  # empty file
+            if response.status not in (200, 206):
+                raise HTTPStatusError(response.status, "GET", storage_path)
+            size = None
+            if response.status == 206:
+                size = int(response.getheader("Content-Range").split("/")[-1])
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        if size is None or size <= RANGE_SIZE:
+            return
+
+        def _get_range(start):
+            return self._read_range(
+                storage_path, start, min(start + RANGE_SIZE, size) - 1
+            )
+
+        starts = iter(range(RANGE_SIZE, size, RANGE_SIZE))
+        with ThreadPoolExecutor(max_workers=RANGE_CONCURRENCY) as executor:
+            ranges = deque(
+                executor.submit(_get_range, start)
+                for _, start in zip(range(RANGE_CONCURRENCY), starts)
+            )
+            try:
+                while ranges:
+                    data = ranges.popleft().result()
+                    start = next(starts, None)
+                    if start is not None:
+                        ranges.append(executor.submit(_get_range, start))
+                    yield data
+            finally:
+                for each in ranges:
+                    each.cancel()
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        raise OperationNotPermitted(f"http://{self._netloc}{self._path} is read-only")
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        raise OperationNotPermitted(f"http://{self._netloc}{self._path} is read-only")
+
+    def _head(self, storage_path: str) -> Union[http.client.HTTPResponse, None]:
+        """Get the response to a HEAD request, None if the file does not exist"""
+        with self._pool.request("HEAD", storage_path) as response:
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise HTTPStatusError(response.status, "HEAD", storage_path)
+            return response
+
+    def _have(self, storage_paths: List[str]) -> List[bool]:
+        """Check whether the files exist, with HEAD requests in parallel
+
+        Args:
+            storage_paths: the URL paths
+
+        Returns:
+            True if the file exists, False otherwise
+        """
+        return self._engine.map(
+            lambda storage_path, on_bytes: self._head(storage_path) is not None,
+            storage_paths,
+            priority=self._priority(storage_paths),
+            is_throttle=_is_throttle,
+        )
+
+    def _walk(self, storage_prefix: str, shard: str = "") -> Iterator[str]:
+        """Iterate over the files of the directory index pages inside a shard
+
+        Args:
+            storage_prefix: the URL path to walk
+            shard: the sub-directory of `storage_prefix` to walk, "" to walk all
+
+        Yields:
+            The file path relative to `storage_prefix`
+        """
+        directories = [shard.strip("/")] if shard else [""]
+        while directories:
+            directory = directories.pop()
+            path = posixpath.join(storage_prefix, directory, "")
+            with self._pool.request("GET", path) as response:
+                if response.status == 404:
+                    continue
+                if response.status != 200:
+                    raise HTTPStatusError(response.status, "GET", path)
+                parser = _IndexParser()
+                parser.feed(response.read().decode("utf-8", errors="replace"))
+            for link in parser.links:
+                name = posixpath.join(directory, link.rstrip("/"))
+                if link.endswith("/"):
+                    directories.append(name)
+                else:
+                    yield name
+
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over the files inside a shard, with their size and time from HEAD
+
+        Args:
+            storage_prefix: the URL path to scan
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
+
+        Yields:
+            The file path relative to `storage_prefix`
+            The file size in bytes
+            The file last modified time, in seconds since epoch
+        """
+        for name in self._walk(storage_prefix, shard):
+            response = self._head(posixpath.join(storage_prefix, name))
+            if response is None:
+                continue
+            modified = response.getheader("Last-Modified")
+            yield (
+                name,
+                int(response.getheader("Content-Length", 0)),
+                parsedate_to_datetime(modified).timestamp() if modified else 0.0,
+            )
+
+    def _list(self, storage_prefix: str, sharded: bool = True) -> Iterator[str]:
+        """Iterate over the files inside `storage_prefix`, without HEAD requests
+
+        Args:
+            storage_prefix: the URL path to list
+            sharded: if True, `storage_prefix` is laid out by hash prefix, the shards
+                are listed in parallel and the hash values are yielded
+
+        Yields:
+            The hash values if `sharded`, otherwise the relative file paths
+        """
+        if not sharded:
+            yield from self._walk(storage_prefix)
+            return
+
+        def walk(shard):
+            return list(self._walk(storage_prefix, shard))
+
+        with ThreadPoolExecutor(max_workers=N_LIST_THREADS) as executor:
+            for names in executor.map(walk, self._shards()):
+                for name in names:
+                    yield name.replace("/", "")
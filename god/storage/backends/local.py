@@ -1,11 +1,12 @@
+import os
 import shutil
 from pathlib import Path
-from typing import Callable, List, Union
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 
+import god.storage.constants as c
 from god.core.common import get_base_dir
-from god.storage.backends.base import BaseStorage
-
-DEFAULT_DIR_LEVEL = 2
+from god.storage.backends.base import CHUNK_SIZE, BaseStorage, partial_path
+from god.storage.layout import LAYOUT_FILE, Layout
 
 
 def parse_config(config: str) -> Path:
@@ -24,25 +25,48 @@ def parse_config(config: str) -> Path:
     return path.resolve()
 
 
+def _copy_atomic(source: str, target: str):
+    """Copy `source` to the partial path of `target`, then rename it into place"""
+    temp_path = partial_path(target)
+    try:
+        shutil.copy(source, temp_path)
+        os.replace(temp_path, target)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
 class LocalStorage(BaseStorage):
     """Store objects locally"""
 
+    PRESENCE_EXCLUSIVE = True
+    # the objects are on local disk already
+    USE_OBJECT_CACHE = False
+
     def __init__(self, config: str):
         # TODO: decide the format for storage config
         # TODO: might only allow relative path (to avoid overwrite hacking)
         self._base_path = parse_config(config)
-        self._dir_levels = DEFAULT_DIR_LEVEL
+        self._layout = self._read_layout()
 
-    def _hash_path(self, hash_value: str, prefix: str = "") -> str:
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
         """From hash value, get relative hash path"""
-        components = [
-            hash_value[idx * 2 : (idx + 1) * 2] for idx in range(self._dir_levels)
-        ]
-        return str(
-            Path(
-                self._base_path, prefix, *components, hash_value[self._dir_levels * 2 :]
-            )
-        )
+        layout = layout or self._layout
+        return str(Path(self._base_path, prefix, *layout.split(hash_value)))
+
+    def _layout_path(self) -> str:
+        return str(Path(self._base_path, LAYOUT_FILE))
+
+    def _presence_dir(self) -> str:
+        """Keep the presence index inside the storage, next to the hashes"""
+        return str(Path(self._base_path, c.DIR_PRESENCE))
+
+    def _local_path(self, storage_path: str) -> str:
+        """Local storage paths are already local filesystem paths"""
+        return storage_path
 
     def _get(
         self,
@@ -50,6 +74,7 @@ class LocalStorage(BaseStorage):
         paths: List[str],
         progress_callback: Union[Callable, None] = None,
         n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
     ):
         """Get the file and store in file_path
 
@@ -60,6 +85,7 @@ class LocalStorage(BaseStorage):
             n_processes: number of processes to handle getting objects. Ignore
                 `n_processes` as copying multiple files at once within local computer
                 can be slower than copying files sequentially (HDD disk seek).
+            hash_values: the SHA-256 of each file to verify, None to skip verification
         """
         created = set()
         for idx, (storage_path, path) in enumerate(zip(storage_paths, paths)):
@@ -67,35 +93,73 @@ class LocalStorage(BaseStorage):
             if parent not in created:
                 parent.mkdir(parents=True, exist_ok=True)
                 created.add(parent)
-            shutil.copy(storage_path, path)
+            if hash_values is not None:
+                self._get_verified(storage_path, path, hash_values[idx])
+            else:
+                _copy_atomic(storage_path, path)
             if progress_callback:
                 progress_callback(total_files=idx + 1, total_bytes=0)
 
-    def _store(self, storage_paths: List[str], paths: List[str]):
+    def _read_chunks(self, storage_path: str) -> Iterator[bytes]:
+        """Stream the content of `storage_path`"""
+        with open(storage_path, "rb") as fi:
+            while True:
+                chunk = fi.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
         """Store a file with a specific hash value
 
+        Each file is copied to its partial path then renamed, so an interrupted store
+        never leaves a truncated file at the storage path.
+
         Args:
             storage_paths: the path from storage
             paths: the file path to send to storage
+            overwrite: if False, skip storage paths that already exist
         """
         for storage_path, path in zip(storage_paths, paths):
-            storage_path = Path(storage_path)
-            if storage_path.exists():
+            if not overwrite and os.path.exists(storage_path):
                 continue
 
-            storage_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy(path, storage_path)
-
-    def _delete(self, storage_paths: List[str]):
+            Path(storage_path).parent.mkdir(parents=True, exist_ok=True)
+            _copy_atomic(path, storage_path)
+
+    def _move(self, source_paths: List[str], storage_paths: List[str]):
+        """Rename files inside the storage, removing the directories left empty"""
+        for source_path, storage_path in zip(source_paths, storage_paths):
+            Path(storage_path).parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source_path, storage_path)
+            parent = Path(source_path).parent
+            while parent != self._base_path and self._base_path in parent.parents:
+                try:
+                    parent.rmdir()
+                except OSError:  # not empty
+                    break
+                parent = parent.parent
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
         """Delete object
 
         Args:
             storage_paths: the location of object to delete
+
+        Returns:
+            The error message of each storage path that cannot be deleted
         """
+        errors = {}
         for storage_path in storage_paths:
-            storage_path = Path(storage_path)
-            if storage_path.exists():
-                storage_path.unlink()
+            try:
+                Path(storage_path).unlink()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                errors[storage_path] = str(e)
+        return errors
 
     def _have(self, storage_paths: List[str]) -> List[bool]:
         """Check whether a file with specific location exists in the storage
@@ -111,13 +175,35 @@ class LocalStorage(BaseStorage):
             result.append(Path(storage_path).exists())
         return result
 
-    def _list(self, storage_prefix: str) -> List[str]:
-        """Return all hashes and location inside the object storage"""
-        path = Path(storage_prefix).resolve()
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over all files inside a shard of `storage_prefix`
 
-        result = []
-        for item in path.glob("**/????*"):
-            if item.is_file:
-                result.append(str(item.relative_to(path)).replace("/", ""))
+        Args:
+            storage_prefix: the storage path to scan
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
 
-        return result
+        Yields:
+            The file path relative to `storage_prefix`, in posix format
+            The file size in bytes
+            The file last modified time, in seconds since epoch
+        """
+        base = str(Path(storage_prefix).resolve())
+        stack = [os.path.join(base, shard) if shard else base]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        yield (
+                            Path(os.path.relpath(entry.path, base)).as_posix(),
+                            stat.st_size,
+                            stat.st_mtime,
+                        )
@@ -1,116 +1,169 @@
+import math
+import os
 import posixpath
 import threading
+from collections import OrderedDict, defaultdict, deque
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from multiprocessing import Pool, Process, Queue, cpu_count
 from pathlib import Path
-from typing import Callable, List, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.errorfactory import ClientError
 from tqdm import tqdm
 
-from god.storage.backends.base import BaseStorage, RemoteRefsMixin
-
-DEFAULT_DIR_LEVEL = 2
+import god.storage.constants as c
+from god.storage.backends.base import (
+    CHUNK_SIZE,
+    BaseStorage,
+    RemoteRefsMixin,
+    partial_path,
+)
+from god.storage.engine import PRIORITIES, PRIORITY_OBJECTS, get_engine
+from god.storage.layout import LAYOUT_FILE, Layout
+
+# number of threads to upload objects
+N_THREADS = 32
+# multipart upload for objects larger than MULTIPART_SIZE, by parts of that size,
+# an interrupted multipart upload is resumed from its uploaded parts
+MULTIPART_SIZE = 64 * 1024 * 1024
+# number of threads to upload parts of a multipart upload, and to download ranges
+MULTIPART_CONCURRENCY = 4
+# verified downloads of files larger than RANGE_SIZE request ranges of that size in
+# parallel, and hash them in order
+RANGE_SIZE = 8 * 1024 * 1024
+# check existence before uploading files of at least this size, smaller files are
+# uploaded with a conditional put instead
+CHECK_SIZE = 1024 * 1024
+# maximum number of keys per `delete_objects` request
+DELETE_BATCH_SIZE = 1000
+# maximum number of keys per `list_objects_v2` page
+LIST_PAGE_SIZE = 1000
+# maximum number of keys remembered to exist, beyond that the presence index of the
+# hashes answers
+MAX_PRESENT_KEYS = 100000
+# error codes of a conditional put on an existing key
+_EXISTS_ERRORS = ("PreconditionFailed", "ConditionalRequestConflict")
+# error codes of S3-compatible servers that do not support conditional puts
+_CONDITIONAL_UNSUPPORTED_ERRORS = (
+    "NotImplemented",
+    "InvalidArgument",
+    "InvalidRequest",
+)
+# error codes of requests that S3 throttles
+_THROTTLE_ERRORS = (
+    "SlowDown",
+    "ServiceUnavailable",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+)
+
+
+def _is_throttle(e: Exception) -> bool:
+    """Whether the error means that S3 asks to slow down"""
+    if not isinstance(e, ClientError):
+        return False
+    return e.response.get("Error", {}).get(
+        "Code"
+    ) in _THROTTLE_ERRORS or e.response.get("ResponseMetadata", {}).get(
+        "HTTPStatusCode"
+    ) in (
+        429,
+        503,
+    )
 
 
-def download_process(
-    process_idx: int,
-    in_queue: Queue,
-    out_queue: Queue,
-    progress_queue: Union[Queue, None],
-):
-    """S3 download process, communicate through queue
+def _progress_bar(total: int) -> tqdm:
+    """A progress bar of `total` files on stderr
 
-    If `progress_queue` is None, don't report progress.
+    It is hidden when stderr is not a terminal, e.g. for scripts and other tools, or
+    when the environment sets GOD_PROGRESS=0.
     """
+    return tqdm(
+        total=total, disable=True if os.environ.get("GOD_PROGRESS") == "0" else None
+    )
 
-    class _DownloadProgressCallback:
-        def __init__(self, progress_queue, process_idx, total_files, total_bytes):
-            self.progress_queue = progress_queue
-            self.process_idx = process_idx
-            self.total_files = total_files
-            self.total_bytes = total_bytes
-            self._lock = threading.Lock()
 
-        def __call__(self, bytes_amount):
-            with self._lock:
-                self.total_bytes += bytes_amount
-                self.progress_queue.put(
-                    {
-                        "process_idx": self.process_idx,
-                        "total_files": self.total_files,
-                        "total_bytes": self.total_bytes,
-                    }
-                )
+def _tqdm_callback(pbar: tqdm) -> Callable:
+    """Progress callback of the transfer engine that updates a tqdm bar"""
 
-    client = boto3.client("s3")
-    total_files, total_bytes = 0, 0
-    while True:
-        message = in_queue.get()
-        if message is None:
-            break
+    def callback(total_files, total_bytes):
+        if total_files is not None and total_files != pbar.n:
+            pbar.update(total_files - pbar.n)
 
-        progress_callback = (
-            _DownloadProgressCallback(
-                progress_queue, process_idx, total_files, total_bytes
-            )
-            if progress_queue
-            else None
-        )
-        bucket, key, output_path = message
-        client.download_file(bucket, key, output_path, Callback=progress_callback)
-        out_queue.put(process_idx)
-
-        if progress_callback:
-            total_files += 1
-            total_bytes = progress_callback.total_bytes
-            progress_queue.put(  # type: ignore (progress_queue cannot be None)
-                {
-                    "process_idx": process_idx,
-                    "total_files": total_files,
-                    "total_bytes": total_bytes,
-                }
-            )
+    return callback
+
+
+class _PresentKeys:
+    """The keys known to exist, keeping the `MAX_PRESENT_KEYS` most recently seen"""
+
+    def __init__(self):
+        self._keys: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key not in self._keys:
+                return False
+            self._keys.move_to_end(key)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._keys)
 
+    def add(self, key: str):
+        self.update([key])
 
-def _download_progress_process(progress_queue: Queue, callback: Callable):
-    """Consolidate download progress of different processes into 1 report
+    def update(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                self._keys[key] = None
+                self._keys.move_to_end(key)
+            while len(self._keys) > MAX_PRESENT_KEYS:
+                self._keys.popitem(last=False)
+
+    def difference_update(self, keys: Iterable[str]):
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+
+class S3ClientPool:
+    """Long-lived S3 clients shared by all threads of a storage
+
+    boto3 sessions are not thread-safe and creating one costs more than uploading a
+    small object, so the pool creates 1 session, and lazily 1 client per thread.
 
     Args:
-        progress_queue: the queue contain progress, contributed by all download workers
-        callback: callback function that will receive total downloaded files and total
-            downloaded bytes
+        max_connections: the size of each client's HTTP connection pool
     """
-    progress = {}
-    while True:
-        current_progress = progress_queue.get()
-        if current_progress["process_idx"] == -1:
-            callback(None, None)
-            break
-        progress[current_progress["process_idx"]] = (
-            current_progress["total_files"],
-            current_progress["total_bytes"],
-        )
-        total_files, total_bytes = 0, 0
-        for each_progress in progress.values():
-            total_files += each_progress[0]
-            total_bytes += each_progress[1]
-        callback(total_files, total_bytes)
 
+    def __init__(self, max_connections: int = N_THREADS):
+        self._session = boto3.session.Session()
+        self._config = Config(max_pool_connections=max_connections)
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
-def upload_worker(task):
-    bucket, key, input_ = task
-    client = boto3.session.Session().client("s3")
-    client.upload_file(input_, bucket, key)
+    def get(self):
+        """Get the S3 client of the current thread"""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            with self._lock:
+                client = self._session.client("s3", config=self._config)
+            self._local.client = client
+        return client
 
 
 def _object_exists_worker(client, bucket: str, prefix: str) -> bool:
-    """Check if an object exists in S3"""
+    """Check if an object exists in S3, raise if S3 throttles"""
     try:
         client.head_object(Bucket=bucket, Key=prefix)
-    except ClientError:
+    except ClientError as e:
+        if _is_throttle(e):
+            raise
         return False
 
     return True
@@ -146,24 +199,52 @@ class S3Storage(BaseStorage, RemoteRefsMixin):
         # @PRIORITY2: remove these default values, raise error if users do not
         # supply these values
         self._bucket, self._prefix = parse_config(config)
-        self._dir_levels = DEFAULT_DIR_LEVEL
+        self._clients = S3ClientPool(max_connections=N_THREADS)
+        self._engine = get_engine()
+        self._present = _PresentKeys()
+        self._empty: Union[bool, None] = None  # whether the storage has no key
+        self._conditional_put = True  # False if the server rejects `IfNoneMatch`
+        self._shard_size = 0.0  # average number of keys per listed shard
+        self._n_listed_shards = 0
+        self._transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_SIZE,
+            multipart_chunksize=MULTIPART_SIZE,
+            max_concurrency=MULTIPART_CONCURRENCY,
+        )
 
-        s3c = boto3.client("s3")
+        s3c = self._clients.get()
         try:
             s3c.head_bucket(Bucket=self._bucket)
         except ClientError:
             raise Exception(
                 f"Bucket {self._bucket} does not exist or you don't have credentials"
             )
+        self._layout = self._read_layout()
 
-    def _hash_path(self, hash_value: str, prefix: str = "") -> str:
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
         """From hash value, get relative hash path"""
-        components = [
-            hash_value[idx * 2 : (idx + 1) * 2] for idx in range(self._dir_levels)
-        ]
-        return posixpath.join(
-            self._prefix, prefix, *components, hash_value[self._dir_levels * 2 :]
-        )
+        layout = layout or self._layout
+        return posixpath.join(self._prefix, prefix, *layout.split(hash_value))
+
+    def _layout_path(self) -> str:
+        return posixpath.join(self._prefix, LAYOUT_FILE)
+
+    def _presence_dir(self) -> str:
+        """Keep the presence index in user cache, it only records known hashes
+
+        Other machines can write to the bucket, so the index cannot tell that a hash
+        is absent, only that it was seen.
+        """
+        return str(Path(c.DIR_USER_CACHE, c.DIR_PRESENCE, self._bucket, self._prefix))
+
+    def _priority(self, storage_paths: List[str]) -> int:
+        """The transfer priority class of a batch of keys, from its first key"""
+        if not storage_paths:
+            return PRIORITY_OBJECTS
+        kind = posixpath.relpath(storage_paths[0], self._prefix or ".").split("/")[0]
+        return PRIORITIES.get(kind, PRIORITY_OBJECTS)
 
     def _get(
         self,
@@ -171,6 +252,7 @@ class S3Storage(BaseStorage, RemoteRefsMixin):
         paths: List[str],
         progress_callback: Union[Callable, None] = None,
         n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
     ):
         """Get the file and store that file in `paths`
 
@@ -178,100 +260,347 @@ class S3Storage(BaseStorage, RemoteRefsMixin):
             storage_path: the path from storage
             paths: the file path to copy to
             progress_callback: callback on how to report progress
-            n_processes: the number of processes to spin up, default equal to the
-                number of CPU cores
+            n_processes: ignored, the transfer engine adapts the concurrency
+            hash_values: the SHA-256 of each file to verify, None to skip verification
         """
         if len(storage_paths) != len(paths):
             raise AttributeError(f"Inconsistent {len(storage_paths)} , {len(paths)}")
 
-        if n_processes is None:
-            n_processes = min(cpu_count(), len(paths))
-
-        processes = {}
-        in_queues = {}
-        out_queue = Queue()
-        progress_queue = Queue() if progress_callback is not None else None
-        progress_process = None
-        current_message_idx = 0
-
-        for process_idx in range(n_processes):
-            in_queue = Queue()
-            in_queue.put(
-                (
-                    self._bucket,
-                    storage_paths[current_message_idx],
-                    paths[current_message_idx],
-                )
+        def _download(task, on_bytes):
+            storage_path, path, hash_value = task
+            if hash_value is not None:
+                self._get_verified(storage_path, path, hash_value, on_bytes)
+                return
+            temp_path = partial_path(path)
+            self._clients.get().download_file(
+                self._bucket,
+                storage_path,
+                temp_path,
+                Callback=on_bytes,
+                Config=self._transfer_config,
             )
-            in_queues[process_idx] = in_queue
-            current_message_idx += 1
+            os.replace(temp_path, path)
+
+        self._engine.map(
+            _download,
+            list(zip(storage_paths, paths, hash_values or [None] * len(paths))),
+            priority=self._priority(storage_paths),
+            progress_callback=progress_callback,
+            is_throttle=_is_throttle,
+        )
 
-            p = Process(
-                target=download_process,
-                args=(process_idx, in_queue, out_queue, progress_queue),
-            )
-            processes[process_idx] = p
-            p.start()
+    def _read_chunks(self, storage_path: str) -> Iterator[bytes]:
+        """Stream the content of `storage_path`
 
-        if progress_callback:
-            progress_process = Process(
-                target=_download_progress_process,
-                args=(progress_queue, progress_callback),
+        The first range also tells the object size. The rest is requested in ranges of
+        RANGE_SIZE, MULTIPART_CONCURRENCY at a time, and yielded in order.
+        """
+        client = self._clients.get()
+        try:
+            response = client.get_object(
+                Bucket=self._bucket, Key=storage_path, Range=f"bytes=0-{RANGE_SIZE - 1}"
             )
-            progress_process.start()
-
-        n_finished = 0
-        while n_finished < n_processes:
-            process_idx = out_queue.get()
-            if current_message_idx >= len(storage_paths):
-                n_finished += 1
-                in_queues[process_idx].put(None)
-                continue
-
-            in_queues[process_idx].put(
-                (
-                    self._bucket,
-                    storage_paths[current_message_idx],
-                    paths[current_message_idx],
-                )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                raise FileNotFoundError(storage_path) from e
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            return  # empty object
+        size = int(response["ContentRange"].split("/")[-1])
+        yield from response["Body"].iter_chunks(CHUNK_SIZE)
+        if size <= RANGE_SIZE:
+            return
+
+        def _get_range(start):
+            end = min(start + RANGE_SIZE, size) - 1
+            return (
+                self._clients.get()
+                .get_object(
+                    Bucket=self._bucket, Key=storage_path, Range=f"bytes={start}-{end}"
+                )["Body"]
+                .read()
             )
-            current_message_idx += 1
-
-        if progress_process and progress_queue:
-            progress_queue.put({"process_idx": -1})
-            progress_process.join()
 
-    def _store(self, storage_paths: List[str], paths: List[str]):
+        starts = iter(range(RANGE_SIZE, size, RANGE_SIZE))
+        with ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY) as executor:
+            ranges = deque(
+                executor.submit(_get_range, start)
+                for _, start in zip(range(MULTIPART_CONCURRENCY), starts)
+            )
+            try:
+                while ranges:
+                    data = ranges.popleft().result()
+                    start = next(starts, None)
+                    if start is not None:
+                        ranges.append(executor.submit(_get_range, start))
+                    yield data
+            finally:
+                for each in ranges:
+                    each.cancel()
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
         """Store files with a specific hash values
 
+        Unless `overwrite`, keys known to exist are skipped: keys recently seen,
+        large files found by a batched existence check, and small files are uploaded
+        with a conditional put that S3 rejects if the key exists.
+
         Args:
             storage_paths: the path from storage
             paths: the file path to send to storage
+            overwrite: if False, skip storage paths that already exist
+        """
+
+        def _upload(task, on_bytes):
+            storage_path, path = task
+            client = self._clients.get()
+            if overwrite:
+                client.upload_file(
+                    path, self._bucket, storage_path, Config=self._transfer_config
+                )
+            elif os.path.getsize(path) >= MULTIPART_SIZE:
+                self._upload_multipart(path, storage_path)
+            else:
+                self._put_if_absent(client, path, storage_path)
+            on_bytes(os.path.getsize(path))
+            self._present.add(storage_path)
+            self._empty = False
+
+        tasks = list(zip(storage_paths, paths))
+        if not overwrite:
+            tasks = [each for each in tasks if each[0] not in self._present]
+            large = [
+                each[0] for each in tasks if os.path.getsize(each[1]) >= CHECK_SIZE
+            ]
+            if large:
+                exists = set(
+                    large[idx] for idx, each in enumerate(self._have(large)) if each
+                )
+                tasks = [each for each in tasks if each[0] not in exists]
+        with _progress_bar(len(tasks)) as pbar:
+            self._engine.map(
+                _upload,
+                tasks,
+                priority=self._priority(storage_paths),
+                sizes=[os.path.getsize(each[1]) for each in tasks],
+                progress_callback=_tqdm_callback(pbar),
+                is_throttle=_is_throttle,
+            )
+
+    def _put_if_absent(self, client, path: str, storage_path: str):
+        """Upload a small file unless its key exists
+
+        The put is conditional, so S3 checks the existence in the same request. On
+        servers that reject conditional puts, the key is checked with a HEAD first,
+        for this and every later upload of the storage.
+
+        Args:
+            client: the S3 client of the current thread
+            path: the local file to upload
+            storage_path: the key to upload to
+        """
+        if self._conditional_put:
+            try:
+                with open(path, "rb") as fi:
+                    client.put_object(
+                        Bucket=self._bucket, Key=storage_path, Body=fi, IfNoneMatch="*"
+                    )
+                return
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code in _EXISTS_ERRORS:
+                    return
+                status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+                if code not in _CONDITIONAL_UNSUPPORTED_ERRORS and status != 501:
+                    raise
+                self._conditional_put = False
+
+        if _object_exists_worker(client, self._bucket, storage_path):
+            return
+        with open(path, "rb") as fi:
+            client.put_object(Bucket=self._bucket, Key=storage_path, Body=fi)
+
+    def _upload_multipart(self, path: str, storage_path: str):
+        """Upload a large file by parts, resuming an interrupted upload of the key
+
+        Keys are content addressed, so an unfinished multipart upload of the same key
+        has the same content, and its parts that have the expected size are kept.
+
+        Args:
+            path: the local file to upload
+            storage_path: the key to upload to
         """
-        tasks = []
-        for storage_path, path in zip(storage_paths, paths):
-            tasks.append((self._bucket, storage_path, path))
+        client = self._clients.get()
+        size = os.path.getsize(path)
+        part_sizes = {
+            idx + 1: min(MULTIPART_SIZE, size - idx * MULTIPART_SIZE)
+            for idx in range(math.ceil(size / MULTIPART_SIZE))
+        }
+
+        upload_id, etags = None, {}
+        uploads = client.list_multipart_uploads(
+            Bucket=self._bucket, Prefix=storage_path
+        ).get("Uploads", [])
+        for upload in uploads:
+            if upload["Key"] == storage_path:
+                upload_id = upload["UploadId"]
+                break
+
+        if upload_id is not None:
+            paginator = client.get_paginator("list_parts")
+            pages = paginator.paginate(
+                Bucket=self._bucket, Key=storage_path, UploadId=upload_id
+            )
+            for page in pages:
+                for part in page.get("Parts", []):
+                    if part["Size"] == part_sizes.get(part["PartNumber"]):
+                        etags[part["PartNumber"]] = part["ETag"]
+        else:
+            upload_id = client.create_multipart_upload(
+                Bucket=self._bucket, Key=storage_path
+            )["UploadId"]
+
+        def _upload_part(part_number):
+            with open(path, "rb") as fi:
+                fi.seek((part_number - 1) * MULTIPART_SIZE)
+                body = fi.read(part_sizes[part_number])
+            return self._clients.get().upload_part(
+                Bucket=self._bucket,
+                Key=storage_path,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body,
+            )["ETag"]
+
+        remaining = [each for each in part_sizes if each not in etags]
+        with ThreadPoolExecutor(max_workers=MULTIPART_CONCURRENCY) as executor:
+            for part_number, etag in zip(
+                remaining, executor.map(_upload_part, remaining)
+            ):
+                etags[part_number] = etag
+
+        client.complete_multipart_upload(
+            Bucket=self._bucket,
+            Key=storage_path,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": each, "ETag": etags[each]} for each in sorted(etags)
+                ]
+            },
+        )
+
+    def _copy(
+        self, source: BaseStorage, source_paths: List[str], storage_paths: List[str]
+    ) -> bool:
+        """Copy objects from another S3 storage with server-side copy
+
+        Objects larger than `MULTIPART_SIZE` are copied by parts. The data never
+        leaves S3.
+
+        Args:
+            source: the storage to copy from
+            source_paths: the keys in `source`
+            storage_paths: the corresponding keys in this storage
 
-        with Pool(cpu_count()) as p:
-            with tqdm(total=len(tasks)) as pbar:
-                for _ in p.imap_unordered(upload_worker, iterable=tasks):
-                    pbar.update()
+        Returns:
+            True if copied, False if `source` is not an S3 storage
+        """
+        if not isinstance(source, S3Storage):
+            return False
+
+        def _copy_one(task, on_bytes):
+            source_path, storage_path = task
+            self._clients.get().copy(
+                {"Bucket": source._bucket, "Key": source_path},
+                self._bucket,
+                storage_path,
+                Config=self._transfer_config,
+            )
+            self._present.add(storage_path)
+            self._empty = False
+
+        tasks = list(zip(source_paths, storage_paths))
+        with _progress_bar(len(tasks)) as pbar:
+            self._engine.map(
+                _copy_one,
+                tasks,
+                priority=self._priority(storage_paths),
+                progress_callback=_tqdm_callback(pbar),
+                is_throttle=_is_throttle,
+            )
+        return True
 
-    def _delete(self, storage_paths: List[str]):
-        """Delete object
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete objects, in batches of `DELETE_BATCH_SIZE` keys over threads
 
         Args:
             storage_paths: the location of object to delete
+
+        Returns:
+            The error message of each storage path that cannot be deleted
         """
-        # PRIORITY3: make use of bulk delete `client.delete_objects`
-        s3r = boto3.resource("s3")
-        for storage_path in storage_paths:
-            s3r.Object(self._bucket, storage_path).delete()
+
+        def _delete_batch(keys: List[str]) -> Dict[str, str]:
+            try:
+                response = self._clients.get().delete_objects(
+                    Bucket=self._bucket,
+                    Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True},
+                )
+            except ClientError as e:
+                return {key: str(e) for key in keys}
+            return {
+                each["Key"]: f'{each.get("Code", "")}: {each.get("Message", "")}'
+                for each in response.get("Errors", [])
+            }
+
+        batches = [
+            storage_paths[idx : idx + DELETE_BATCH_SIZE]
+            for idx in range(0, len(storage_paths), DELETE_BATCH_SIZE)
+        ]
+        errors: Dict[str, str] = {}
+        if batches:
+            n_workers = min(N_THREADS, len(batches))
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                for each in executor.map(_delete_batch, batches):
+                    errors.update(each)
+
+        self._present.difference_update(storage_paths)
+        return errors
 
     def _have(self, storage_paths: List[str]) -> List[bool]:
         """Check whether a file with specific location exists in the storage
 
-        Since len(storage_paths) can easily reach 10s of millions
+        Keys recently seen to exist are not asked again.
+
+        Args:
+            storage_paths: the location of the file
+
+        Returns:
+            True if the file exists, False otherwise
+        """
+        result = [each in self._present for each in storage_paths]
+        unknown = [idx for idx, each in enumerate(result) if not each]
+        if not unknown:
+            return result
+
+        exists = self._probe([storage_paths[idx] for idx in unknown])
+        for idx, each in zip(unknown, exists):
+            if each:
+                result[idx] = True
+                self._present.add(storage_paths[idx])
+
+        return result
+
+    def _probe(self, storage_paths: List[str]) -> List[bool]:
+        """Ask S3 whether files with specific locations exist
+
+        Since len(storage_paths) can easily reach 10s of millions, sending 1 HEAD per
+        key is too slow. The keys are grouped by shard (e.g. `objects/ab/cd/`), and a
+        shard is listed instead when listing it takes fewer requests than the HEADs.
+        Shards are listed, and HEADs are sent, in parallel.
 
         Args:
             storage_paths: the location of the file
@@ -279,48 +608,111 @@ class S3Storage(BaseStorage, RemoteRefsMixin):
         Returns:
             True if the file exists, False otherwise
         """
-        s3c = boto3.client("s3")
-        if not s3c.list_objects_v2(Bucket=self._bucket, Prefix=self._prefix, MaxKeys=1)[
-            "KeyCount"
-        ]:
+        if self._is_empty():
             return [False] * len(storage_paths)
 
-        result = []
-        if len(storage_paths) < 10:
-            for storage_path in storage_paths:
-                try:
-                    s3c.head_object(Bucket=self._bucket, Key=storage_path)
-                    result.append(True)
-                except ClientError:
-                    result.append(False)
-        else:
-            # good when len(storage_paths) < 100000 (3 mins)
-            # but if the dataset is millions file, then multithreading is still slow
-            fn = partial(_object_exists_worker, s3c, self._bucket)
-            n_workers = int(min(128, len(storage_paths) / 2))
-            with ThreadPoolExecutor(max_workers=n_workers) as executor:
-                result = list(executor.map(fn, storage_paths))
+        shards: Dict[str, List[int]] = defaultdict(list)
+        for idx, storage_path in enumerate(storage_paths):
+            shards[posixpath.dirname(storage_path)].append(idx)
+
+        # cost of a shard: 1 request per HEAD, or 1 request per listed page
+        n_pages = max(1, math.ceil(self._shard_size / LIST_PAGE_SIZE))
+        to_list, to_head = [], []
+        for shard, indices in shards.items():
+            if len(indices) > n_pages:
+                to_list.append(shard)
+            else:
+                to_head += indices
+
+        result = [False] * len(storage_paths)
+
+        def _check(task, on_bytes):
+            method, value = task
+            if method == "list":
+                return self._list_shard(value)
+            return _object_exists_worker(
+                self._clients.get(), self._bucket, storage_paths[value]
+            )
+
+        tasks = [("list", each) for each in to_list] + [
+            ("head", each) for each in to_head
+        ]
+        answers = self._engine.map(
+            _check,
+            tasks,
+            priority=self._priority(storage_paths),
+            is_throttle=_is_throttle,
+        )
+
+        n_listed_keys = 0
+        for shard, keys in zip(to_list, answers[: len(to_list)]):
+            n_listed_keys += len(keys)
+            self._present.update(keys)
+            for idx in shards[shard]:
+                result[idx] = storage_paths[idx] in keys
+        for idx, exists in zip(to_head, answers[len(to_list) :]):
+            result[idx] = exists
+
+        if to_list:
+            # running average of shard size, to estimate the listing cost next time
+            self._n_listed_shards += len(to_list)
+            self._shard_size += (
+                n_listed_keys - self._shard_size * len(to_list)
+            ) / self._n_listed_shards
 
         return result
 
-    def _list(self, storage_prefix: str) -> List[str]:
-        """Return all hashes and location inside the object storage
+    def _is_empty(self) -> bool:
+        """Whether the storage has no key, asked once per instance
+
+        Stores of this instance make it non-empty. Keys that other machines store
+        afterwards are not seen until a new instance, they are then uploaded again.
+        """
+        if self._empty is None:
+            self._empty = not self._clients.get().list_objects_v2(
+                Bucket=self._bucket, Prefix=self._prefix, MaxKeys=1
+            )["KeyCount"]
+        return self._empty
+
+    def _list_shard(self, shard: str) -> Set[str]:
+        """List all keys directly inside a shard
 
         Args:
-            storage_prefix: the object prefix (should ends with "/")
+            shard: the key prefix of the shard, without trailing "/"
+
+        Returns:
+            The keys inside the shard
         """
-        result = []
-        s3c = boto3.client("s3")
+        return {f"{shard}/{name}" for name, _, _ in self._scan(f"{shard}/")}
 
-        # PRIORITY3: perform multi-threading
-        paginator = s3c.get_paginator("list_objects_v2")
-        pages = paginator.paginate(Bucket=self._bucket, Prefix=f"{storage_prefix}")
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over all keys inside a shard of `storage_prefix`
+
+        Args:
+            storage_prefix: the key prefix to scan, ends with "/"
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
+
+        Yields:
+            The key relative to `storage_prefix`
+            The object size in bytes
+            The object last modified time, in seconds since epoch
+        """
+        prefix = f"{storage_prefix}{shard}/" if shard else storage_prefix
+        paginator = self._clients.get().get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=self._bucket,
+            Prefix=prefix,
+            PaginationConfig={"PageSize": LIST_PAGE_SIZE},
+        )
         for page in pages:
-            for each in page["Contents"]:
-                result.append(
-                    each["Key"].replace(f"{storage_prefix}", "").replace("/", "")
+            for each in page.get("Contents", []):
+                yield (
+                    each["Key"][len(storage_prefix) :],
+                    each["Size"],
+                    each["LastModified"].timestamp(),
                 )
-        return result
 
     def _ref_path(self, ref: str, prefix: str = "") -> str:
         """Construct the path to ref file
@@ -0,0 +1,355 @@
+"""Storage served by `god serve`, over the smart HTTP transport
+
+Configured as `god+http://host:port/[path]` or `god+https://...`. Every operation is
+sent in batches of BATCH_SIZE hashes (see `god.storage.server` for the endpoints),
+batches run in parallel on the transfer engine, and ref updates are
+compare-and-swap on the server. The token of the server, if any, is read from the
+environment variable `GOD_SERVE_TOKEN`.
+
+The storage paths are `<kind>/<hash>` and `refs/<ref>`, the server decides where
+the files are kept.
+"""
+import json
+import os
+import posixpath
+import shutil
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from urllib.parse import urlsplit
+
+from god.storage.backends.base import (
+    CHUNK_SIZE,
+    BaseStorage,
+    RemoteRefsMixin,
+    partial_path,
+    write_verified,
+)
+from god.storage.backends.http import HTTPConnectionPool, HTTPStatusError, _is_throttle
+from god.storage.engine import PRIORITIES, PRIORITY_OBJECTS, get_engine
+from god.storage.layout import Layout
+from god.storage.server import REFS, TOKEN_ENV, pack_header, read_pack, unbitmap
+
+# number of hashes per request
+BATCH_SIZE = 1000
+
+
+def parse_config(config: str) -> Tuple[str, str, str]:
+    """Parse god+http(s)://host[:port]/[path]
+
+    Returns:
+        - the scheme, "http" or "https"
+        - the host and port
+        - the URL path that the endpoints are under
+    """
+    parts = urlsplit(config)
+    if parts.scheme not in ("god+http", "god+https") or not parts.netloc:
+        raise ValueError(
+            f'Expect "god+http://" or "god+https://" but receive {config} instead'
+        )
+    return parts.scheme[len("god+") :], parts.netloc, parts.path.rstrip("/")
+
+
+def _batches(items: List, size: int = BATCH_SIZE) -> List[List]:
+    return [items[start : start + size] for start in range(0, len(items), size)]
+
+
+def _read_lines(response) -> Iterator[str]:
+    """Iterate over the lines of a streamed response
+
+    The response is read in chunks, since reading it by line takes a truncated
+    response as a complete one.
+    """
+    rest = b""
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        *lines, rest = (rest + chunk).split(b"\n")
+        for line in lines:
+            yield line.decode()
+    if rest:
+        yield rest.decode()
+
+
+class SmartHTTPStorage(BaseStorage, RemoteRefsMixin):
+    """Store objects in a repo served by `god serve`"""
+
+    def __init__(self, config: str):
+        scheme, self._netloc, self._root = parse_config(config)
+        self._pool = HTTPConnectionPool(scheme, self._netloc)
+        self._engine = get_engine()
+        token = os.environ.get(TOKEN_ENV)
+        self._headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
+        """The kind and the hash, the server lays the hashes out"""
+        return posixpath.join(prefix, hash_value)
+
+    def _ref_path(self, ref: str, prefix: str = "") -> str:
+        return posixpath.join(prefix, ref)
+
+    def _shards(self) -> List[str]:
+        """The server lists a kind in 1 request"""
+        return [""]
+
+    def _split(self, storage_path: str) -> Tuple[str, str]:
+        """Get the kind and the hash (or ref name) of a storage path"""
+        kind, _, name = storage_path.partition("/")
+        return kind, name
+
+    def _group(self, storage_paths: List[str]) -> Dict[str, List[int]]:
+        """Group the indices of storage paths by kind"""
+        groups = defaultdict(list)
+        for idx, storage_path in enumerate(storage_paths):
+            groups[self._split(storage_path)[0]].append(idx)
+        return groups
+
+    def _post(self, endpoint: str, body: Union[bytes, Callable], **headers) -> bytes:
+        """Send a request that has a small response, and get the response"""
+        path = f"{self._root}/{endpoint}"
+        with self._pool.request(
+            "POST", path, {**self._headers, **headers}, body
+        ) as response:
+            data = response.read()
+            if response.status != 200:
+                raise HTTPStatusError(response.status, "POST", path)
+            return data
+
+    def _get(
+        self,
+        storage_paths: List[str],
+        paths: List[str],
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
+    ):
+        """Download the files, a pack per batch of hashes
+
+        Args:
+            storage_paths: the paths in the storage
+            paths: the file paths to copy to
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: ignored, the transfer engine adapts the concurrency
+            hash_values: the SHA-256 of each file to verify, None to skip verification
+        """
+        if len(storage_paths) != len(paths):
+            raise AttributeError(f"Inconsistent {len(storage_paths)} , {len(paths)}")
+        verify = hash_values is not None
+
+        def _get_pack(task, on_bytes):
+            kind, targets = task
+            path = f"{self._root}/get/{kind}"
+            body = "\n".join(targets).encode()
+            with self._pool.request("POST", path, self._headers, body) as response:
+                if response.status != 200:
+                    raise HTTPStatusError(response.status, "POST", path)
+                received = 0
+                for hash_value, size, chunks in read_pack(response):
+                    if size < 0:
+                        raise FileNotFoundError(f"{kind}/{hash_value}")
+                    self._write(
+                        targets[hash_value], chunks, hash_value, verify, on_bytes
+                    )
+                    received += 1
+                if received != len(targets):
+                    # the server dropped the connection inside the stream
+                    raise EOFError(f"Pack of {kind} ends after {received} files")
+
+        tasks = []
+        for kind, indices in self._group(storage_paths).items():
+            if kind == REFS:
+                for idx in indices:
+                    self._get_ref(self._split(storage_paths[idx])[1], paths[idx])
+                continue
+            targets = defaultdict(list)
+            for idx in indices:
+                targets[self._split(storage_paths[idx])[1]].append(paths[idx])
+            tasks += [
+                (kind, {each: targets[each] for each in batch})
+                for batch in _batches(list(targets))
+            ]
+
+        self._engine.map(
+            _get_pack,
+            tasks,
+            priority=self._priority(storage_paths),
+            is_throttle=_is_throttle,
+        )
+        if progress_callback:
+            progress_callback(total_files=len(paths), total_bytes=0)
+
+    def _write(
+        self,
+        paths: List[str],
+        chunks: Iterator[bytes],
+        hash_value: str,
+        verify: bool,
+        on_bytes: Callable[[int], None],
+    ):
+        """Write the content of a hash to its first path, and copy it to the rest"""
+        first, *rest = paths
+        if verify:
+            write_verified(first, chunks, hash_value, on_bytes)
+        else:
+            with open(partial_path(first), "wb") as fo:
+                for chunk in chunks:
+                    fo.write(chunk)
+                    on_bytes(len(chunk))
+            os.replace(partial_path(first), first)
+        for path in rest:
+            shutil.copyfile(first, path)
+
+    def _get_ref(self, ref: str, path: str):
+        url = f"{self._root}/{REFS}/{ref}"
+        with self._pool.request("GET", url, self._headers) as response:
+            data = response.read()
+            if response.status == 404:
+                raise FileNotFoundError(ref)
+            if response.status != 200:
+                raise HTTPStatusError(response.status, "GET", url)
+        with open(path, "wb") as fo:
+            fo.write(data)
+
+    def _priority(self, storage_paths: List[str]) -> int:
+        if not storage_paths:
+            return PRIORITY_OBJECTS
+        return PRIORITIES.get(self._split(storage_paths[0])[0], PRIORITY_OBJECTS)
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        """Upload the files, a pack per batch of hashes. Refs are set unconditionally
+
+        Args:
+            storage_paths: the paths in the storage
+            paths: the local files to store
+            overwrite: ignored, hashes never change and refs are always overwritten
+        """
+
+        def _put_pack(task, on_bytes):
+            kind, files = task
+            sizes = [os.path.getsize(path) for _, path in files]
+            length = sum(
+                len(pack_header(hash_value, size)) + size
+                for (hash_value, _), size in zip(files, sizes)
+            )
+
+            def body():
+                for (hash_value, path), size in zip(files, sizes):
+                    yield pack_header(hash_value, size)
+                    with open(path, "rb") as fi:
+                        for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+                            on_bytes(len(chunk))
+                            yield chunk
+
+            self._post(f"put/{kind}", body, **{"Content-Length": str(length)})
+
+        tasks = []
+        for kind, indices in self._group(storage_paths).items():
+            if kind == REFS:
+                for idx in indices:
+                    with open(paths[idx], "r") as fi:
+                        self._update_ref(self._split(storage_paths[idx])[1], fi.read())
+                continue
+            files = [
+                (self._split(storage_paths[idx])[1], paths[idx]) for idx in indices
+            ]
+            tasks += [(kind, batch) for batch in _batches(files)]
+
+        self._engine.map(
+            _put_pack,
+            tasks,
+            priority=self._priority(storage_paths),
+            is_throttle=_is_throttle,
+        )
+
+    def _update_ref(self, ref: str, new: Union[str, None], **old) -> bool:
+        """Update a ref on the server, compare-and-swap if `old` is given"""
+        path = f"{self._root}/{REFS}/{ref}"
+        body = json.dumps({"new": new, **old}).encode()
+        with self._pool.request("POST", path, self._headers, body) as response:
+            response.read()
+            if response.status == 409:
+                return False
+            if response.status != 200:
+                raise HTTPStatusError(response.status, "POST", path)
+        return True
+
+    def swap_ref(self, ref: str, old: Union[str, None], new: Union[str, None]) -> bool:
+        """Set the ref to `new` only if it is still `old`, atomically on the server
+
+        Args:
+            ref: the name of the ref
+            old: the expected content of the ref, None if it should not exist
+            new: the new content of the ref, None to delete the ref
+
+        Returns:
+            True if the ref is updated, False if the ref is not `old`
+        """
+        return self._update_ref(ref, new, old=old)
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete the files, a request per batch of hashes
+
+        Args:
+            storage_paths: the paths in the storage
+
+        Returns:
+            The error message of each storage path that cannot be deleted
+        """
+        errors = {}
+        for kind, indices in self._group(storage_paths).items():
+            names = [self._split(storage_paths[idx])[1] for idx in indices]
+            if kind == REFS:
+                for name in names:
+                    self._update_ref(name, None)
+                continue
+            for batch in _batches(names):
+                result = json.loads(
+                    self._post(f"delete/{kind}", "\n".join(batch).encode())
+                )
+                for hash_value, message in result.items():
+                    errors[posixpath.join(kind, hash_value)] = message
+        return errors
+
+    def _have(self, storage_paths: List[str]) -> List[bool]:
+        """Check whether the files exist, a request per batch of hashes
+
+        Args:
+            storage_paths: the paths in the storage
+
+        Returns:
+            True if the file exists, False otherwise
+        """
+        result = [False] * len(storage_paths)
+        for kind, indices in self._group(storage_paths).items():
+            for batch in _batches(indices):
+                names = [self._split(storage_paths[idx])[1] for idx in batch]
+                data = self._post(f"have/{kind}", "\n".join(names).encode())
+                for idx, exists in zip(batch, unbitmap(data, len(batch))):
+                    result[idx] = exists
+        return result
+
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over the hashes (or refs) of a kind, in 1 streamed request
+
+        Args:
+            storage_prefix: the kind, as given by `_hash_path("", prefix=kind)`
+            shard: ignored, the server lists the whole kind
+
+        Yields:
+            The hash (or ref name)
+            The file size in bytes
+            The file last modified time, in seconds since epoch
+        """
+        path = f"{self._root}/scan/{storage_prefix.strip('/')}"
+        with self._pool.request("GET", path, self._headers) as response:
+            if response.status != 200:
+                raise HTTPStatusError(response.status, "GET", path)
+            for line in _read_lines(response):
+                name, size, mtime = line.split("\t")
+                yield name, int(size), float(mtime)
@@ -0,0 +1,404 @@
+"""Storage on a server reachable by SSH, over SFTP
+
+Configured as `ssh://[user@]host[:port]/absolute/path`. The host, user, port and
+identity file are also read from `~/.ssh/config`, and the server must be in the
+known hosts. Requires `paramiko`, imported when the storage is created.
+
+    - 1 SSH connection is kept for the storage, and N_CHANNELS SFTP channels are
+        multiplexed over it, so that files are transferred in parallel without a
+        handshake per file.
+    - Reads are prefetched and writes are pipelined: the requests of a file are sent
+        without waiting for each reply.
+    - Existence checks list each directory (e.g. `objects/ab/cd`) once, instead of a
+        round trip per file.
+    - Files are uploaded to a temporary name then renamed, so that readers never see
+        a partial file.
+"""
+import os
+import posixpath
+import queue
+import stat
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from urllib.parse import urlsplit
+
+import god.storage.constants as c
+from god.storage.backends.base import (
+    CHUNK_SIZE,
+    BaseStorage,
+    RemoteRefsMixin,
+    partial_path,
+)
+from god.storage.engine import PRIORITIES, PRIORITY_OBJECTS, get_engine
+from god.storage.layout import LAYOUT_FILE, Layout
+
+# number of SFTP channels over the SSH connection
+N_CHANNELS = 8
+# seconds to wait for the server
+TIMEOUT = 60
+
+
+def parse_config(config: str) -> Tuple[Union[str, None], str, Union[int, None], str]:
+    """Parse ssh://[user@]host[:port]/absolute/path
+
+    Returns:
+        - the user, None to use the one from `~/.ssh/config` or the local user
+        - the host
+        - the port, None to use the one from `~/.ssh/config` or 22
+        - the absolute path of the storage root
+    """
+    parts = urlsplit(config)
+    if parts.scheme != "ssh" or not parts.hostname:
+        raise ValueError(f'Expect "ssh://" but receive {config} instead')
+    if not parts.path.startswith("/"):
+        raise ValueError(f"Expect an absolute path but receive {config} instead")
+    return parts.username, parts.hostname, parts.port, parts.path.rstrip("/") or "/"
+
+
+class SFTPPool:
+    """SFTP channels over 1 SSH connection, shared by all threads
+
+    Args:
+        user: the user to log in as, None for the default
+        host: the server
+        port: the SSH port, None for the default
+        n_channels: the maximum number of channels
+    """
+
+    def __init__(
+        self,
+        user: Union[str, None],
+        host: str,
+        port: Union[int, None],
+        n_channels: int = N_CHANNELS,
+    ):
+        import paramiko
+
+        self._paramiko = paramiko
+        self._kwargs = self._connect_kwargs(user, host, port)
+        self._client = None
+        self._lock = threading.Lock()
+        self._idle: queue.Queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(n_channels)
+        self._connect()
+
+    def _connect_kwargs(
+        self, user: Union[str, None], host: str, port: Union[int, None]
+    ) -> Dict:
+        """Fill the connection arguments from `~/.ssh/config`"""
+        options = {}
+        ssh_config = Path("~/.ssh/config").expanduser()
+        if ssh_config.is_file():
+            options = self._paramiko.SSHConfig.from_path(str(ssh_config)).lookup(host)
+        kwargs = {
+            "hostname": options.get("hostname", host),
+            "port": port or int(options.get("port", 22)),
+            "username": user or options.get("user"),
+            "timeout": TIMEOUT,
+        }
+        if "identityfile" in options:
+            kwargs["key_filename"] = options["identityfile"]
+        return kwargs
+
+    def _connect(self):
+        client = self._paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.connect(**self._kwargs)
+        client.get_transport().set_keepalive(30)
+        self._client = client
+
+    def _open(self):
+        """Open a channel, reconnecting if the connection is lost"""
+        with self._lock:
+            transport = self._client.get_transport()
+            if transport is None or not transport.is_active():
+                self._idle = queue.Queue()
+                self._connect()
+                transport = self._client.get_transport()
+        return self._paramiko.SFTPClient.from_transport(transport)
+
+    @contextmanager
+    def channel(self):
+        """Get an SFTP channel, waiting if all channels are in use"""
+        with self._slots:
+            try:
+                sftp = self._idle.get_nowait()
+            except queue.Empty:
+                sftp = self._open()
+            try:
+                yield sftp
+            except (EOFError, OSError) as e:
+                if isinstance(e, (FileNotFoundError, PermissionError)):
+                    self._idle.put(sftp)
+                else:
+                    sftp.close()
+                raise
+            except BaseException:
+                sftp.close()
+                raise
+            else:
+                self._idle.put(sftp)
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+        self._client.close()
+
+
+class SSHStorage(BaseStorage, RemoteRefsMixin):
+    """Store objects on a server over SFTP"""
+
+    def __init__(self, config: str):
+        user, self._host, port, self._base_path = parse_config(config)
+        self._pool = SFTPPool(user, self._host, port)
+        self._engine = get_engine()
+        self._created_dirs = set()
+        self._layout = self._read_layout()
+
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
+        """From hash value, get the path on the server"""
+        layout = layout or self._layout
+        return posixpath.join(self._base_path, prefix, *layout.split(hash_value))
+
+    def _layout_path(self) -> str:
+        return posixpath.join(self._base_path, LAYOUT_FILE)
+
+    def _ref_path(self, ref: str, prefix: str = "") -> str:
+        """Construct the path to ref file
+
+        Args:
+            ref: the name of the ref
+            prefix: the object prefix
+        """
+        return posixpath.join(self._base_path, prefix, ref)
+
+    def _presence_dir(self) -> str:
+        """Keep the presence index in user cache, it only records known hashes"""
+        return str(
+            Path(
+                c.DIR_USER_CACHE,
+                c.DIR_PRESENCE,
+                self._host,
+                self._base_path.lstrip("/"),
+            )
+        )
+
+    def _priority(self, storage_paths: List[str]) -> int:
+        """The transfer priority class of a batch of paths, from its first path"""
+        if not storage_paths:
+            return PRIORITY_OBJECTS
+        kind = posixpath.relpath(storage_paths[0], self._base_path).split("/")[0]
+        return PRIORITIES.get(kind, PRIORITY_OBJECTS)
+
+    def _makedirs(self, sftp, directory: str):
+        """Create `directory` and its parents on the server"""
+        if directory in self._created_dirs:
+            return
+        missing = []
+        while directory not in ("", "/") and directory not in self._created_dirs:
+            try:
+                sftp.stat(directory)
+                break
+            except FileNotFoundError:
+                missing.append(directory)
+                directory = posixpath.dirname(directory)
+        for each in reversed(missing):
+            try:
+                sftp.mkdir(each)
+            except OSError:
+                # created by another channel in the meantime
+                sftp.stat(each)
+        self._created_dirs.update(missing)
+
+    def _get(
+        self,
+        storage_paths: List[str],
+        paths: List[str],
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
+    ):
+        """Download the files in parallel over the channels
+
+        Args:
+            storage_paths: the paths on the server
+            paths: the file paths to copy to
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: ignored, the transfer engine adapts the concurrency
+            hash_values: the SHA-256 of each file to verify, None to skip verification
+        """
+        if len(storage_paths) != len(paths):
+            raise AttributeError(f"Inconsistent {len(storage_paths)} , {len(paths)}")
+
+        def _download(task, on_bytes):
+            storage_path, path, hash_value = task
+            if hash_value is not None:
+                self._get_verified(storage_path, path, hash_value, on_bytes)
+                return
+            temp_path = partial_path(path)
+            with open(temp_path, "wb") as fo:
+                for chunk in self._read_chunks(storage_path):
+                    fo.write(chunk)
+                    on_bytes(len(chunk))
+            os.replace(temp_path, path)
+
+        self._engine.map(
+            _download,
+            list(zip(storage_paths, paths, hash_values or [None] * len(paths))),
+            priority=self._priority(storage_paths),
+            progress_callback=progress_callback,
+        )
+
+    def _read_chunks(self, storage_path: str) -> Iterator[bytes]:
+        """Stream the content of `storage_path`, with prefetched reads"""
+        with self._pool.channel() as sftp:
+            with sftp.open(storage_path, "rb") as fi:
+                fi.prefetch()
+                while True:
+                    chunk = fi.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        """Upload the files in parallel over the channels
+
+        Args:
+            storage_paths: the paths on the server
+            paths: the local files to upload
+            overwrite: if False, skip storage paths that already exist
+        """
+        if not overwrite:
+            exists = self._have(storage_paths)
+            storage_paths = [each for each, ok in zip(storage_paths, exists) if not ok]
+            paths = [each for each, ok in zip(paths, exists) if not ok]
+
+        def _upload(task, on_bytes):
+            storage_path, path = task
+            temp_path = f"{storage_path}.{uuid.uuid4().hex[:8]}.part"
+            with self._pool.channel() as sftp:
+                self._makedirs(sftp, posixpath.dirname(storage_path))
+                with sftp.open(temp_path, "wb") as fo, open(path, "rb") as fi:
+                    fo.set_pipelined(True)
+                    for chunk in iter(lambda: fi.read(CHUNK_SIZE), b""):
+                        fo.write(chunk)
+                        on_bytes(len(chunk))
+                sftp.posix_rename(temp_path, storage_path)
+
+        self._engine.map(
+            _upload,
+            list(zip(storage_paths, paths)),
+            priority=self._priority(storage_paths),
+        )
+
+    def _move(self, source_paths: List[str], storage_paths: List[str]):
+        """Rename files on the server"""
+
+        def _rename(task, on_bytes):
+            source_path, storage_path = task
+            with self._pool.channel() as sftp:
+                self._makedirs(sftp, posixpath.dirname(storage_path))
+                sftp.posix_rename(source_path, storage_path)
+
+        self._engine.map(
+            _rename,
+            list(zip(source_paths, storage_paths)),
+            priority=self._priority(storage_paths),
+        )
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete the files in parallel over the channels
+
+        Args:
+            storage_paths: the paths on the server
+
+        Returns:
+            The error message of each storage path that cannot be deleted
+        """
+
+        def _remove(storage_path, on_bytes):
+            with self._pool.channel() as sftp:
+                try:
+                    sftp.remove(storage_path)
+                except FileNotFoundError:
+                    return None
+                except OSError as e:
+                    return str(e)
+            return None
+
+        errors = self._engine.map(
+            _remove, storage_paths, priority=self._priority(storage_paths)
+        )
+        return {
+            path: error
+            for path, error in zip(storage_paths, errors)
+            if error is not None
+        }
+
+    def _have(self, storage_paths: List[str]) -> List[bool]:
+        """Check whether the files exist, listing each directory once
+
+        Args:
+            storage_paths: the paths on the server
+
+        Returns:
+            True if the file exists, False otherwise
+        """
+        directories = defaultdict(list)
+        for idx, storage_path in enumerate(storage_paths):
+            directories[posixpath.dirname(storage_path)].append(idx)
+
+        def _listdir(directory, on_bytes):
+            with self._pool.channel() as sftp:
+                try:
+                    return set(sftp.listdir(directory))
+                except FileNotFoundError:
+                    return set()
+
+        result = [False] * len(storage_paths)
+        listings = self._engine.map(
+            _listdir, list(directories), priority=self._priority(storage_paths)
+        )
+        for (directory, indices), names in zip(directories.items(), listings):
+            for idx in indices:
+                result[idx] = posixpath.basename(storage_paths[idx]) in names
+        return result
+
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over all files inside a shard of `storage_prefix`
+
+        Args:
+            storage_prefix: the path on the server to scan
+            shard: the sub-directory of `storage_prefix` to scan, "" to scan all
+
+        Yields:
+            The file path relative to `storage_prefix`
+            The file size in bytes
+            The file last modified time, in seconds since epoch
+        """
+        with self._pool.channel() as sftp:
+            directories = [shard.strip("/")]
+            while directories:
+                directory = directories.pop()
+                try:
+                    entries = sftp.listdir_attr(
+                        posixpath.join(storage_prefix, directory)
+                    )
+                except FileNotFoundError:
+                    continue
+                for entry in entries:
+                    name = posixpath.join(directory, entry.filename)
+                    if stat.S_ISDIR(entry.st_mode):
+                        directories.append(name)
+                    else:
+                        yield name, entry.st_size, float(entry.st_mtime)
@@ -0,0 +1,312 @@
+"""Local storage striped over several directories, e.g. 1 per disk
+
+Configured as `striped:///disk0/god,/disk1/god,...`. Each hash is owned by 1 root
+directory, chosen by consistent hashing: every root has VIRTUAL_NODES points on a
+hash ring, and a hash belongs to the root of the next point on the ring. Adding a
+root only moves about 1/N of the hashes, which `rebalance` moves in the background
+while the storage stays usable: a hash that is not yet in its owner root is read
+from the root that still has it.
+
+Each root is a `LocalStorage` with its own presence index. Batches of files are read
+and written on all roots in parallel.
+"""
+import bisect
+import hashlib
+import os
+import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+from god.storage.backends.base import BaseStorage
+from god.storage.backends.local import LocalStorage
+from god.storage.layout import Layout
+
+# points of each root on the hash ring, more points spread the hashes more evenly
+VIRTUAL_NODES = 128
+# threads per root to read and write files
+N_THREADS_PER_ROOT = 4
+
+
+def parse_config(config: str) -> List[Path]:
+    """Parse `striped:///path0,/path1,...` into the root directories"""
+    if not config.startswith("striped://"):
+        raise ValueError(f'Expect "striped://" but receive {config} instead')
+    roots = [Path(each) for each in config[len("striped://") :].split(",") if each]
+    if not roots or not all(each.is_absolute() for each in roots):
+        raise ValueError(
+            f"Expect striped:///path0,/path1 with absolute paths but receive {config}"
+        )
+    return [each.resolve() for each in roots]
+
+
+def _ring_position(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class StripedPresence:
+    """Presence index over the presence indices of the roots"""
+
+    def __init__(self, storage: "StripedStorage", prefix: str):
+        self._storage = storage
+        self._indices = [each.presence(prefix) for each in storage._roots]
+
+    def exists(self) -> bool:
+        return all(each.exists() for each in self._indices)
+
+    @property
+    def complete(self) -> bool:
+        return all(each.complete for each in self._indices)
+
+    def contains(self, hash_values: List[str]) -> List[bool]:
+        """A hash is present if any root has it, e.g. while it is being rebalanced"""
+        result = [False] * len(hash_values)
+        for index in self._indices:
+            missing = [idx for idx, exists in enumerate(result) if not exists]
+            if not missing:
+                break
+            found = index.contains([hash_values[idx] for idx in missing])
+            for idx, exists in zip(missing, found):
+                result[idx] = exists
+        return result
+
+    def add(self, hash_values: Iterable[str]):
+        """Record the hashes in the index of their owner root"""
+        for root_idx, hashes in self._storage._by_owner(hash_values).items():
+            self._indices[root_idx].add(hashes)
+
+    def remove(self, hash_values: Iterable[str]):
+        hash_values = list(hash_values)
+        for index in self._indices:
+            index.remove(hash_values)
+
+    def rebuild(self, hash_values: Iterable[str]):
+        hash_values = list(hash_values)
+        owned = self._storage._by_owner(hash_values)
+        for root_idx, index in enumerate(self._indices):
+            index.rebuild(owned.get(root_idx, []))
+
+
+class StripedStorage(BaseStorage):
+    """Store objects in several local directories"""
+
+    PRESENCE_EXCLUSIVE = True
+    # the objects are on local disk already
+    USE_OBJECT_CACHE = False
+
+    def __init__(self, config: str):
+        self._root_paths = parse_config(config)
+        self._roots = [LocalStorage(f"file://{each}") for each in self._root_paths]
+        ring = sorted(
+            (_ring_position(f"{root}#{idx}"), root_idx)
+            for root_idx, root in enumerate(self._root_paths)
+            for idx in range(VIRTUAL_NODES)
+        )
+        self._ring_positions = [each[0] for each in ring]
+        self._ring_roots = [each[1] for each in ring]
+
+    @property
+    def _layout(self) -> Layout:
+        """The roots are re-laid out together, they share the first root's layout"""
+        return self._roots[0]._layout
+
+    def _reload_layout(self, max_age: float = 0) -> bool:
+        return any([each._reload_layout(max_age) for each in self._roots])
+
+    def _layout_storages(self) -> List[BaseStorage]:
+        return list(self._roots)
+
+    def _owner(self, hash_value: str) -> int:
+        """The index of the root that owns `hash_value`"""
+        position = int(hash_value[:16].ljust(16, "0"), 16)
+        idx = bisect.bisect_left(self._ring_positions, position)
+        return self._ring_roots[idx % len(self._ring_roots)]
+
+    def _by_owner(self, hash_values: Iterable[str]) -> Dict[int, List[str]]:
+        result = defaultdict(list)
+        for each in hash_values:
+            result[self._owner(each)].append(each)
+        return result
+
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
+        """The path in the owner root, the first root for an empty hash"""
+        root = self._roots[self._owner(hash_value) if hash_value else 0]
+        return root._hash_path(hash_value, prefix=prefix, layout=layout)
+
+    def _root_of(self, storage_path: str) -> Tuple[int, str]:
+        """Get the root index of a storage path, and the path relative to the root"""
+        path = Path(storage_path)
+        for root_idx, root in enumerate(self._root_paths):
+            if path == root or root in path.parents:
+                return root_idx, str(path.relative_to(root))
+        raise ValueError(f"{storage_path} is not inside the striped storage")
+
+    def _locate(self, storage_path: str) -> str:
+        """The path that has the file: the owner root, else any other root"""
+        if os.path.exists(storage_path):
+            return storage_path
+        _, relative = self._root_of(storage_path)
+        for root in self._root_paths:
+            path = str(Path(root, relative))
+            if os.path.exists(path):
+                return path
+        return storage_path
+
+    def _local_path(self, storage_path: str) -> str:
+        """Striped storage paths are local filesystem paths"""
+        return storage_path
+
+    def presence(self, prefix: str) -> StripedPresence:
+        indices = self.__dict__.setdefault("_presence_indices", {})
+        if prefix not in indices:
+            indices[prefix] = StripedPresence(self, prefix)
+        return indices[prefix]
+
+    def rebuild_index(self, prefix: str) -> int:
+        return sum(each.rebuild_index(prefix) for each in self._roots)
+
+    def _parallel(self, fn: Callable, root_indices: Dict[int, List[int]]):
+        """Run `fn(root_idx, indices)` on slices of each root's indices in parallel"""
+        jobs = []
+        for root_idx, indices in root_indices.items():
+            size = max(1, -(-len(indices) // N_THREADS_PER_ROOT))
+            for start in range(0, len(indices), size):
+                jobs.append((root_idx, indices[start : start + size]))
+        if not jobs:
+            return []
+        n_workers = min(len(jobs), N_THREADS_PER_ROOT * len(self._roots))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(lambda job: fn(*job), jobs))
+
+    def _group(self, storage_paths: List[str]) -> Dict[int, List[int]]:
+        result = defaultdict(list)
+        for idx, storage_path in enumerate(storage_paths):
+            result[self._root_of(storage_path)[0]].append(idx)
+        return result
+
+    def _get(
+        self,
+        storage_paths: List[str],
+        paths: List[str],
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
+    ):
+        """Get the files, reading from all roots in parallel
+
+        Args:
+            storage_paths: the paths in the storage
+            paths: the file paths to copy to
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: ignored, each root is read by N_THREADS_PER_ROOT threads
+            hash_values: the SHA-256 of each file to verify, None to skip verification
+        """
+        storage_paths = [self._locate(each) for each in storage_paths]
+
+        def _get_slice(root_idx, indices):
+            self._roots[root_idx]._get(
+                storage_paths=[storage_paths[idx] for idx in indices],
+                paths=[paths[idx] for idx in indices],
+                hash_values=(
+                    None
+                    if hash_values is None
+                    else [hash_values[idx] for idx in indices]
+                ),
+            )
+
+        self._parallel(_get_slice, self._group(storage_paths))
+        if progress_callback:
+            progress_callback(total_files=len(paths), total_bytes=0)
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        """Store the files, writing to all roots in parallel
+
+        Args:
+            storage_paths: the paths in the storage
+            paths: the local files to store
+            overwrite: if False, skip storage paths that already exist
+        """
+
+        def _store_slice(root_idx, indices):
+            self._roots[root_idx]._store(
+                storage_paths=[storage_paths[idx] for idx in indices],
+                paths=[paths[idx] for idx in indices],
+                overwrite=overwrite,
+            )
+
+        self._parallel(_store_slice, self._group(storage_paths))
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete the files from every root, in case they are not rebalanced yet
+
+        Args:
+            storage_paths: the paths in the storage
+
+        Returns:
+            The error message of each storage path that cannot be deleted
+        """
+        errors = {}
+        for root_idx, root in enumerate(self._roots):
+            copies = {}
+            for storage_path in storage_paths:
+                _, relative = self._root_of(storage_path)
+                copies[str(Path(self._root_paths[root_idx], relative))] = storage_path
+            for path, message in root._delete(list(copies)).items():
+                errors[copies[path]] = message
+        return errors
+
+    def _have(self, storage_paths: List[str]) -> List[bool]:
+        return [os.path.exists(self._locate(each)) for each in storage_paths]
+
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over the files of all roots, each file once"""
+        _, relative = self._root_of(storage_prefix)
+        seen = set()
+        for root in self._roots:
+            for name, size, mtime in root._scan(
+                str(Path(root._base_path, relative)), shard
+            ):
+                if name not in seen:
+                    seen.add(name)
+                    yield name, size, mtime
+
+    def rebalance(self) -> int:
+        """Move every hash that is not in its owner root to its owner root
+
+        Returns:
+            The number of hashes moved
+        """
+
+        def _rebalance_root(root_idx):
+            root = self._roots[root_idx]
+            n_moved = 0
+            for prefix in [self.OBJECTS_PREFIX, self.DIRS_PREFIX, self.COMMITS_PREFIX]:
+                storage_prefix = root._hash_path("", prefix=prefix)
+                moved = defaultdict(list)
+                for name, _, _ in root._scan_hashes(storage_prefix):
+                    hash_value = name.replace("/", "")
+                    owner = self._owner(hash_value)
+                    if owner == root_idx:
+                        continue
+                    target = self._roots[owner]._hash_path(hash_value, prefix=prefix)
+                    Path(target).parent.mkdir(parents=True, exist_ok=True)
+                    # copy first, so that the hash is always in 1 of the roots
+                    temp = f"{target}.rebalance"
+                    shutil.copyfile(str(Path(storage_prefix, name)), temp)
+                    os.replace(temp, target)
+                    moved[owner].append(hash_value)
+                for owner, hash_values in moved.items():
+                    self._roots[owner].presence(prefix).add(hash_values)
+                    root._delete_hashes(hash_values, prefix=prefix)
+                    n_moved += len(hash_values)
+            return n_moved
+
+        with ThreadPoolExecutor(max_workers=len(self._roots)) as executor:
+            return sum(executor.map(_rebalance_root, range(len(self._roots))))
@@ -0,0 +1,376 @@
+"""Storage with a hot local tier and a cold remote tier
+
+Configured as `tiered://<hot>?cold=<cold>`, e.g.
+`tiered://file:///nvme/repo?cold=s3://bucket/prefix&demote_days=30`.
+
+    - Writes land on the hot tier and are queued to be copied to the cold tier. The
+        queue is a file in the hot tier, flushed by a background thread, so stores
+        return at local disk speed. Only processes that write start the thread, and
+        at exit they wait up to FLUSH_EXIT_TIMEOUT seconds for it to finish.
+    - Hashes that a process did not flush in time stay in the hot tier only until
+        the next process writes to the storage, or until `god storages flush`, which
+        flush every queue left behind. Run `god storages flush` after a large push
+        that exited before flushing.
+    - Reads come from the hot tier, and fall back to the cold tier. Hashes read from
+        the cold tier are kept in the hot tier.
+    - Objects that have not been read for `demote_days` days (default
+        DEFAULT_DEMOTE_DAYS) and that the cold tier has are removed from the hot tier,
+        at most once a day by the background thread, or with `god storages demote`.
+"""
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from urllib.parse import parse_qs
+
+from god.storage.backends.base import BaseStorage
+from god.storage.backends.local import LocalStorage
+from god.storage.layout import Layout
+from god.storage.presence import FileLock
+
+DIR_TIERED = "tiered"
+FILE_PENDING = "pending"
+FILE_DEMOTED = "demoted"
+DEFAULT_DEMOTE_DAYS = 30
+# seconds between 2 automatic demotions
+DEMOTE_INTERVAL = 24 * 60 * 60
+# seconds that a process waits at exit for its background flush
+FLUSH_EXIT_TIMEOUT = 60
+
+
+def parse_config(config: str) -> Tuple[str, str, int]:
+    """Parse `tiered://<hot>?cold=<cold>&demote_days=<days>`
+
+    Returns:
+        The hot tier config
+        The cold tier config
+        The number of days without read before an object is demoted
+    """
+    if not config.startswith("tiered://"):
+        raise ValueError(f'Expect "tiered://" but receive {config} instead')
+    hot, _, query = config[len("tiered://") :].partition("?")
+    params = parse_qs(query)
+    if not hot.startswith("file://") or "cold" not in params:
+        raise ValueError(
+            f"Expect tiered://file:///path?cold=<storage> but receive {config} instead"
+        )
+    demote_days = int(params.get("demote_days", [DEFAULT_DEMOTE_DAYS])[0])
+    return hot, params["cold"][0], demote_days
+
+
+class TieredStorage(BaseStorage):
+    """Store objects on local disk, backed by a remote storage"""
+
+    # both tiers are read through their own presence index
+    USE_OBJECT_CACHE = False
+
+    def __init__(self, config: str):
+        from god.storage.commons import get_backend  # avoid circular import
+
+        hot, cold, self._demote_days = parse_config(config)
+        self._hot = LocalStorage(hot)
+        self._cold = get_backend(cold)
+        self._tiered_dir = Path(self._hot._base_path, DIR_TIERED)
+        self._flusher: Union[threading.Thread, None] = None
+        self._flusher_lock = threading.Lock()
+        self._exiting = threading.Event()
+
+    @property
+    def _layout(self) -> Layout:
+        """The layout of the hot tier, the cold tier is re-laid out on its own"""
+        return self._hot._layout
+
+    def _reload_layout(self, max_age: float = 0) -> bool:
+        return self._hot._reload_layout(max_age)
+
+    def _layout_storages(self) -> List[BaseStorage]:
+        return [self._hot]
+
+    def _hash_path(
+        self, hash_value: str, prefix: str = "", layout: Union[Layout, None] = None
+    ) -> str:
+        """The path in the hot tier"""
+        return self._hot._hash_path(hash_value, prefix=prefix, layout=layout)
+
+    def _split(self, storage_path: str) -> Tuple[str, str]:
+        """Get the kind and the hash of a storage path"""
+        kind, *components = (
+            Path(storage_path).relative_to(self._hot._base_path).as_posix().split("/")
+        )
+        return kind, "".join(components)
+
+    def _group(self, storage_paths: List[str]) -> Dict[str, List[int]]:
+        """Group the indices of storage paths by kind of hash"""
+        groups = defaultdict(list)
+        for idx, storage_path in enumerate(storage_paths):
+            groups[self._split(storage_path)[0]].append(idx)
+        return groups
+
+    def _get(
+        self,
+        storage_paths: List[str],
+        paths: List[str],
+        progress_callback: Union[Callable, None] = None,
+        n_processes: Union[int, None] = None,
+        hash_values: Union[List[str], None] = None,
+    ):
+        """Get the files from the hot tier, fetching them from the cold tier if missing
+
+        Args:
+            storage_paths: the paths in the hot tier
+            paths: the file paths to copy to
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            n_processes: number of processes to get files from the cold tier
+            hash_values: the SHA-256 of each file to verify, None to skip verification
+        """
+        for kind, indices in self._group(storage_paths).items():
+            hashes = [self._split(storage_paths[idx])[1] for idx in indices]
+            exists = self._hot._have_hashes(hashes, prefix=kind)
+            missing = [idx for idx, each in zip(indices, exists) if not each]
+            if not missing:
+                continue
+
+            index = self._hot.presence(kind)
+            for idx in missing:
+                Path(storage_paths[idx]).parent.mkdir(parents=True, exist_ok=True)
+            missing_hashes = [self._split(storage_paths[idx])[1] for idx in missing]
+            self._cold._get(
+                storage_paths=[
+                    self._cold._hash_path(each, prefix=kind) for each in missing_hashes
+                ],
+                paths=[storage_paths[idx] for idx in missing],
+                n_processes=n_processes,
+                hash_values=(
+                    None
+                    if hash_values is None
+                    else [hash_values[idx] for idx in missing]
+                ),
+            )
+            if index is not None:
+                index.add(missing_hashes)
+
+        self._hot._get(
+            storage_paths=storage_paths,
+            paths=paths,
+            progress_callback=progress_callback,
+            hash_values=hash_values,
+        )
+        self._touch(storage_paths)
+
+    def _touch(self, storage_paths: List[str]):
+        """Record the read time as access time, keep the modified time"""
+        now = time.time()
+        for each in storage_paths:
+            try:
+                os.utime(each, (now, os.stat(each).st_mtime))
+            except FileNotFoundError:
+                continue
+
+    def _store(
+        self, storage_paths: List[str], paths: List[str], overwrite: bool = False
+    ):
+        """Store the files in the hot tier, and queue them for the cold tier
+
+        Args:
+            storage_paths: the paths in the hot tier
+            paths: the local files to store
+            overwrite: if False, skip storage paths that already exist
+        """
+        for kind, indices in self._group(storage_paths).items():
+            hashes = [self._split(storage_paths[idx])[1] for idx in indices]
+            self._hot._store_hashes([paths[idx] for idx in indices], hashes, kind)
+            self._queue(kind, hashes)
+
+    def _delete(self, storage_paths: List[str]) -> Dict[str, str]:
+        """Delete the files from both tiers
+
+        Args:
+            storage_paths: the paths in the hot tier
+
+        Returns:
+            The error message of each storage path that cannot be deleted
+        """
+        errors = {}
+        for kind, indices in self._group(storage_paths).items():
+            hashes = {self._split(storage_paths[idx])[1]: idx for idx in indices}
+            for tier in [self._hot, self._cold]:
+                for hash_value, message in tier._delete_hashes(
+                    list(hashes), prefix=kind
+                ).items():
+                    errors[storage_paths[hashes[hash_value]]] = message
+        return errors
+
+    def _have(self, storage_paths: List[str]) -> List[bool]:
+        result = [False] * len(storage_paths)
+        for kind, indices in self._group(storage_paths).items():
+            hashes = [self._split(storage_paths[idx])[1] for idx in indices]
+            for idx, exists in zip(indices, self._have_hashes(hashes, prefix=kind)):
+                result[idx] = exists
+        return result
+
+    def _have_hashes(self, hash_values: List[str], prefix: str) -> List[bool]:
+        """Check the hot tier, then the cold tier for the rest"""
+        result = self._hot._have_hashes(hash_values, prefix=prefix)
+        missing = [idx for idx, exists in enumerate(result) if not exists]
+        if missing:
+            exists = self._cold._have_hashes(
+                [hash_values[idx] for idx in missing], prefix=prefix
+            )
+            for idx, each in zip(missing, exists):
+                result[idx] = each
+        return result
+
+    def _scan(
+        self, storage_prefix: str, shard: str = ""
+    ) -> Iterator[Tuple[str, int, float]]:
+        """Iterate over the files of both tiers, each file once"""
+        kind = Path(storage_prefix).relative_to(self._hot._base_path).as_posix()
+        seen = set()
+        for name, size, mtime in self._hot._scan(storage_prefix, shard):
+            seen.add(name.replace("/", ""))
+            yield name, size, mtime
+        cold_prefix = self._cold._hash_path("", prefix=kind)
+        for name, size, mtime in self._cold._scan(cold_prefix, shard):
+            if name.replace("/", "") not in seen:
+                yield name, size, mtime
+
+    def _queue(self, kind: str, hash_values: List[str]):
+        """Record that the hashes should be copied to the cold tier"""
+        if not hash_values:
+            return
+        with FileLock(self._tiered_dir / f"{FILE_PENDING}.lock"):
+            with (self._tiered_dir / FILE_PENDING).open("a") as fo:
+                fo.write("".join(f"{kind} {each}\n" for each in hash_values))
+        self._start_flusher()
+
+    def _start_flusher(self):
+        """Flush the queue in a background thread, if not already flushing
+
+        The queues left by earlier processes are flushed too. The thread is joined at
+        exit, for at most FLUSH_EXIT_TIMEOUT seconds.
+        """
+        with self._flusher_lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            if self._flusher is None:
+                atexit.register(self._join_at_exit)
+            self._flusher = threading.Thread(target=self._background, daemon=True)
+            self._flusher.start()
+
+    def _join_at_exit(self, timeout: Union[float, None] = None):
+        """Wait for the flush to finish, skipping the demotion that may follow
+
+        Args:
+            timeout: the seconds to wait, default to FLUSH_EXIT_TIMEOUT
+        """
+        self._exiting.set()
+        with self._flusher_lock:
+            flusher = self._flusher
+        if flusher is not None:
+            flusher.join(FLUSH_EXIT_TIMEOUT if timeout is None else timeout)
+
+    def _background(self):
+        while self.flush():
+            continue
+        demoted_file = self._tiered_dir / FILE_DEMOTED
+        if not self._exiting.is_set() and (
+            not demoted_file.exists()
+            or time.time() - demoted_file.stat().st_mtime > DEMOTE_INTERVAL
+        ):
+            demoted_file.touch()
+            self.demote(self._demote_days)
+
+    def wait(self):
+        """Wait for the background thread to flush the queue"""
+        with self._flusher_lock:
+            flusher = self._flusher
+        if flusher is not None:
+            flusher.join()
+
+    def flush(self) -> int:
+        """Copy the queued hashes to the cold tier
+
+        The queue is renamed before flushing, so that other processes keep queueing
+        into a new file. Queues left by interrupted flushes are flushed again, copying
+        a hash twice is harmless.
+
+        Returns:
+            The number of hashes copied
+        """
+        with FileLock(self._tiered_dir / f"{FILE_PENDING}.lock"):
+            pending = self._tiered_dir / FILE_PENDING
+            if pending.exists():
+                pending.rename(
+                    self._tiered_dir
+                    / f"{FILE_PENDING}.{time.time_ns():020d}-{uuid.uuid4().hex}"
+                )
+
+        n_flushed = 0
+        for queue_file in sorted(self._tiered_dir.glob(f"{FILE_PENDING}.*-*")):
+            groups = defaultdict(set)
+            try:
+                with queue_file.open("r") as fi:
+                    for line in fi:
+                        kind, _, hash_value = line.strip().partition(" ")
+                        if hash_value:
+                            groups[kind].add(hash_value)
+            except FileNotFoundError:
+                # flushed by another process
+                continue
+
+            for kind, hash_values in groups.items():
+                hash_values = sorted(hash_values)
+                paths = [
+                    self._hot._hash_path(each, prefix=kind) for each in hash_values
+                ]
+                # hashes deleted since they were queued are not copied
+                exists = [os.path.exists(each) for each in paths]
+                hash_values = [each for each, ok in zip(hash_values, exists) if ok]
+                paths = [each for each, ok in zip(paths, exists) if ok]
+                if not hash_values:
+                    continue
+                self._cold._store_hashes(paths, hash_values, prefix=kind)
+                n_flushed += len(hash_values)
+
+            try:
+                queue_file.unlink()
+            except FileNotFoundError:
+                pass
+
+        return n_flushed
+
+    def demote(self, days: Union[float, None] = None) -> int:
+        """Remove the objects not read for `days` days from the hot tier
+
+        The queue is flushed first, and only objects that the cold tier has are
+        removed.
+
+        Args:
+            days: the days without read, default to the `demote_days` of the config
+
+        Returns:
+            The number of objects removed from the hot tier
+        """
+        self.flush()
+        days = self._demote_days if days is None else days
+        cutoff = time.time() - days * 24 * 60 * 60
+        prefix = self._hot._hash_path("", prefix=self.OBJECTS_PREFIX)
+
+        candidates = []
+        for name, _, _ in self._hot._scan_hashes(prefix):
+            try:
+                if os.stat(Path(prefix, name)).st_atime < cutoff:
+                    candidates.append(name.replace("/", ""))
+            except FileNotFoundError:
+                continue
+        if not candidates:
+            return 0
+
+        exists = self._cold._have_hashes(candidates, prefix=self.OBJECTS_PREFIX)
+        demoted = [each for each, ok in zip(candidates, exists) if ok]
+        errors = self._hot._delete_hashes(demoted, prefix=self.OBJECTS_PREFIX)
+        return len(demoted) - len(errors)
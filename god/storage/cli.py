@@ -18,11 +18,21 @@ def main(ctx):
 @click.argument("path")
 @click.pass_context
 def migrate_cmd(ctx, path):
+    """Copy all objects, dirs and commits to storage at PATH, resumable"""
+    from pathlib import Path
+
+    from god.core.common import get_base_dir
     from god.storage.migrate import migrate
+    from god.utils.common import get_string_hash
+    from god.utils.constants import DIR_CACHE
 
     new_storage = get_backend(path)
     old_storage = ctx.obj["type"]
-    migrate(old_storage, new_storage)
+    checkpoint_file = Path(
+        get_base_dir(), DIR_CACHE, "migrate", f"{get_string_hash(path)}.json"
+    )
+    n_migrated = migrate(old_storage, new_storage, checkpoint_file=checkpoint_file)
+    print(f"Migrated {n_migrated} files")
 
 
 @main.command("use")
@@ -40,6 +50,97 @@ def use(config):
         yaml.dump(data, fo)
 
 
+@main.command("rebuild-index")
+@click.pass_context
+def rebuild_index(ctx):
+    """Rebuild the presence index of the storage from a full listing"""
+    storage = ctx.obj["type"]
+    for prefix in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        print(f"{prefix}: {storage.rebuild_index(prefix)}")
+
+
+@main.command("clean-cache")
+@click.option("--size", default=0, help="Keep this many bytes of recently used objects")
+def clean_cache(size):
+    """Evict objects from the user object cache, shared by all repos"""
+    from god.cache.objects import get_object_cache
+
+    cache = get_object_cache()
+    if cache is None:
+        print("The object cache is turned off")
+        return
+    print(f"Evicted {cache.evict(size)} objects, {cache.size()} bytes remain")
+
+
+@main.command("flush")
+@click.pass_context
+def flush(ctx):
+    """Copy the hashes queued in the hot tier to the cold tier of a tiered storage"""
+    storage = ctx.obj["type"]
+    if not hasattr(storage, "flush"):
+        print("The storage is not tiered")
+        return
+    print(f"Flushed {storage.flush()} files")
+
+
+@main.command("demote")
+@click.option("--days", type=float, default=None, help="Days without read")
+@click.pass_context
+def demote(ctx, days):
+    """Remove objects not read recently from the hot tier of a tiered storage"""
+    storage = ctx.obj["type"]
+    if not hasattr(storage, "demote"):
+        print("The storage is not tiered")
+        return
+    print(f"Demoted {storage.demote(days)} objects")
+
+
+@main.command("rebalance")
+@click.pass_context
+def rebalance(ctx):
+    """Move the hashes of a striped storage to the roots that own them"""
+    storage = ctx.obj["type"]
+    if not hasattr(storage, "rebalance"):
+        print("The storage is not striped")
+        return
+    print(f"Moved {storage.rebalance()} files")
+
+
+@main.command("relayout")
+@click.option("--depth", type=int, required=True, help="Number of directory levels")
+@click.option("--width", type=int, required=True, help="Hex characters per directory")
+@click.pass_context
+def relayout_cmd(ctx, depth, width):
+    """Move the hashes of the storage to a new fan-out layout"""
+    from god.storage.layout import relayout
+
+    print(f"Moved {relayout(ctx.obj['type'], depth, width)} files")
+
+
+@main.command("build-manifest")
+@click.argument("path", required=False)
+@click.pass_context
+def build_manifest_cmd(ctx, path):
+    """Rebuild the hash manifests of a remote storage from its full listing"""
+    from god.storage.manifest import build_manifest
+
+    storage = get_backend(path) if path else ctx.obj["type"]
+    for kind, count in build_manifest(storage).items():
+        print(f"{kind}: {count}")
+
+
+@main.command("compact-manifest")
+@click.argument("path", required=False)
+@click.pass_context
+def compact_manifest_cmd(ctx, path):
+    """Merge the manifest segments of a remote storage"""
+    from god.storage.manifest import compact_manifest
+
+    storage = get_backend(path) if path else ctx.obj["type"]
+    for kind in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        print(f"{kind}: {compact_manifest(storage, kind)} segments removed")
+
+
 @main.command("get-objects")
 @click.option(
     "--files",
@@ -50,7 +151,10 @@ def use(config):
 )
 @click.pass_context
 def get_objects(ctx, files):
+    from god.storage.promisor import fetch_missing_objects
+
     file_path, file_hash = zip(*json.loads(files))
+    fetch_missing_objects(ctx.obj["type"], list(file_hash))
     ctx.obj["type"].get_objects(file_hash, file_path)
 
 
@@ -83,6 +187,22 @@ def have_objects(ctx, files):
     print(json.dumps(result))
 
 
+@main.command("delete-objects")
+@click.option(
+    "--files",
+    type=str_stdin_option,
+    default=sys.stdin,
+    required=True,
+    help="JSON format [hash1, hash2...]",
+)
+@click.option("--dry-run", is_flag=True, default=False, help="Do not delete anything")
+@click.pass_context
+def delete_objects(ctx, files, dry_run):
+    """Delete objects, print the hashes that cannot be deleted with their errors"""
+    result = ctx.obj["type"].delete_objects(json.loads(files), dry_run=dry_run)
+    print(json.dumps(result))
+
+
 @main.command("get-dirs")
 @click.option(
     "--files",
@@ -126,6 +246,22 @@ def have_dirs(ctx, files):
     print(json.dumps(result))
 
 
+@main.command("delete-dirs")
+@click.option(
+    "--files",
+    type=str_stdin_option,
+    default=sys.stdin,
+    required=True,
+    help="JSON format [hash1, hash2...]",
+)
+@click.option("--dry-run", is_flag=True, default=False, help="Do not delete anything")
+@click.pass_context
+def delete_dirs(ctx, files, dry_run):
+    """Delete dirs, print the hashes that cannot be deleted with their errors"""
+    result = ctx.obj["type"].delete_dirs(json.loads(files), dry_run=dry_run)
+    print(json.dumps(result))
+
+
 @main.command("get-commits")
 @click.option(
     "--files",
@@ -169,5 +305,21 @@ def have_commits(ctx, files):
     print(json.dumps(result))
 
 
+@main.command("delete-commits")
+@click.option(
+    "--files",
+    type=str_stdin_option,
+    default=sys.stdin,
+    required=True,
+    help="JSON format [hash1, hash2...]",
+)
+@click.option("--dry-run", is_flag=True, default=False, help="Do not delete anything")
+@click.pass_context
+def delete_commits(ctx, files, dry_run):
+    """Delete commits, print the hashes that cannot be deleted with their errors"""
+    result = ctx.obj["type"].delete_commits(json.loads(files), dry_run=dry_run)
+    print(json.dumps(result))
+
+
 if __name__ == "__main__":
     main()
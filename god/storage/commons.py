@@ -2,12 +2,24 @@ import yaml
 
 from god.remote import get_remote_declaration_config_path
 from god.storage.backends.base import BaseStorage
+from god.storage.backends.http import HTTPStorage
 from god.storage.backends.local import LocalStorage
 from god.storage.backends.s3 import S3Storage
+from god.storage.backends.smart import SmartHTTPStorage
+from god.storage.backends.ssh import SSHStorage
+from god.storage.backends.striped import StripedStorage
+from god.storage.backends.tiered import TieredStorage
 
 STORAGE = {
     "file": LocalStorage,
+    "god+http": SmartHTTPStorage,
+    "god+https": SmartHTTPStorage,
+    "http": HTTPStorage,
+    "https": HTTPStorage,
     "s3": S3Storage,
+    "ssh": SSHStorage,
+    "striped": StripedStorage,
+    "tiered": TieredStorage,
 }
 
 
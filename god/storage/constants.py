@@ -1,3 +1,15 @@
+import os
+from pathlib import Path
+
 DIR_OBJECTS = "objects"
 DIR_DIRS = "dirs"
 DIR_COMMITS = "commits"
+DIR_PRESENCE = "presence"
+# downloads that do not match their hash, kept inside DIR_USER_CACHE for inspection
+DIR_QUARANTINE = "quarantine"
+# machine-wide cache, shared by all repos of the user
+DIR_USER_CACHE = str(
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"), "god")
+)
+# garbage collection keeps unreachable hashes modified within this many days
+GRACE_DAYS = 14
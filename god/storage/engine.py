@@ -0,0 +1,365 @@
+"""Transfer engine shared by remote storages
+
+Every get, store and existence check of a remote storage runs as a job of the
+engine. The engine runs an asyncio event loop in a background thread, which
+schedules the blocking jobs onto worker threads:
+
+    - Concurrency follows AIMD: it grows by 1 every `limit` successful jobs, and is
+        halved when the storage throttles (e.g. S3 `SlowDown`) or when the latency
+        per MB of a class of jobs (priority and size) rises well above the lowest
+        latency of its recent jobs. That lowest latency restarts from the average
+        after each decrease, so a lasting shift of latency that does not come from
+        congestion halves the limit once, rather than down to the minimum.
+        Throttled jobs are retried with exponential backoff.
+    - Bandwidth is capped globally with a token bucket, set by the environment
+        variable `GOD_MAX_BANDWIDTH` (bytes per second).
+    - Jobs of a higher priority class (refs and commits, then dirs, then objects)
+        take the next free slot first.
+    - Progress of a batch is aggregated into 1 callback.
+
+Jobs must not submit other jobs to the engine and wait for them, since they would
+wait for slots that they themselves hold.
+"""
+import asyncio
+import bisect
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+PRIORITY_COMMITS = 0
+PRIORITY_DIRS = 1
+PRIORITY_OBJECTS = 2
+# the priority class of each storage prefix, other prefixes are PRIORITY_OBJECTS
+PRIORITIES = {
+    "refs": PRIORITY_COMMITS,
+    "commits": PRIORITY_COMMITS,
+    "manifests": PRIORITY_COMMITS,
+    "dirs": PRIORITY_DIRS,
+}
+
+INITIAL_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 128
+# the latency per MB that is this many times the lowest one means congestion
+LATENCY_FACTOR = 3.0
+# weight of the latest job in the latency moving average
+LATENCY_WEIGHT = 0.1
+LATENCY_UNIT = 1024 * 1024
+# the lowest latency of a class is taken over its last 1 to 2 windows of this many
+# jobs, so it follows a lasting change of the storage or the network
+LATENCY_WINDOW = 100
+# the upper bounds in bytes of the job size classes, larger jobs are the last class
+SIZE_CLASSES = [64 * 1024, 8 * 1024 * 1024]
+MAX_RETRIES = 8
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 20.0
+
+
+class _LatencyStats:
+    """The moving average and the recent lowest latency of a class of jobs"""
+
+    def __init__(self):
+        self.average: Union[float, None] = None
+        self._lowest: Union[float, None] = None  # of the current window
+        self._previous: Union[float, None] = None  # of the previous window
+        self._count = 0
+
+    def add(self, latency: float):
+        if self.average is None:
+            self.average = latency
+        else:
+            self.average += LATENCY_WEIGHT * (latency - self.average)
+        if self._lowest is None or self.average < self._lowest:
+            self._lowest = self.average
+        self._count += 1
+        if self._count >= LATENCY_WINDOW:
+            self._previous, self._lowest, self._count = self._lowest, None, 0
+
+    @property
+    def congested(self) -> bool:
+        """Whether the average is well above the recent lowest latency"""
+        lowest = min(
+            each
+            for each in [self._lowest, self._previous, self.average]
+            if each is not None
+        )
+        return self.average > LATENCY_FACTOR * lowest
+
+    def rebase(self):
+        """Forget the lowest latency, the average becomes the reference"""
+        self._previous, self._lowest, self._count = None, self.average, 0
+
+
+class AIMDLimiter:
+    """Adaptive concurrency limit, handing free slots out by priority
+
+    Only used from the event loop thread.
+    """
+
+    def __init__(
+        self,
+        initial: int = INITIAL_CONCURRENCY,
+        minimum: int = MIN_CONCURRENCY,
+        maximum: int = MAX_CONCURRENCY,
+    ):
+        self.limit = float(initial)
+        self._minimum = minimum
+        self._maximum = maximum
+        self._in_flight = 0
+        self._waiters: List = []
+        self._counter = itertools.count()
+        self._latency = None
+        self._stats: Dict[Tuple[int, int], _LatencyStats] = {}
+        self._last_decrease = 0.0
+
+    async def acquire(self, priority: int):
+        """Wait for a free slot"""
+        if self._in_flight < int(self.limit) and not self._waiters:
+            self._in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # cancelled after being handed a slot
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Free a slot, and hand the free slots to the waiters of highest priority"""
+        self._in_flight -= 1
+        while self._waiters and self._in_flight < int(self.limit):
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.cancelled():
+                self._in_flight += 1
+                future.set_result(None)
+
+    def on_success(
+        self, latency: float, n_bytes: int, priority: int = PRIORITY_OBJECTS
+    ):
+        """Additive increase, or decrease if the latency shows congestion
+
+        Args:
+            latency: the seconds that the job took
+            n_bytes: the bytes that the job transferred
+            priority: the priority class of the job, jobs are compared with the jobs
+                of the same priority and size class
+        """
+        key = (priority, bisect.bisect_left(SIZE_CLASSES, n_bytes))
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _LatencyStats()
+        stats.add(latency / (1 + n_bytes / LATENCY_UNIT))
+        self._latency = stats.average
+
+        if stats.congested and self._decrease():
+            stats.rebase()
+        else:
+            self.limit = min(self._maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self):
+        """Multiplicative decrease"""
+        self._decrease()
+
+    def _decrease(self) -> bool:
+        """Halve the limit, at most once per the current latency
+
+        Returns:
+            True if the limit is halved, False if it was halved too recently
+        """
+        now = time.monotonic()
+        if now - self._last_decrease < (self._latency or 0):
+            return False
+        self._last_decrease = now
+        self.limit = max(self._minimum, self.limit / 2)
+        return True
+
+
+class TokenBucket:
+    """Bandwidth cap shared by all jobs, thread-safe
+
+    Args:
+        rate: the cap in bytes per second, None for no cap
+    """
+
+    def __init__(self, rate: Union[float, None] = None):
+        self._rate = rate
+        self._tokens = rate or 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n_bytes: int) -> float:
+        """Take `n_bytes` tokens, possibly going into debt
+
+        Returns:
+            The seconds to wait until the debt is paid
+        """
+        if not self._rate or not n_bytes:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._rate, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._tokens -= n_bytes
+            return max(0.0, -self._tokens / self._rate)
+
+
+class _Progress:
+    """Aggregate the progress of all jobs of a batch, thread-safe"""
+
+    def __init__(self, callback: Union[Callable, None]):
+        self._callback = callback
+        self._lock = threading.Lock()
+        self.total_files = 0
+        self.total_bytes = 0
+
+    def add(self, n_files: int = 0, n_bytes: int = 0):
+        with self._lock:
+            self.total_files += n_files
+            self.total_bytes += n_bytes
+            if self._callback:
+                self._callback(
+                    total_files=self.total_files, total_bytes=self.total_bytes
+                )
+
+    def finish(self):
+        if self._callback:
+            self._callback(None, None)
+
+
+class TransferEngine:
+    """Run blocking transfer jobs with adaptive concurrency and rate limiting
+
+    Args:
+        bandwidth: the bandwidth cap in bytes per second, None for no cap
+    """
+
+    def __init__(self, bandwidth: Union[float, None] = None):
+        self._limiter = AIMDLimiter()
+        self._bucket = TokenBucket(bandwidth)
+        self._executor = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENCY, thread_name_prefix="god-transfer"
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def concurrency(self) -> float:
+        """The current concurrency limit"""
+        return self._limiter.limit
+
+    def map(
+        self,
+        fn: Callable[[Any, Callable[[int], None]], Any],
+        items: List[Any],
+        priority: int = PRIORITY_OBJECTS,
+        sizes: Union[List[int], None] = None,
+        progress_callback: Union[Callable, None] = None,
+        is_throttle: Union[Callable[[Exception], bool], None] = None,
+    ) -> List[Any]:
+        """Run `fn` on every item, block until all finish
+
+        Args:
+            fn: the job, called with the item and a callback that takes the number of
+                bytes just transferred
+            items: the items to run `fn` on
+            priority: the priority class of the jobs, lower runs first
+            sizes: the expected bytes of each job, to pace the bandwidth before the
+                job starts. Bytes reported by the job are paced after.
+            progress_callback: it is passed total_files (int) and total_bytes (int)
+            is_throttle: tell if an exception means the storage throttles, then the
+                job is retried
+
+        Returns:
+            The results of `fn`, in the order of `items`
+        """
+        if not items:
+            return []
+        future = asyncio.run_coroutine_threadsafe(
+            self._map(fn, items, priority, sizes, progress_callback, is_throttle),
+            self._loop,
+        )
+        return future.result()
+
+    async def _map(self, fn, items, priority, sizes, progress_callback, is_throttle):
+        progress = _Progress(progress_callback)
+        sizes = sizes or [0] * len(items)
+        tasks = [
+            asyncio.ensure_future(
+                self._run(fn, item, size, priority, progress, is_throttle)
+            )
+            for item, size in zip(items, sizes)
+        ]
+        try:
+            return await asyncio.gather(*tasks)
+        finally:
+            # when a job fails, stop the others and wait until they free their slots
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            progress.finish()
+
+    async def _run(self, fn, item, size, priority, progress, is_throttle):
+        """Run 1 job in a slot, retry it if throttled"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RETRIES + 1):
+            await self._limiter.acquire(priority)
+            n_bytes = [0]
+
+            def on_bytes(amount):
+                n_bytes[0] += amount
+                progress.add(n_bytes=amount)
+                if not size:
+                    time.sleep(self._bucket.reserve(amount))
+
+            error = None
+            try:
+                await asyncio.sleep(self._bucket.reserve(size))
+                start = time.monotonic()
+                job = loop.run_in_executor(self._executor, fn, item, on_bytes)
+                try:
+                    result = await asyncio.shield(job)
+                except asyncio.CancelledError:
+                    # the thread cannot be stopped, hold the slot until it finishes
+                    await asyncio.wait([job])
+                    raise
+            except Exception as e:
+                error = e
+            finally:
+                self._limiter.release()
+
+            if error is None:
+                self._limiter.on_success(
+                    time.monotonic() - start, n_bytes[0] or size, priority
+                )
+                progress.add(n_files=1)
+                return result
+            if is_throttle is None or not is_throttle(error) or attempt == MAX_RETRIES:
+                raise error
+            self._limiter.on_throttle()
+            backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)
+            await asyncio.sleep(random.uniform(0, backoff))
+
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine() -> TransferEngine:
+    """Get the transfer engine of the process, shared by all storages"""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            bandwidth = os.environ.get("GOD_MAX_BANDWIDTH")
+            _ENGINE = TransferEngine(bandwidth=float(bandwidth) if bandwidth else None)
+        return _ENGINE
@@ -0,0 +1,105 @@
+"""On-disk journal of a transfer operation (push, fetch, clone)
+
+The journal is a JSON-lines file inside `.god/transfers`. It records the plan of the
+operation, and the hashes that started and finished transferring, a batch at a
+time. When an interrupted operation is run again, it reuses the plan instead of
+asking the storages again, skips the finished hashes, and cleans up the partial
+files of the hashes that were in flight.
+"""
+import json
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Set, Union
+
+
+class TransferJournal:
+    """Journal of a transfer operation
+
+    Args:
+        journal_dir: the directory that contains transfer journals
+        name: the name of the operation, an interrupted operation is resumed by
+            opening the journal with the same name
+    """
+
+    def __init__(self, journal_dir: Union[str, Path], name: str):
+        self._path = Path(journal_dir, name)
+        self._lock = threading.Lock()
+        self._plan: Union[Dict, None] = None
+        self._started: Dict[str, Set[str]] = defaultdict(set)
+        self._done: Dict[str, Set[str]] = defaultdict(set)
+
+        self.resumed = self._path.exists()
+        if self.resumed:
+            self._load()
+
+    def _load(self):
+        """Read the records of the interrupted operation"""
+        with self._path.open("r") as fi:
+            for line in fi:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last record was cut by the interruption
+                    break
+                if "plan" in record:
+                    self._plan = record["plan"]
+                elif "started" in record:
+                    self._started[record["started"]].update(record["items"])
+                elif "done" in record:
+                    self._done[record["done"]].update(record["items"])
+
+    def _append(self, record: Dict):
+        """Durably append a record"""
+        with self._lock:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with self._path.open("a") as fo:
+                fo.write(json.dumps(record) + "\n")
+                fo.flush()
+                os.fsync(fo.fileno())
+
+    def get_plan(self) -> Union[Dict, None]:
+        """Get the recorded plan, None if the plan has not been recorded"""
+        return self._plan
+
+    def set_plan(self, plan: Dict):
+        """Record the plan of the operation, e.g. the hashes to transfer"""
+        self._plan = plan
+        self._append({"plan": plan})
+
+    def pending(self, kind: str, hash_values: List[str]) -> List[str]:
+        """Get the hashes that have not finished transferring
+
+        Args:
+            kind: the kind of hashes (objects, dirs or commits)
+            hash_values: the hashes to check
+
+        Returns:
+            The hashes of `hash_values` that are not done
+        """
+        done = self._done[kind]
+        return [each for each in hash_values if each not in done]
+
+    def in_flight(self, kind: str) -> List[str]:
+        """Get the hashes that started but did not finish transferring"""
+        return sorted(self._started[kind].difference(self._done[kind]))
+
+    def finished(self, kind: str) -> List[str]:
+        """Get the hashes that finished transferring"""
+        return sorted(self._done[kind])
+
+    def start(self, kind: str, hash_values: List[str]):
+        """Record that the hashes start transferring"""
+        self._started[kind].update(hash_values)
+        self._append({"started": kind, "items": hash_values})
+
+    def done(self, kind: str, hash_values: List[str]):
+        """Record that the hashes finished transferring"""
+        self._done[kind].update(hash_values)
+        self._append({"done": kind, "items": hash_values})
+
+    def close(self):
+        """The operation finishes, remove the journal"""
+        if self._path.exists():
+            self._path.unlink()
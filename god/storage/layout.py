@@ -0,0 +1,177 @@
+"""Fan-out layout of the hash paths inside a storage
+
+A hash is stored at `<prefix>/<c1>/<c2>/.../<rest>`, where there are `depth`
+components of `width` hex characters each, e.g. depth 2 and width 2 (the default)
+store `abcdef...` at `ab/cd/ef...`. The layout of a storage is recorded in its
+`layout.json`. Storages without `layout.json` use the default layout.
+
+`relayout` changes the layout of a storage in place, while the storage stays in use:
+it records the new layout along with the previous one, moves the hashes batch by
+batch, then drops the previous layout. Until then, hashes that are not at their new
+path are read from their path in the previous layout.
+
+Processes that are already running pick up the new layout by themselves: they read
+it again when a hash is missing at its path, and before storing hashes at most every
+`LAYOUT_RELOAD_INTERVAL` seconds. `relayout` keeps moving hashes until a pass that
+starts that long after the new layout was recorded has nothing to move, so hashes
+stored at the previous paths meanwhile are moved too. A single store that runs
+longer than that, e.g. a large upload started before the re-layout, can still land
+at the previous paths; run `relayout` again with the same layout to move them.
+"""
+import json
+import posixpath
+import time
+from typing import Dict, List, Union
+
+DEFAULT_DEPTH = 2
+DEFAULT_WIDTH = 2
+LAYOUT_FILE = "layout.json"
+# number of hashes to move at a time
+RELAYOUT_BATCH_SIZE = 1000
+# seconds a process may use the layout it read before reading it again
+LAYOUT_RELOAD_INTERVAL = 10
+
+
+class Layout:
+    """Fan-out layout of hash paths
+
+    Args:
+        depth: the number of directory levels
+        width: the number of hex characters of each directory name
+        previous: the layout the storage is being moved from, if any
+    """
+
+    def __init__(
+        self,
+        depth: int = DEFAULT_DEPTH,
+        width: int = DEFAULT_WIDTH,
+        previous: Union["Layout", None] = None,
+    ):
+        if depth < 0 or width < 1:
+            raise ValueError(f"Invalid layout depth {depth}, width {width}")
+        self.depth = depth
+        self.width = width
+        self.previous = previous
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, Layout)
+            and self.depth == other.depth
+            and self.width == other.width
+        )
+
+    def __repr__(self) -> str:
+        return f"Layout(depth={self.depth}, width={self.width})"
+
+    def split(self, hash_value: str) -> List[str]:
+        """Split a hash into its path components"""
+        end = self.depth * self.width
+        components = [
+            hash_value[idx : idx + self.width] for idx in range(0, end, self.width)
+        ]
+        return components + [hash_value[end:]]
+
+    def shards(self) -> List[str]:
+        """The top-level directory names, including those of the previous layout"""
+        if self.depth == 0 or (self.previous is not None and self.previous.depth == 0):
+            return [""]
+        shards = [f"{idx:0{self.width}x}" for idx in range(16**self.width)]
+        if self.previous is not None and self.previous.width != self.width:
+            shards += self.previous.shards()
+        return shards
+
+    def to_dict(self) -> Dict:
+        result = {"depth": self.depth, "width": self.width}
+        if self.previous is not None:
+            result["previous"] = self.previous.to_dict()
+        return result
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Layout":
+        previous = data.get("previous")
+        return cls(
+            depth=data["depth"],
+            width=data["width"],
+            previous=None if previous is None else cls.from_dict(previous),
+        )
+
+    def dumps(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def loads(cls, content: str) -> "Layout":
+        return cls.from_dict(json.loads(content))
+
+
+def relayout(storage, depth: int, width: int) -> int:
+    """Move every hash of `storage` to its path in a new layout
+
+    An interrupted re-layout is continued by running it again with the same layout.
+    Storages made of other storages re-lay out each of their parts.
+
+    Args:
+        storage: the storage (BaseStorage)
+        depth: the new number of directory levels
+        width: the new number of hex characters of each directory name
+
+    Returns:
+        The number of hashes moved
+    """
+    return sum(_relayout(each, depth, width) for each in storage._layout_storages())
+
+
+def _relayout(storage, depth: int, width: int) -> int:
+    """Re-lay out a storage that records its own layout"""
+    storage._reload_layout()
+    current = storage._layout
+    target = Layout(depth=depth, width=width)
+    if current.previous is not None and current != target:
+        raise RuntimeError(
+            f"The storage is being re-laid out from {current.previous} to {current}, "
+            f"continue it before changing to {target}"
+        )
+    if current.previous is None and current == target:
+        return 0
+
+    target.previous = current.previous or current
+    storage._write_layout(target)
+    # processes that read the layout before it changed store at the previous paths
+    # until they read it again, so keep moving until a pass that starts after they
+    # all did finds nothing to move
+    settled_at = time.monotonic() + LAYOUT_RELOAD_INTERVAL
+
+    n_moved = 0
+    while True:
+        final = time.monotonic() >= settled_at
+        moved = _move_hashes(storage)
+        n_moved += moved
+        if final and not moved:
+            break
+        if not moved:
+            time.sleep(max(0, settled_at - time.monotonic()))
+
+    storage._write_layout(Layout(depth=depth, width=width))
+    return n_moved
+
+
+def _move_hashes(storage) -> int:
+    """Move the hashes that are not at their path in the storage's layout"""
+    n_moved = 0
+    for kind in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        storage_prefix = storage._hash_path("", prefix=kind)
+        sources, targets = [], []
+        for name, _, _ in storage._scan_hashes(storage_prefix):
+            source = posixpath.join(storage_prefix, name)
+            destination = storage._hash_path(name.replace("/", ""), prefix=kind)
+            if source == destination:
+                continue
+            sources.append(source)
+            targets.append(destination)
+            if len(sources) >= RELAYOUT_BATCH_SIZE:
+                storage._move(sources, targets)
+                n_moved += len(sources)
+                sources, targets = [], []
+        if sources:
+            storage._move(sources, targets)
+            n_moved += len(sources)
+    return n_moved
@@ -0,0 +1,286 @@
+"""Manifests of the hashes that a remote storage holds
+
+Each push appends, for each kind of hash, 1 segment file per manifest shard into
+`manifests/<kind>/<shard>/`. Segments are never modified: their names are unique
+and sort by creation time, so concurrent pushers never conflict. A segment line is
+either a hash that was added or "-" and a hash that was removed.
+
+A client syncs the manifest into the storage's presence index, downloading only the
+segments it has not seen, then answers existence checks locally. When the manifest
+is complete (marked by `manifests/<kind>.complete`, written when the manifest is
+built from a full listing or when the storage was empty), hashes missing from the
+manifest are known to be absent without asking the storage.
+
+Compaction merges the segments of a shard into 1 segment, then deletes the merged
+segments. The merged segment sorts right after the last merged segment, so that it
+is applied in the same order as the segments it replaces.
+"""
+import json
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+from god.storage.backends.base import BaseStorage, RemoteRefsMixin
+
+MANIFESTS_PREFIX = "manifests"
+# number of leading hex characters of a hash that decide its manifest shard
+SHARD_LENGTH = 1
+# compact a shard when it has more than this many segments
+MAX_SEGMENTS = 64
+
+
+def _supported(storage: BaseStorage) -> bool:
+    """Manifests are kept by shared remote storages that have a presence index"""
+    return (
+        isinstance(storage, RemoteRefsMixin)
+        and not storage.PRESENCE_EXCLUSIVE
+        and storage._presence_dir() is not None
+    )
+
+
+def _kind_prefix(storage, kind: str) -> str:
+    """The storage prefix of all segments of a kind, ends with "/" """
+    return storage._ref_path(f"{kind}/", prefix=MANIFESTS_PREFIX)
+
+
+def _complete_path(storage, kind: str) -> str:
+    return storage._ref_path(f"{kind}.complete", prefix=MANIFESTS_PREFIX)
+
+
+def _seen_file(storage: BaseStorage, kind: str) -> Path:
+    """The local file that records the segments already applied to presence index"""
+    return Path(storage._presence_dir(), MANIFESTS_PREFIX, f"{kind}.json")
+
+
+def list_segments(storage: BaseStorage, kind: str) -> List[str]:
+    """List the segments of a kind, in the order they should be applied
+
+    Args:
+        storage: the remote storage
+        kind: the kind of hashes (objects, dirs or commits)
+
+    Returns:
+        The segments, as "<shard>/<name>"
+    """
+    segments = [name for name, _, _ in storage._scan(_kind_prefix(storage, kind))]
+    return sorted(segments, key=lambda each: each.split("/")[-1])
+
+
+def read_segments(
+    storage: BaseStorage, kind: str, segments: List[str]
+) -> Tuple[Set[str], Set[str]]:
+    """Read segments, later segments take precedence
+
+    Args:
+        storage: the remote storage
+        kind: the kind of hashes (objects, dirs or commits)
+        segments: the segments to read, in the order to apply them
+
+    Returns:
+        The hashes added
+        The hashes removed
+    """
+    added, removed = set(), set()
+    if not segments:
+        return added, removed
+
+    prefix = _kind_prefix(storage, kind)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = [str(Path(temp_dir, str(idx))) for idx in range(len(segments))]
+        storage._get(storage_paths=[prefix + each for each in segments], paths=paths)
+        for path in paths:
+            with open(path, "r") as fi:
+                for line in fi.read().splitlines():
+                    if line.startswith("-"):
+                        added.discard(line[1:])
+                        removed.add(line[1:])
+                    elif line:
+                        removed.discard(line)
+                        added.add(line)
+
+    return added, removed
+
+
+def _write_segments(
+    storage: BaseStorage, kind: str, lines: Dict[str, List[str]], names: Dict[str, str]
+):
+    """Upload 1 segment per shard
+
+    Args:
+        storage: the remote storage
+        kind: the kind of hashes (objects, dirs or commits)
+        lines: the segment lines of each shard
+        names: the segment name of each shard
+    """
+    prefix = _kind_prefix(storage, kind)
+    storage_paths, paths = [], []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for shard, shard_lines in lines.items():
+            path = Path(temp_dir, shard)
+            path.write_text("\n".join(shard_lines) + "\n")
+            storage_paths.append(f"{prefix}{shard}/{names[shard]}")
+            paths.append(str(path))
+        storage._store(storage_paths=storage_paths, paths=paths)
+
+
+def append_manifest(
+    storage: BaseStorage,
+    kind: str,
+    added: Iterable[str] = (),
+    removed: Iterable[str] = (),
+):
+    """Append a segment to each manifest shard that the hashes belong to
+
+    Call this after the hashes are stored in (or deleted from) the storage.
+
+    Args:
+        storage: the remote storage
+        kind: the kind of hashes (objects, dirs or commits)
+        added: the hashes that were stored
+        removed: the hashes that were deleted
+    """
+    if not _supported(storage):
+        return
+
+    lines: Dict[str, List[str]] = defaultdict(list)
+    for each in added:
+        lines[each[:SHARD_LENGTH]].append(each)
+    for each in removed:
+        lines[each[:SHARD_LENGTH]].append(f"-{each}")
+    if not lines:
+        return
+
+    name = f"{time.time_ns():020d}-{uuid.uuid4().hex}"
+    _write_segments(storage, kind, lines, {shard: name for shard in lines})
+
+
+def compact_manifest(storage: BaseStorage, kind: str, max_segments: int = 1) -> int:
+    """Merge the segments of each shard that has more than `max_segments` segments
+
+    Args:
+        storage: the remote storage
+        kind: the kind of hashes (objects, dirs or commits)
+        max_segments: the number of segments a shard can have without compaction
+
+    Returns:
+        The number of segments removed
+    """
+    if not _supported(storage):
+        return 0
+
+    shards: Dict[str, List[str]] = defaultdict(list)
+    for segment in list_segments(storage, kind):
+        shards[segment.split("/")[0]].append(segment)
+
+    n_removed = 0
+    for shard, segments in shards.items():
+        if len(segments) <= max_segments:
+            continue
+
+        added, _ = read_segments(storage, kind, segments)
+        name = f"{segments[-1].split('/')[-1]}-{uuid.uuid4().hex[:8]}"
+        _write_segments(storage, kind, {shard: sorted(added)}, {shard: name})
+        prefix = _kind_prefix(storage, kind)
+        storage._delete(storage_paths=[prefix + each for each in segments])
+        n_removed += len(segments) - 1
+
+    return n_removed
+
+
+def build_manifest(storage: BaseStorage) -> Dict[str, int]:
+    """Rebuild the manifests of a storage from its full listing and mark them complete
+
+    Args:
+        storage: the remote storage
+
+    Returns:
+        The number of hashes of each kind
+    """
+    if not _supported(storage):
+        raise RuntimeError("The storage does not keep manifests")
+
+    result = {}
+    for kind in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        old_segments = list_segments(storage, kind)
+        hash_values = list(storage._list(storage._hash_path("", prefix=kind)))
+        append_manifest(storage, kind, added=hash_values)
+        prefix = _kind_prefix(storage, kind)
+        storage._delete(storage_paths=[prefix + each for each in old_segments])
+        _mark_complete(storage, kind)
+        result[kind] = len(hash_values)
+
+    return result
+
+
+def _mark_complete(storage: BaseStorage, kind: str):
+    """Mark the manifest of a kind as listing every hash of the storage"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir, "complete")
+        path.write_text("")
+        storage._store(storage_paths=[_complete_path(storage, kind)], paths=[str(path)])
+
+
+def init_manifest(storage: BaseStorage):
+    """Mark the manifests complete if the storage is still empty
+
+    Args:
+        storage: the remote storage
+    """
+    if not _supported(storage):
+        return
+
+    for kind in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        if storage._have([_complete_path(storage, kind)])[0]:
+            continue
+        if next(storage._scan(storage._hash_path("", prefix=kind)), None) is None:
+            _mark_complete(storage, kind)
+
+
+def sync_manifest(storage: BaseStorage) -> Dict[str, bool]:
+    """Apply the new manifest segments to the storage's presence index
+
+    If the manifest of a kind is complete, the presence index is trusted to answer
+    that hashes are absent, for the lifetime of `storage`.
+
+    Args:
+        storage: the remote storage
+
+    Returns:
+        Whether the manifest of each kind is complete
+    """
+    result = {}
+    if not _supported(storage):
+        return result
+
+    for kind in [storage.OBJECTS_PREFIX, storage.DIRS_PREFIX, storage.COMMITS_PREFIX]:
+        index = storage.presence(kind)
+        segments = list_segments(storage, kind)
+        seen_file = _seen_file(storage, kind)
+        seen = (
+            set(json.loads(seen_file.read_text()))
+            if seen_file.exists() and index.complete
+            else None
+        )
+
+        if seen is None or not seen.issubset(segments):
+            # first sync, or segments were compacted: apply the whole manifest
+            added, _ = read_segments(storage, kind, segments)
+            index.rebuild(added)
+        else:
+            added, removed = read_segments(
+                storage, kind, [each for each in segments if each not in seen]
+            )
+            index.remove(removed)
+            index.add(added)
+
+        seen_file.parent.mkdir(parents=True, exist_ok=True)
+        seen_file.write_text(json.dumps(segments))
+
+        result[kind] = storage._have([_complete_path(storage, kind)])[0]
+        if result[kind]:
+            storage.trust_presence(kind)
+
+    return result
@@ -1,70 +1,132 @@
-from god.storage.commons import BaseStorage, LocalStorage
-
-
-def get_files():
-    pass
-
-
-def set_files():
-    pass
-
-
-def migrate_local_storage(storage1: BaseStorage, storage2: BaseStorage):
-    """Migrate relating to local storage"""
-    from pathlib import Path
-
-    if isinstance(storage1, LocalStorage):
-
-        # migrate objects
-        object_paths = storage1.list_objects()
-        paths, hash_values = [], []
-        for each in object_paths:
-            paths.append(str(storage1._object_path / each))
-            hash_values.append("".join(Path(each).parts))
-        storage2.store_objects(paths, hash_values)
-
-        # migrate dirs
-        dir_paths = storage1.list_dirs()
-        paths, hash_values = [], []
-        for each in dir_paths:
-            paths.append(str(storage1._dir_path / each))
-            hash_values.append("".join(Path(each).parts))
-        storage2.store_dirs(paths, hash_values)
-
-        # migrate commits
-        commit_paths = storage1.list_commits()
-        paths, hash_values = [], []
-        for each in commit_paths:
-            paths.append(str(storage1._commit_path / each))
-            hash_values.append("".join(Path(each).parts))
-        storage2.store_commits(paths, hash_values)
+"""Migrate all objects, dirs and commits from a storage to another storage
+
+The source inventory is listed 1 hash-prefix shard at a time, diffed against what the
+destination already has (answered by its presence index when possible), and only the
+missing hashes are copied. Several shards are migrated in parallel. Objects are
+migrated before dirs, and dirs before commits, so that the destination never has a
+commit or dir whose content is missing.
+
+Copies stay inside the storage provider when it supports it (e.g. S3 to S3 with
+server-side copy), read from or write into the storage location directly when
+either storage is local, and are staged through a temporary directory otherwise.
+
+Each migrated shard is recorded in a checkpoint file, so that an interrupted
+migration resumes from the shards that are not done.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Set, Union
+
+from tqdm import tqdm
+
+from god.storage.backends.base import BaseStorage
+from god.storage.manifest import (
+    MAX_SEGMENTS,
+    compact_manifest,
+    init_manifest,
+    sync_manifest,
+)
+from god.storage.transfer import transfer
+
+# number of shards to migrate at the same time
+N_SHARDS = 4
+
+
+def _read_checkpoint(checkpoint_file: Union[str, Path, None]) -> Set[str]:
+    """Read the migrated shards, as "<kind>/<shard>" """
+    if checkpoint_file is None or not Path(checkpoint_file).exists():
+        return set()
+    with open(checkpoint_file, "r") as fi:
+        return set(json.load(fi))
+
+
+def _write_checkpoint(checkpoint_file: Union[str, Path, None], done: Set[str]):
+    """Atomically replace the checkpoint with the migrated shards"""
+    if checkpoint_file is None:
         return
-
-
-def safe_migrate(storage1: BaseStorage, storage2: BaseStorage):
-    """Migrate data from `storage1` to `storage2`
-
-    In essence, this method:
-        1. Downloads objects from `storage1` to local.
-        2. Then uploads those objects from local to `storage2`.
+    Path(checkpoint_file).parent.mkdir(parents=True, exist_ok=True)
+    temp_file = f"{checkpoint_file}.tmp"
+    with open(temp_file, "w") as fo:
+        json.dump(sorted(done), fo)
+    os.replace(temp_file, checkpoint_file)
+
+
+def migrate_shard(
+    storage1: BaseStorage, storage2: BaseStorage, prefix: str, shard: str
+) -> List[str]:
+    """Migrate the hashes of 1 shard that `storage2` does not have
+
+    Args:
+        storage1: the storage to migrate from
+        storage2: the storage to migrate to
+        prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+        shard: the hash prefix directory
+
+    Returns:
+        The migrated hashes
     """
-    if isinstance(storage1, LocalStorage) or isinstance(storage2, LocalStorage):
-        migrate_local_storage(storage1, storage2)
-        return
-
-    for item in storage1.get_hashes():
-        # download
-        # upload
-        storage2.store_files()  # PRIORITY5: reconsider the necessity of migrate
-
-
-def migrate(storage1: BaseStorage, storage2: BaseStorage):
+    storage_prefix = storage1._hash_path("", prefix=prefix)
+    hash_values = [
+        name.replace("/", "")
+        for name, _, _ in storage1._scan_hashes(storage_prefix, shard)
+    ]
+    if not hash_values:
+        return []
+
+    exists = getattr(storage2, f"have_{prefix}")(hash_values)
+    missing = [hash_values[idx] for idx in range(len(hash_values)) if not exists[idx]]
+    transfer(storage1, storage2, missing, prefix=prefix)
+
+    return missing
+
+
+def migrate(
+    storage1: BaseStorage,
+    storage2: BaseStorage,
+    checkpoint_file: Union[str, Path, None] = None,
+) -> int:
     """Migrate data from `storage1` to `storage2`
 
-    This stragegy might not be optimal as there can be specific methods to transfer
-    data directly from `storage1` to `storage2`, without needing that data in local.
-    Since such strategy typically requires providers of both storages to support each
-    other, and `god` does not have control of those providers, so we will support
-    optimized transfer on best-effort basis. Otherwise, fall back to the safe transfer
+    Args:
+        storage1: the storage to migrate from
+        storage2: the storage to migrate to
+        checkpoint_file: the file that records migrated shards, to resume an
+            interrupted migration. It is removed when the migration finishes.
+
+    Returns:
+        The number of migrated hashes
     """
-    safe_migrate(storage1, storage2)
+    init_manifest(storage2)
+    sync_manifest(storage2)
+
+    done = _read_checkpoint(checkpoint_file)
+    lock = threading.Lock()
+    n_migrated = 0
+
+    def _migrate(prefix, shard):
+        nonlocal n_migrated
+        migrated = migrate_shard(storage1, storage2, prefix, shard)
+        with lock:
+            n_migrated += len(migrated)
+            done.add(f"{prefix}/{shard}")
+            _write_checkpoint(checkpoint_file, done)
+
+    for prefix in [
+        storage1.OBJECTS_PREFIX,
+        storage1.DIRS_PREFIX,
+        storage1.COMMITS_PREFIX,
+    ]:
+        shards = [each for each in storage1._shards() if f"{prefix}/{each}" not in done]
+        with ThreadPoolExecutor(max_workers=N_SHARDS) as executor:
+            jobs = [executor.submit(_migrate, prefix, shard) for shard in shards]
+            for job in tqdm(jobs, desc=prefix):
+                job.result()
+        compact_manifest(storage2, prefix, max_segments=MAX_SEGMENTS)
+
+    if checkpoint_file is not None and Path(checkpoint_file).exists():
+        os.unlink(checkpoint_file)
+
+    return n_migrated
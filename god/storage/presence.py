@@ -0,0 +1,295 @@
+"""Persistent index of the hashes that a storage holds
+
+Checking whether a storage has a hash costs 1 `stat` on local filesystem and 1
+network request on remote storages. The presence index answers from local disk
+instead. Each kind of hash (objects, dirs, commits) has these files in the index
+directory:
+
+    - `<kind>`: the sorted 32-byte digests, searched in place with `mmap`
+    - `<kind>.bloom`: the Bloom filter of the sorted digests, so that most absent
+        hashes are answered without touching the sorted file
+    - `<kind>.journal`: the digests added ("+") or removed ("-") since the last
+        compaction, in order
+    - `<kind>.complete`: exists if the index lists every hash in the storage, set
+        when the index is rebuilt from a storage listing
+
+Hashes that are not 64-character hex strings are never indexed.
+"""
+import bisect
+import fcntl
+import heapq
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Union
+
+DIGEST_SIZE = 32
+RECORD_SIZE = DIGEST_SIZE + 1
+# number of Bloom filter bits per digest, ~1% false positives with BLOOM_K
+BLOOM_BITS_PER_DIGEST = 10
+BLOOM_K = 7
+BLOOM_MIN_BITS = 8 * 1024
+# merge the journal into the sorted file when it has this many records
+COMPACT_SIZE = 100000
+
+
+def _digest(hash_value: str) -> Union[bytes, None]:
+    """Convert hex hash into digest, None if the hash cannot be indexed"""
+    if len(hash_value) != 2 * DIGEST_SIZE:
+        return None
+    try:
+        return bytes.fromhex(hash_value)
+    except ValueError:
+        return None
+
+
+def _bloom_positions(digest: bytes, n_bits: int) -> Iterator[int]:
+    """The Bloom filter bits of a digest, taken from slices of the digest itself"""
+    for idx in range(BLOOM_K):
+        yield int.from_bytes(digest[idx * 4 : (idx + 1) * 4], "big") % n_bits
+
+
+class _Digests:
+    """Read-only sequence view of the sorted digest file, to use with `bisect`"""
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+
+    def __len__(self):
+        return len(self._buffer) // DIGEST_SIZE
+
+    def __getitem__(self, idx):
+        return self._buffer[idx * DIGEST_SIZE : (idx + 1) * DIGEST_SIZE]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class PresenceIndex:
+    """Persistent set of hashes of 1 kind inside a storage
+
+    Several processes can use the same index: writes are serialized with a file
+    lock, and each read picks up the changes made by other processes. Threads share
+    the loaded index under a mutex.
+
+    Args:
+        index_dir: the directory that contains the index files
+        kind: the kind of hashes (objects, dirs or commits)
+    """
+
+    def __init__(self, index_dir: Union[str, Path], kind: str):
+        self._dir = Path(index_dir)
+        self._sorted_file = self._dir / kind
+        self._bloom_file = self._dir / f"{kind}.bloom"
+        self._journal_file = self._dir / f"{kind}.journal"
+        self._complete_file = self._dir / f"{kind}.complete"
+        self._lock_file = self._dir / f"{kind}.lock"
+
+        self._sorted_id = None
+        self._digests = _Digests(b"")
+        self._bloom = b""
+        self._bloom_bits = 0
+        self._journal: Dict[bytes, bool] = {}
+        self._journal_offset = 0
+        self._mutex = threading.RLock()
+
+    def exists(self) -> bool:
+        """Whether the index has been created"""
+        return self._sorted_file.exists() or self._journal_file.exists()
+
+    @property
+    def complete(self) -> bool:
+        """Whether the index lists every hash in the storage"""
+        return self._complete_file.exists()
+
+    def contains(self, hash_values: List[str]) -> List[bool]:
+        """Check whether the index has the hashes
+
+        Args:
+            hash_values: the hashes to check
+
+        Returns:
+            True if the index has the hash, False otherwise
+        """
+        result = []
+        with self._mutex:
+            self._refresh()
+            for hash_value in hash_values:
+                digest = _digest(hash_value)
+                if digest is None:
+                    result.append(False)
+                elif digest in self._journal:
+                    result.append(self._journal[digest])
+                else:
+                    result.append(self._in_sorted(digest))
+        return result
+
+    def add(self, hash_values: Iterable[str]):
+        """Record that the storage has the hashes"""
+        self._append(hash_values, b"+")
+
+    def remove(self, hash_values: Iterable[str]):
+        """Record that the storage no longer has the hashes"""
+        self._append(hash_values, b"-")
+
+    def rebuild(self, hash_values: Iterable[str]):
+        """Replace the index content with `hash_values` and mark it complete
+
+        Args:
+            hash_values: every hash that the storage has, e.g. from a listing
+        """
+        digests = sorted(
+            {each for each in map(_digest, hash_values) if each is not None}
+        )
+        with self._lock():
+            self._write_sorted(digests, len(digests))
+            self._journal_file.write_bytes(b"")
+            self._complete_file.touch()
+        self._refresh()
+
+    def compact(self):
+        """Merge the journal into the sorted digest file"""
+        with self._mutex, self._lock():
+            self._refresh()
+            if not self._journal:
+                return
+            added = sorted(key for key, value in self._journal.items() if value)
+            n_digests = len(self._digests) + len(added)
+            self._write_sorted(self._merge(added), n_digests)
+            self._journal_file.write_bytes(b"")
+        self._refresh()
+
+    def _merge(self, added: List[bytes]) -> Iterator[bytes]:
+        """Merge the sorted digests with the journal, in sorted order"""
+        last = None
+        for digest in heapq.merge(self._digests, added):
+            if digest != last and self._journal.get(digest, True):
+                yield digest
+            last = digest
+
+    def _in_sorted(self, digest: bytes) -> bool:
+        """Check the Bloom filter, then binary search the sorted digests"""
+        if not self._bloom_bits:
+            return False
+        for pos in _bloom_positions(digest, self._bloom_bits):
+            if not self._bloom[pos // 8] & (1 << (pos % 8)):
+                return False
+        idx = bisect.bisect_left(self._digests, digest)
+        return idx < len(self._digests) and self._digests[idx] == digest
+
+    def _append(self, hash_values: Iterable[str], op: bytes):
+        """Append the digests to journal"""
+        records = b"".join(
+            op + digest for digest in map(_digest, hash_values) if digest is not None
+        )
+        if not records:
+            return
+
+        with self._lock():
+            with self._journal_file.open("ab") as fo:
+                fo.write(records)
+            journal_size = self._journal_file.stat().st_size
+        if journal_size >= COMPACT_SIZE * RECORD_SIZE:
+            self.compact()
+
+    def _write_sorted(self, digests: Iterable[bytes], n_digests: int):
+        """Write the sorted digests and their Bloom filter, replacing the old files
+
+        Args:
+            digests: the sorted digests, without duplication
+            n_digests: the upper bound of number of digests, to size the filter
+        """
+        n_bits = max(BLOOM_MIN_BITS, n_digests * BLOOM_BITS_PER_DIGEST)
+        bloom = bytearray((n_bits + 7) // 8)
+        temp_sorted = self._sorted_file.with_name(f"{self._sorted_file.name}.tmp")
+        temp_bloom = self._bloom_file.with_name(f"{self._bloom_file.name}.tmp")
+        with temp_sorted.open("wb") as fo:
+            for digest in digests:
+                fo.write(digest)
+                for pos in _bloom_positions(digest, n_bits):
+                    bloom[pos // 8] |= 1 << (pos % 8)
+        with temp_bloom.open("wb") as fo:
+            fo.write(n_bits.to_bytes(8, "big"))
+            fo.write(bloom)
+        os.replace(temp_bloom, self._bloom_file)
+        os.replace(temp_sorted, self._sorted_file)
+
+    def _refresh(self):
+        """Load the changes made to index files since the last read"""
+        with self._mutex:
+            self._refresh_unlocked()
+
+    def _refresh_unlocked(self):
+        try:
+            stat = self._sorted_file.stat()
+            sorted_id = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            sorted_id = None
+
+        try:
+            journal_size = self._journal_file.stat().st_size
+        except FileNotFoundError:
+            journal_size = 0
+
+        if sorted_id != self._sorted_id or journal_size < self._journal_offset:
+            self._load_sorted(sorted_id)
+            self._journal = {}
+            self._journal_offset = 0
+
+        if journal_size > self._journal_offset:
+            with self._journal_file.open("rb") as fi:
+                fi.seek(self._journal_offset)
+                data = fi.read(journal_size - self._journal_offset)
+            data = data[: len(data) - len(data) % RECORD_SIZE]
+            for idx in range(0, len(data), RECORD_SIZE):
+                self._journal[data[idx + 1 : idx + RECORD_SIZE]] = (
+                    data[idx : idx + 1] == b"+"
+                )
+            self._journal_offset += len(data)
+
+    def _load_sorted(self, sorted_id):
+        """Map the sorted digests and the Bloom filter into memory"""
+        self._sorted_id = sorted_id
+        self._digests = _Digests(self._map(self._sorted_file))
+        bloom = self._map(self._bloom_file)
+        if len(bloom) > 8:
+            self._bloom_bits = int.from_bytes(bloom[:8], "big")
+            self._bloom = memoryview(bloom)[8:]
+        else:
+            self._bloom_bits = 0
+            self._bloom = b""
+
+    @staticmethod
+    def _map(path: Path):
+        """Read-only memory map of `path`, empty bytes if the file is empty"""
+        try:
+            with path.open("rb") as fi:
+                if not os.fstat(fi.fileno()).st_size:
+                    return b""
+                return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return b""
+
+    def _lock(self):
+        """Exclusive lock over the index files of this kind"""
+        return FileLock(self._lock_file)
+
+
+class FileLock:
+    """Exclusive `flock` over a file, as a context manager"""
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._fo = None
+
+    def __enter__(self):
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._fo = self._path.open("a")
+        fcntl.flock(self._fo.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self._fo.fileno(), fcntl.LOCK_UN)
+        self._fo.close()
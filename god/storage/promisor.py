@@ -0,0 +1,57 @@
+"""Fetch objects on demand for partial clones
+
+A partial clone (`god clone --filter`) only fetches commits and dirs. The objects
+are left in the promisor remote, and are fetched lazily, in batch, the first time
+they are read (checkout, diff, merge or any Python reader using `get_objects`).
+"""
+from typing import List
+
+from god.remote import get_remote_declaration_config_path
+from god.remote.base import get_promisor_remote, get_remote
+from god.storage.backends.base import BaseStorage
+from god.storage.commons import get_backend
+from god.storage.transfer import transfer
+
+
+def fetch_missing_objects(
+    storage: BaseStorage, hash_values: List[str], base_dir: str = None
+) -> List[str]:
+    """Fetch the objects that `storage` does not have from the promisor remote
+
+    Args:
+        storage: the local storage that should contain the objects
+        hash_values: the hashes of objects that are about to be read
+        base_dir: the repo base directory, default to the current repo
+
+    Returns:
+        The hashes of objects fetched from the promisor remote
+    """
+    remote_config_path = get_remote_declaration_config_path(base_dir=base_dir)
+    promisor = get_promisor_remote(remote_config_path=remote_config_path)
+    if not promisor or not hash_values:
+        return []
+
+    hash_values = list(set(hash_values))
+    exists = storage.have_objects(hash_values)
+    missing = [hash_values[idx] for idx in range(len(hash_values)) if not exists[idx]]
+    if not missing:
+        return []
+
+    remote_loc = get_remote(remote_config_path=remote_config_path, name=promisor)
+    remote_storage = get_backend(remote_loc[promisor])
+    transfer(remote_storage, storage, missing, prefix=storage.OBJECTS_PREFIX)
+
+    return missing
+
+
+def get_objects(hash_values: List[str], paths: List[str], base_dir: str = None):
+    """Get the objects from repo storage to `paths`, fetching them if missing
+
+    Args:
+        hash_values: list of object hashes we wish to get
+        paths: corresponding target locations that store the objects
+        base_dir: the repo base directory, default to the current repo
+    """
+    storage = get_backend(base_dir=base_dir)
+    fetch_missing_objects(storage, hash_values, base_dir=base_dir)
+    storage.get_objects(hash_values=hash_values, paths=paths)
@@ -0,0 +1,508 @@
+"""Smart HTTP transport: serve a storage and refs to `god+http://` clients
+
+Remote operations over dumb object stores take 1 request per file. `god serve`
+answers batches instead, so that a LAN mirror serves a push or a clone in a few round
+trips. <kind> is objects, dirs or commits, hashes are sent 1 per line:
+
+    POST /have/<kind>       hashes -> presence bitmap, the bit i (most significant
+                            bit first) is set if the i-th hash is present
+    POST /get/<kind>        hashes -> pack of the files
+    POST /put/<kind>        pack -> stores the files, objects and dirs are verified
+    POST /delete/<kind>     hashes -> JSON of the error message of each hash
+    GET  /scan/<kind>       -> "<hash>\\t<size>\\t<mtime>" lines
+    POST /have/refs         ref names -> presence bitmap
+    GET  /scan/refs         -> "<ref>\\t<size>\\t<mtime>" lines
+    GET  /refs/<ref>        -> the content of the ref
+    POST /refs/<ref>        JSON {"old": ..., "new": ...} -> sets the ref to "new"
+                            (deletes it if null) if its content is "old" (absent if
+                            null), answers 409 with the current content otherwise.
+                            Without "old", sets the ref unconditionally
+
+A server with a token answers 401 to requests without the header
+`Authorization: Bearer <token>`. A read-only server answers 403 to put, delete and
+ref updates. `god serve` listens on the loopback interface by default, and is
+read-only unless it is given a token. It refuses to update the branch that the served
+repo has checked out, since that would move the branch under its working tree.
+
+An error while a response is streamed, after its status is sent, drops the
+connection, so the client sees a truncated response rather than a wrong one.
+
+A pack is, for each file, a "<hash> <size>\\n" line then the content of the file.
+The size is -1 for a missing file. Streamed responses use chunked encoding over
+kept-alive connections.
+"""
+import hmac
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Tuple, Union
+from urllib.parse import unquote
+
+from god.core.head import read_HEAD
+from god.storage.backends.base import CHUNK_SIZE, BaseStorage, write_verified
+from god.storage.presence import FileLock
+from god.utils.exceptions import IntegrityError
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8421
+REFS = "refs"
+# the environment variable of the token, read by `god serve` and its clients
+TOKEN_ENV = "GOD_SERVE_TOKEN"
+# the endpoints that change the storage or the refs, with POST
+WRITE_ENDPOINTS = ("put", "delete", REFS)
+# number of files that the server downloads at a time from a storage that is not on
+# local disk
+STAGE_BATCH_SIZE = 256
+_HASH = re.compile(r"^[0-9a-f]+$")
+
+
+def read_pack(stream: BinaryIO) -> Iterator[Tuple[str, int, Iterator[bytes]]]:
+    """Iterate over the files of a pack
+
+    Each file content must be consumed before the next file is read.
+
+    Args:
+        stream: the pack
+
+    Yields:
+        The hash
+        The size, -1 if the file is missing
+        The content, in chunks
+    """
+    while True:
+        line = stream.readline()
+        if not line:
+            return
+        hash_value, _, size = line.decode().strip().partition(" ")
+        size = int(size)
+
+        def chunks(remaining=size):
+            while remaining > 0:
+                chunk = stream.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise EOFError(f"Pack ends inside {hash_value}")
+                remaining -= len(chunk)
+                yield chunk
+
+        yield hash_value, size, chunks()
+
+
+def pack_header(hash_value: str, size: int) -> bytes:
+    return f"{hash_value} {size}\n".encode()
+
+
+def bitmap(flags: List[bool]) -> bytes:
+    """Pack booleans into bits, the most significant bit first"""
+    result = bytearray((len(flags) + 7) // 8)
+    for idx, flag in enumerate(flags):
+        if flag:
+            result[idx // 8] |= 0x80 >> (idx % 8)
+    return bytes(result)
+
+
+def unbitmap(data: bytes, n_flags: int) -> List[bool]:
+    """Unpack `bitmap`"""
+    return [bool(data[idx // 8] & (0x80 >> (idx % 8))) for idx in range(n_flags)]
+
+
+class RefStore:
+    """The refs of a repo, with compare-and-swap updates
+
+    Args:
+        refs_dir: the directory that holds the refs
+    """
+
+    def __init__(self, refs_dir: Union[str, Path]):
+        self._dir = Path(refs_dir).resolve()
+        self._lock = threading.Lock()
+        self._file_lock = Path(f"{self._dir}.lock")
+
+    def path(self, ref: str) -> Path:
+        path = Path(self._dir, ref).resolve()
+        if self._dir not in path.parents:
+            raise ValueError(f"Invalid ref {ref}")
+        return path
+
+    def get(self, ref: str) -> Union[str, None]:
+        try:
+            return self.path(ref).read_text()
+        except FileNotFoundError:
+            return None
+
+    def scan(self) -> Iterator[Tuple[str, int, float]]:
+        for path in sorted(self._dir.rglob("*")):
+            if path.is_file() and path.suffix != ".swap":
+                stat = path.stat()
+                yield path.relative_to(
+                    self._dir
+                ).as_posix(), stat.st_size, stat.st_mtime
+
+    def swap(
+        self, ref: str, old: Union[str, None], new: Union[str, None], check: bool = True
+    ) -> Tuple[bool, Union[str, None]]:
+        """Set `ref` to `new` if its content is `old`
+
+        Args:
+            ref: the ref name
+            old: the expected content, None if the ref should be absent
+            new: the new content, None to delete the ref
+            check: if False, set the ref whatever its content
+
+        Returns:
+            Whether the ref is set
+            The content of the ref before
+        """
+        path = self.path(ref)
+        with self._lock, FileLock(self._file_lock):
+            current = self.get(ref)
+            if check and not (
+                (current is None) == (old is None)
+                and (current or "").strip() == (old or "").strip()
+            ):
+                return False, current
+            if new is None:
+                if current is not None:
+                    path.unlink()
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp = path.with_name(f"{path.name}.swap")
+                temp.write_text(new)
+                os.replace(temp, path)
+            return True, current
+
+
+class StorageRequestHandler(BaseHTTPRequestHandler):
+    """Answer the requests of `god+http://` clients, see the module docstring"""
+
+    protocol_version = "HTTP/1.1"
+    server: "StorageServer"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _route(self) -> Tuple[str, str]:
+        """Split the request path into the endpoint and the kind or ref name"""
+        path = unquote(self.path[len(self.server.root) :]).lstrip("/")
+        endpoint, _, name = path.partition("/")
+        return endpoint, name
+
+    def _kind(self, name: str) -> str:
+        storage = self.server.storage
+        if name not in (
+            storage.OBJECTS_PREFIX,
+            storage.DIRS_PREFIX,
+            storage.COMMITS_PREFIX,
+        ):
+            raise ValueError(f"Unknown kind {name}")
+        return name
+
+    def _read_lines(self) -> List[str]:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        return [each for each in body.split("\n") if each]
+
+    def _hashes(self) -> List[str]:
+        hash_values = self._read_lines()
+        for each in hash_values:
+            if not _HASH.match(each):
+                raise ValueError(f"Invalid hash {each}")
+        return hash_values
+
+    def _send(self, status: int, body: bytes = b"", content_type: str = "text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks: Iterator[bytes]):
+        """Send a response of unknown length with chunked encoding"""
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        except Exception as e:
+            # too late for an error status: end without the last chunk
+            self.close_connection = True
+            self.log_error("Stream failed: %s: %s", type(e).__name__, e)
+            return
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _handle(self, method):
+        try:
+            method()
+        except (ValueError, IntegrityError, EOFError) as e:
+            # the request body may be left unread
+            self.close_connection = True
+            self._send(HTTPStatus.BAD_REQUEST, str(e).encode())
+        except FileNotFoundError as e:
+            self.close_connection = True
+            self._send(HTTPStatus.NOT_FOUND, str(e).encode())
+
+    def _authorized(self, write: bool) -> bool:
+        """Answer 401 or 403 and return False if the request is not allowed"""
+        token = self.server.token
+        if token is not None:
+            header = self.headers.get("Authorization", "")
+            if not hmac.compare_digest(header.encode(), f"Bearer {token}".encode()):
+                self.close_connection = True
+                self._send(HTTPStatus.UNAUTHORIZED, b"Missing or wrong token")
+                return False
+        if write and self.server.read_only:
+            self.close_connection = True
+            self._send(HTTPStatus.FORBIDDEN, b"The server is read-only")
+            return False
+        return True
+
+    def do_GET(self):
+        if self._authorized(write=False):
+            self._handle(self._get)
+
+    def do_POST(self):
+        if self._authorized(write=self._route()[0] in WRITE_ENDPOINTS):
+            self._handle(self._post)
+
+    def _get(self):
+        endpoint, name = self._route()
+        if endpoint == "scan":
+            if name == REFS:
+                entries = self.server.refs.scan()
+            else:
+                entries = self.server.scan(self._kind(name))
+            self._send_stream(
+                f"{each}\t{size}\t{mtime}\n".encode() for each, size, mtime in entries
+            )
+        elif endpoint == REFS:
+            content = self.server.refs.get(name)
+            if content is None:
+                raise FileNotFoundError(f"Ref {name} does not exist")
+            self._send(HTTPStatus.OK, content.encode())
+        else:
+            raise FileNotFoundError(f"Unknown endpoint {endpoint}")
+
+    def _post(self):
+        endpoint, name = self._route()
+        if endpoint == "have":
+            if name == REFS:
+                exists = [
+                    self.server.refs.get(each) is not None
+                    for each in self._read_lines()
+                ]
+            else:
+                kind = self._kind(name)
+                exists = self.server.storage._have_hashes(self._hashes(), prefix=kind)
+            self._send(HTTPStatus.OK, bitmap(exists), "application/octet-stream")
+        elif endpoint == "get":
+            kind = self._kind(name)
+            self._send_stream(self.server.pack(self._hashes(), kind))
+        elif endpoint == "put":
+            kind = self._kind(name)
+            length = int(self.headers.get("Content-Length", 0))
+            n_stored = self.server.unpack(_LimitedReader(self.rfile, length), kind)
+            self._send(HTTPStatus.OK, str(n_stored).encode())
+        elif endpoint == "delete":
+            kind = self._kind(name)
+            errors = self.server.storage._delete_hashes(self._hashes(), prefix=kind)
+            self._send(HTTPStatus.OK, json.dumps(errors).encode(), "application/json")
+        elif endpoint == REFS:
+            length = int(self.headers.get("Content-Length", 0))
+            update = json.loads(self.rfile.read(length))
+            if name == self.server.current_branch():
+                self._send(
+                    HTTPStatus.FORBIDDEN,
+                    f"Refusing to update the checked-out branch {name}".encode(),
+                )
+                return
+            swapped, current = self.server.refs.swap(
+                name, update.get("old"), update.get("new"), check="old" in update
+            )
+            self._send(
+                HTTPStatus.OK if swapped else HTTPStatus.CONFLICT,
+                json.dumps({"current": current}).encode(),
+                "application/json",
+            )
+        else:
+            raise FileNotFoundError(f"Unknown endpoint {endpoint}")
+
+
+class _LimitedReader:
+    """Read at most `length` bytes of a stream, for request bodies"""
+
+    def __init__(self, stream: BinaryIO, length: int):
+        self._stream = stream
+        self._remaining = length
+
+    def read(self, size: int) -> bytes:
+        data = self._stream.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        return data
+
+    def readline(self) -> bytes:
+        data = self._stream.readline(self._remaining)
+        self._remaining -= len(data)
+        return data
+
+
+class StorageServer(ThreadingHTTPServer):
+    """HTTP server over a storage and a refs directory
+
+    Args:
+        address: the host and port to listen on
+        storage: the storage to serve
+        refs_dir: the directory of the refs to serve
+        root: the URL path that the endpoints are under
+        verbose: whether to log every request
+        token: if given, every request must send it as a bearer token
+        read_only: whether to refuse put, delete and ref updates
+        file_head: the HEAD file of the served repo, its branch is not updated
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        storage: BaseStorage,
+        refs_dir: Union[str, Path],
+        root: str = "",
+        verbose: bool = False,
+        token: Union[str, None] = None,
+        read_only: bool = False,
+        file_head: Union[str, Path, None] = None,
+    ):
+        super().__init__(address, StorageRequestHandler)
+        self.storage = storage
+        self.refs = RefStore(refs_dir)
+        self.root = root.rstrip("/")
+        self.verbose = verbose
+        self.token = token or None
+        self.read_only = read_only
+        self.file_head = file_head
+
+    def current_branch(self) -> Union[str, None]:
+        """The branch that the served repo has checked out, read at each call"""
+        if self.file_head is None:
+            return None
+        try:
+            return read_HEAD(self.file_head).ref()
+        except FileNotFoundError:
+            return None
+
+    def scan(self, kind: str) -> Iterator[Tuple[str, int, float]]:
+        storage_prefix = self.storage._hash_path("", prefix=kind)
+        for name, size, mtime in self.storage._scan_hashes(storage_prefix):
+            yield name.replace("/", ""), size, mtime
+
+    def pack(self, hash_values: List[str], kind: str) -> Iterator[bytes]:
+        """Stream the files of the hashes as a pack"""
+        paths = self.storage.local_paths(hash_values, prefix=kind, read=True)
+        if paths is not None:
+            for hash_value, path in zip(hash_values, paths):
+                yield from self._pack_file(hash_value, path)
+            return
+
+        # stage the files of a storage that is not on local disk
+        exists = self.storage._have_hashes(hash_values, prefix=kind)
+        for start in range(0, len(hash_values), STAGE_BATCH_SIZE):
+            batch = hash_values[start : start + STAGE_BATCH_SIZE]
+            present = [
+                each
+                for each, ok in zip(batch, exists[start : start + STAGE_BATCH_SIZE])
+                if ok
+            ]
+            with tempfile.TemporaryDirectory() as temp_dir:
+                getattr(self.storage, f"get_{kind}")(
+                    hash_values=present,
+                    paths=[str(Path(temp_dir, each)) for each in present],
+                )
+                for hash_value in batch:
+                    yield from self._pack_file(
+                        hash_value, str(Path(temp_dir, hash_value))
+                    )
+
+    def _pack_file(self, hash_value: str, path: str) -> Iterator[bytes]:
+        try:
+            fi = open(path, "rb")
+        except FileNotFoundError:
+            yield pack_header(hash_value, -1)
+            return
+        with fi:
+            yield pack_header(hash_value, os.fstat(fi.fileno()).st_size)
+            while True:
+                chunk = fi.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def unpack(self, stream: BinaryIO, kind: str) -> int:
+        """Store the files of a pack, verifying the hashes of objects and dirs
+
+        Returns:
+            The number of files stored
+        """
+        verify = kind in (self.storage.OBJECTS_PREFIX, self.storage.DIRS_PREFIX)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            hash_values, paths = [], []
+            for hash_value, size, chunks in read_pack(stream):
+                if not _HASH.match(hash_value):
+                    raise ValueError(f"Invalid hash {hash_value}")
+                if size < 0:
+                    continue
+                path = str(Path(temp_dir, hash_value))
+                if verify:
+                    write_verified(path, chunks, hash_value)
+                else:
+                    with open(path, "wb") as fo:
+                        for chunk in chunks:
+                            fo.write(chunk)
+                hash_values.append(hash_value)
+                paths.append(path)
+            self.storage._store_hashes(paths, hash_values, prefix=kind)
+            return len(hash_values)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def serve(
+    storage: BaseStorage,
+    refs_dir: Union[str, Path],
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    verbose: bool = False,
+    token: Union[str, None] = None,
+    read_only: bool = False,
+    file_head: Union[str, Path, None] = None,
+):
+    """Serve the storage and refs until interrupted
+
+    Without a token, the storage and refs are served read-only. The branch in
+    `file_head` is never updated.
+    """
+    read_only = read_only or not token
+    with StorageServer(
+        (host, port),
+        storage,
+        refs_dir,
+        verbose=verbose,
+        token=token,
+        read_only=read_only,
+        file_head=file_head,
+    ) as server:
+        print(f"Serving on god+http://{host}:{server.server_address[1]}")
+        if read_only:
+            print(f"Read-only, set {TOKEN_ENV} to accept pushes")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
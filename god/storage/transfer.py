@@ -0,0 +1,107 @@
+"""Transfer hashes between 2 storages
+
+When either storage keeps its content in local filesystem, the transfer reads from
+or writes into that storage location directly. Otherwise the target storage copies
+from the source inside the provider (e.g. S3 to S3) when it can, and only then the
+files are staged in a temporary directory.
+"""
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Union
+
+from god.storage.backends.base import BaseStorage, remove_partial
+from god.storage.journal import TransferJournal
+
+# number of hashes to transfer between 2 journal records
+JOURNAL_BATCH_SIZE = 1000
+
+
+def transfer(
+    source: BaseStorage,
+    target: BaseStorage,
+    hash_values: List[str],
+    prefix: str,
+    progress_callback: Union[Callable, None] = None,
+    journal: Union[TransferJournal, None] = None,
+):
+    """Copy hashes from `source` storage to `target` storage
+
+    With a journal, hashes that are done are skipped, the partial downloads of hashes
+    that were in flight are removed, and the rest is transferred and recorded in
+    batches of `JOURNAL_BATCH_SIZE`.
+
+    Args:
+        source: the storage to copy from
+        target: the storage to copy to
+        hash_values: the hashes to copy
+        prefix: the kind of hashes (OBJECTS_PREFIX, DIRS_PREFIX or COMMITS_PREFIX)
+        progress_callback: it is passed total_files (int) and total_bytes (int)
+        journal: the journal of the transfer operation
+    """
+    if journal is None:
+        _transfer(source, target, hash_values, prefix, progress_callback)
+        return
+
+    in_flight = journal.in_flight(prefix)
+    if in_flight:
+        for path in target.local_paths(in_flight, prefix=prefix) or []:
+            remove_partial(path)
+
+    hash_values = journal.pending(prefix, hash_values)
+    for idx in range(0, len(hash_values), JOURNAL_BATCH_SIZE):
+        batch = hash_values[idx : idx + JOURNAL_BATCH_SIZE]
+        journal.start(prefix, batch)
+        _transfer(source, target, batch, prefix, progress_callback)
+        journal.done(prefix, batch)
+
+
+def _transfer(
+    source: BaseStorage,
+    target: BaseStorage,
+    hash_values: List[str],
+    prefix: str,
+    progress_callback: Union[Callable, None] = None,
+):
+    """Copy hashes from `source` storage to `target` storage, see `transfer`"""
+    if not hash_values:
+        return
+
+    get = getattr(source, f"get_{prefix}")
+    store = getattr(target, f"store_{prefix}")
+
+    # upload from the source storage location
+    source_paths = source.local_paths(hash_values, prefix=prefix, read=True)
+    if source_paths is not None:
+        store(paths=source_paths, hash_values=hash_values)
+        return
+
+    # download into the target storage location
+    target_paths = target.local_paths(hash_values, prefix=prefix)
+    if target_paths is not None:
+        created = set()
+        for each in target_paths:
+            parent = Path(each).parent
+            if parent not in created:
+                parent.mkdir(parents=True, exist_ok=True)
+                created.add(parent)
+        index = target.presence(prefix)
+        # copy, not hardlink: the target may be another repo that must not share
+        # its files with the source or the user object cache
+        get(
+            hash_values=hash_values,
+            paths=target_paths,
+            progress_callback=progress_callback,
+        )
+        if index is not None:
+            index.add(hash_values)
+        return
+
+    # copy inside the storage provider
+    if target.copy_hashes(source, hash_values, prefix=prefix):
+        return
+
+    # neither storage is local, stage the files
+    with tempfile.TemporaryDirectory() as temp_dir:
+        paths = [str(Path(temp_dir, each)) for each in hash_values]
+        get(hash_values=hash_values, paths=paths, progress_callback=progress_callback)
+        store(paths=paths, hash_values=hash_values)
@@ -9,6 +9,7 @@ DIR_HIDDEN_WORKING = str(Path(DIR_GOD, "workings"))
 DIR_HIDDEN_WORKING_PLUGINS = str(Path(DIR_HIDDEN_WORKING, "plugins"))
 
 DIR_CACHE = str(Path(DIR_GOD, "cache"))
+DIR_TRANSFERS = str(Path(DIR_GOD, "transfers"))
 
 DIR_REFS = str(Path(DIR_GOD, "refs"))
 DIR_REFS_HEADS = str(Path(DIR_REFS, "heads"))
@@ -16,4 +17,5 @@ DIR_REFS_REMOTES = str(Path(DIR_REFS, "remotes"))
 
 FILE_HEAD = str(Path(DIR_GOD, "HEAD"))
 FILE_INDEX = str(Path(DIR_GOD, "index"))
+FILE_SHALLOW = str(Path(DIR_GOD, "shallow"))
 FILE_CONFIG = "godconfig"
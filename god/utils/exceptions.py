@@ -38,3 +38,9 @@ class NotYetSupported(Exception):
     """A feature that is within planning but not yet implemented"""
 
     pass
+
+
+class IntegrityError(Exception):
+    """Content does not match its hash"""
+
+    pass
@@ -22,7 +22,7 @@ setuptools.setup(
         "python-magic",
         "boto3",
     ],
-    extra_requires=["ipython", "pdbpp", "pytest"],
+    extra_requires=["ipython", "pdbpp", "pytest", "moto"],
     entry_points={
         "console_scripts": [
             "god=god.cli:entrypoint",
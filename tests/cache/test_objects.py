@@ -0,0 +1,127 @@
+"""Test the user object cache"""
+import os
+import shutil
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.cache.objects import ObjectCache, get_object_cache
+from god.storage.backends.local import LocalStorage
+from god.utils.common import get_string_hash
+
+
+class CachedStorage(LocalStorage):
+    """Local storage that reads through the object cache, like remote storages"""
+
+    USE_OBJECT_CACHE = True
+
+
+class ObjectCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/cache/objects").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.cache = ObjectCache(self.cache_dir / "cache", max_size=100)
+        # the user object cache is off by default
+        self.cache_size = mock.patch.dict(os.environ, {"GOD_CACHE_SIZE": "1000"})
+        self.cache_size.start()
+
+        self.hashes, self.paths = [], []
+        for idx in range(5):
+            content = f"{idx}" * 30
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+    def tearDown(self):
+        self.cache_size.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_read_write(self):
+        self.cache.write(self.hashes[:2], self.paths[:2])
+        self.assertEqual(self.cache.size(), 60)
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(3)]
+        self.assertEqual(self.cache.read(self.hashes[:3], targets), [True, True, False])
+        self.assertEqual(Path(targets[1]).read_text(), "1" * 30)
+        self.assertFalse(Path(targets[2]).exists())
+
+    def test_evict_least_recently_used(self):
+        """Going over the cap evicts the least recently read objects"""
+        self.cache.write(self.hashes[:3], self.paths[:3])
+        time.sleep(0.01)
+        self.cache.read(self.hashes[:1], [str(self.cache_dir / "out")])
+        self.cache.write(self.hashes[3:4], self.paths[3:4])
+        self.assertEqual(self.cache.exists(self.hashes[:4]), [True, False, True, True])
+        self.assertEqual(self.cache.size(), 90)
+
+    def test_link(self):
+        """Linked objects share the cached copy"""
+        self.cache.write(self.hashes[:1], self.paths[:1], link=True)
+        target = str(self.cache_dir / "out")
+        self.cache.read(self.hashes[:1], [target], link=True)
+        self.assertEqual(os.stat(target).st_ino, os.stat(self.paths[0]).st_ino)
+
+    def test_storage_read_through(self):
+        """Cached objects are not got from the storage again"""
+        storage = CachedStorage(f"file://{self.cache_dir / 'storage'}")
+        storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(5)]
+
+        with mock.patch.object(c, "DIR_USER_CACHE", str(self.cache_dir / "user")):
+            storage.get_objects(hash_values=self.hashes[:2], paths=targets[:2])
+            with mock.patch.object(storage, "_get", wraps=storage._get) as get:
+                storage.get_objects(hash_values=self.hashes, paths=targets)
+        self.assertEqual(get.call_args.kwargs["hash_values"], self.hashes[2:])
+        for idx, target in enumerate(targets):
+            self.assertEqual(Path(target).read_text(), f"{idx}" * 30)
+
+    def test_corrupt_hit(self):
+        """A cached object that does not match its hash is evicted and got again"""
+        storage = CachedStorage(f"file://{self.cache_dir / 'storage'}")
+        storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(2)]
+
+        with mock.patch.object(c, "DIR_USER_CACHE", str(self.cache_dir / "user")):
+            storage.get_objects(hash_values=self.hashes[:2], paths=targets)
+            cache = get_object_cache()
+            cache._path(self.hashes[0]).write_text("x" * 30)
+            cache._path(self.hashes[1]).write_text("x")
+            with mock.patch.object(storage, "_get", wraps=storage._get) as get:
+                storage.get_objects(hash_values=self.hashes[:2], paths=targets)
+        self.assertEqual(get.call_args.kwargs["hash_values"], self.hashes[:2])
+        for idx, target in enumerate(targets):
+            self.assertEqual(Path(target).read_text(), f"{idx}" * 30)
+        self.assertEqual(cache._path(self.hashes[0]).read_text(), "0" * 30)
+        self.assertEqual(cache.size(), 60)
+
+    def test_one_cache_per_process(self):
+        with mock.patch.object(c, "DIR_USER_CACHE", str(self.cache_dir / "user")):
+            self.assertIs(get_object_cache(), get_object_cache())
+            with mock.patch.dict(os.environ):
+                del os.environ["GOD_CACHE_SIZE"]
+                self.assertIsNone(get_object_cache())
+
+    def test_reflink(self):
+        """Objects are cloned where the filesystem can, and copied elsewhere"""
+        target = str(self.cache_dir / "out")
+        with mock.patch("god.cache.objects._reflink", return_value=False) as reflink:
+            self.cache.write(self.hashes[:1], self.paths[:1])
+            self.assertEqual(self.cache.read(self.hashes[:1], [target]), [True])
+        self.assertEqual(reflink.call_count, 2)
+        self.assertEqual(Path(target).read_text(), "0" * 30)
+        self.assertEqual(os.stat(target).st_nlink, 1)
+
+        # a clone that does not match is not read
+        Path(target).unlink()
+
+        def bad_clone(source, temp):
+            Path(temp).write_text("x" * 30)
+            return True
+
+        with mock.patch("god.cache.objects._reflink", side_effect=bad_clone):
+            self.assertEqual(self.cache.read(self.hashes[:1], [target]), [False])
+        self.assertFalse(Path(target).exists())
@@ -0,0 +1,200 @@
+"""Test the transfer engine"""
+import asyncio
+import threading
+import time
+import unittest
+from unittest import mock
+
+from god.storage import engine
+from god.storage.engine import (
+    PRIORITY_COMMITS,
+    PRIORITY_OBJECTS,
+    AIMDLimiter,
+    TokenBucket,
+    TransferEngine,
+)
+
+
+class Throttled(Exception):
+    pass
+
+
+class AIMDLimiterTest(unittest.TestCase):
+    def test_additive_increase(self):
+        """The limit grows by about 1 after `limit` successful jobs"""
+        limiter = AIMDLimiter(initial=4)
+        for _ in range(4):
+            limiter.on_success(latency=0.01, n_bytes=0)
+        self.assertGreater(limiter.limit, 4.9)
+        self.assertLess(limiter.limit, 5.1)
+
+    def test_throttle_halves(self):
+        limiter = AIMDLimiter(initial=16)
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 8)
+
+    def test_minimum(self):
+        limiter = AIMDLimiter(initial=1)
+        limiter.on_throttle()
+        self.assertEqual(limiter.limit, 1)
+
+    def _run(self, limiter, clock, latency, n_jobs, **kwargs):
+        """Report `n_jobs` jobs, `limit` at a time, and return the lowest limit"""
+        lowest = limiter.limit
+        for _ in range(n_jobs):
+            clock[0] += latency / limiter.limit
+            limiter.on_success(latency=latency, n_bytes=0, **kwargs)
+            lowest = min(lowest, limiter.limit)
+        return lowest
+
+    def test_latency_shift(self):
+        """A lasting rise of latency halves the limit once, then it grows again"""
+        clock = [1000.0]
+        limiter = AIMDLimiter(initial=16)
+        with mock.patch.object(engine.time, "monotonic", lambda: clock[0]):
+            self._run(limiter, clock, 0.01, 200)
+            before = limiter.limit
+            lowest = self._run(limiter, clock, 0.05, 20 * engine.LATENCY_WINDOW)
+        self.assertLess(lowest, before)
+        self.assertGreaterEqual(lowest, before / 2)
+        self.assertGreater(limiter.limit, before)
+
+    def test_latency_per_class(self):
+        """Slow jobs of a class do not decrease the limit for fast jobs of another"""
+        clock = [1000.0]
+        limiter = AIMDLimiter(initial=16)
+        with mock.patch.object(engine.time, "monotonic", lambda: clock[0]):
+            self._run(limiter, clock, 0.01, 50, priority=PRIORITY_COMMITS)
+            before = limiter.limit
+            lowest = self._run(limiter, clock, 0.5, 50, priority=PRIORITY_OBJECTS)
+            self.assertEqual(lowest, before)
+
+            # a rise within the class is congestion
+            before = limiter.limit
+            lowest = self._run(limiter, clock, 0.1, 50, priority=PRIORITY_COMMITS)
+        self.assertLess(lowest, before)
+
+    def test_priority_order(self):
+        """Free slots go to the waiters of highest priority first"""
+        limiter = AIMDLimiter(initial=1)
+        order = []
+
+        async def job(priority, name):
+            await limiter.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0)
+            limiter.release()
+
+        async def run():
+            await limiter.acquire(PRIORITY_OBJECTS)
+            jobs = [
+                asyncio.ensure_future(job(PRIORITY_OBJECTS, "object")),
+                asyncio.ensure_future(job(PRIORITY_COMMITS, "commit")),
+            ]
+            await asyncio.sleep(0)
+            limiter.release()
+            await asyncio.gather(*jobs)
+
+        asyncio.run(run())
+        self.assertEqual(order, ["commit", "object"])
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_no_cap(self):
+        self.assertEqual(TokenBucket().reserve(10**9), 0)
+
+    def test_debt(self):
+        """Taking more than the burst makes the caller wait for the debt"""
+        bucket = TokenBucket(rate=1000)
+        self.assertEqual(bucket.reserve(1000), 0)
+        self.assertAlmostEqual(bucket.reserve(500), 0.5, places=2)
+
+
+class TransferEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff_base = engine.BACKOFF_BASE
+        engine.BACKOFF_BASE = 0.001
+        self.engine = TransferEngine()
+
+    def tearDown(self):
+        engine.BACKOFF_BASE = self.backoff_base
+
+    def test_map(self):
+        """Results keep the order of items, and progress is aggregated"""
+        reports = []
+
+        def job(item, on_bytes):
+            on_bytes(item)
+            return item * 2
+
+        result = self.engine.map(
+            job,
+            list(range(10)),
+            progress_callback=lambda total_files, total_bytes: reports.append(
+                (total_files, total_bytes)
+            ),
+        )
+        self.assertEqual(result, [each * 2 for each in range(10)])
+        self.assertEqual(reports[-1], (None, None))
+        self.assertEqual(reports[-2], (10, 45))
+
+    def test_retry_throttled(self):
+        """Throttled jobs are retried and the concurrency is decreased"""
+        attempts = {}
+        lock = threading.Lock()
+
+        def job(item, on_bytes):
+            with lock:
+                attempts[item] = attempts.get(item, 0) + 1
+                if attempts[item] < 3:
+                    raise Throttled()
+            return item
+
+        concurrency = self.engine.concurrency
+        result = self.engine.map(
+            job, [1, 2, 3], is_throttle=lambda e: isinstance(e, Throttled)
+        )
+        self.assertEqual(result, [1, 2, 3])
+        self.assertEqual(attempts, {1: 3, 2: 3, 3: 3})
+        self.assertLess(self.engine.concurrency, concurrency)
+
+    def test_raise(self):
+        """Other errors are raised without retry"""
+        attempts = []
+
+        def job(item, on_bytes):
+            attempts.append(item)
+            raise ValueError(item)
+
+        with self.assertRaises(ValueError):
+            self.engine.map(job, [1], is_throttle=lambda e: isinstance(e, Throttled))
+        self.assertEqual(attempts, [1])
+
+    def test_failure_cancels(self):
+        """A failed job stops the others, which free their slots"""
+        started, finished = [], []
+        lock = threading.Lock()
+
+        def job(item, on_bytes):
+            with lock:
+                started.append(item)
+            if item == 0:
+                raise ValueError(item)
+            time.sleep(0.05)
+            with lock:
+                finished.append(item)
+            return item
+
+        with self.assertRaises(ValueError):
+            self.engine.map(job, list(range(200)))
+        self.assertLess(len(started), 200)
+        self.assertEqual(sorted(finished), sorted(started[1:]))
+        self.assertEqual(self.engine._limiter._in_flight, 0)
+        self.assertEqual(self.engine._limiter._waiters, [])
+
+    def test_bandwidth(self):
+        """The bandwidth cap paces the jobs"""
+        capped = TransferEngine(bandwidth=10000)
+        start = time.monotonic()
+        capped.map(lambda item, on_bytes: item, [1, 2, 3], sizes=[10000] * 3)
+        self.assertGreater(time.monotonic() - start, 1.5)
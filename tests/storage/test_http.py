@@ -0,0 +1,122 @@
+"""Test the read-only HTTP storage against a static file server"""
+import functools
+import os
+import shutil
+import threading
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.storage.backends import http
+from god.storage.backends.http import HTTPStorage
+from god.storage.backends.local import LocalStorage
+from god.utils.common import get_string_hash
+from god.utils.exceptions import OperationNotPermitted
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(QuietHandler):
+    """Static file server that keeps connections alive and answers byte ranges"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not header or not os.path.isfile(path):
+            return super().do_GET()
+
+        start, end = (int(each) for each in header[len("bytes=") :].split("-"))
+        size = os.path.getsize(path)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        end = min(end, size - 1)
+        with open(path, "rb") as fi:
+            fi.seek(start)
+            data = fi.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class HTTPStorageTest(unittest.TestCase):
+    handler = QuietHandler
+
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/http").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.root = self.cache_dir / "root"
+        self.local = LocalStorage(f"file://{self.root}")
+
+        self.hashes, self.paths = [], []
+        for idx in range(20):
+            content = f"object {idx} " * (idx * 50)
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.local.store_objects(paths=self.paths, hash_values=self.hashes)
+        Path(self.root, "refs").mkdir()
+        Path(self.root, "refs", "main").write_text("commit")
+
+        self.range_size = http.RANGE_SIZE
+        http.RANGE_SIZE = 1000
+        self.user_cache = mock.patch.object(
+            c, "DIR_USER_CACHE", str(self.cache_dir / "user")
+        )
+        self.user_cache.start()
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(self.handler, directory=str(self.root))
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.storage = HTTPStorage(f"http://127.0.0.1:{self.server.server_address[1]}/")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.user_cache.stop()
+        http.RANGE_SIZE = self.range_size
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_objects(self):
+        """Objects are downloaded and verified, large ones in ranges if supported"""
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(20)]
+        self.storage.get_objects(hash_values=self.hashes, paths=targets)
+        for source, target in zip(self.paths, targets):
+            self.assertEqual(Path(source).read_text(), Path(target).read_text())
+
+    def test_have_list(self):
+        self.assertEqual(
+            self.storage.have_objects([self.hashes[0], "0" * 64]), [True, False]
+        )
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes))
+        self.assertEqual(list(self.storage.list_refs()), ["main"])
+
+    def test_refs(self):
+        target = self.cache_dir / "main"
+        self.storage.get_refs(refs=["main"], paths=[str(target)])
+        self.assertEqual(target.read_text(), "commit")
+        self.assertEqual(self.storage.have_refs(["main", "other"]), [True, False])
+
+    def test_read_only(self):
+        with self.assertRaises(OperationNotPermitted):
+            self.storage.store_objects(paths=self.paths[:1], hash_values=["0" * 64])
+        with self.assertRaises(OperationNotPermitted):
+            self.storage.delete_objects(self.hashes[:1])
+
+
+class HTTPRangeStorageTest(HTTPStorageTest):
+    handler = RangeHandler
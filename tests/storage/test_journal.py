@@ -0,0 +1,64 @@
+"""Test resumable transfers with the transfer journal"""
+import shutil
+import unittest
+from pathlib import Path
+
+from god.storage.backends.base import partial_path
+from god.storage.backends.local import LocalStorage
+from god.storage.journal import TransferJournal
+from god.storage.transfer import transfer
+from god.utils.common import get_string_hash
+
+
+class TransferJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/journal").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.journal_dir = self.cache_dir / "transfers"
+        self.source = LocalStorage(f"file://{self.cache_dir / 'source'}")
+        self.target = LocalStorage(f"file://{self.cache_dir / 'target'}")
+
+        self.hashes, paths = [], []
+        for idx in range(10):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.source.store_objects(paths=paths, hash_values=self.hashes)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_resume(self):
+        """A reopened journal has the plan, and the done and in-flight hashes"""
+        journal = TransferJournal(self.journal_dir, "push-1")
+        self.assertFalse(journal.resumed)
+        journal.set_plan({"objects": self.hashes})
+        journal.start("objects", self.hashes[:6])
+        journal.done("objects", self.hashes[:3])
+
+        journal = TransferJournal(self.journal_dir, "push-1")
+        self.assertTrue(journal.resumed)
+        self.assertEqual(journal.get_plan(), {"objects": self.hashes})
+        self.assertEqual(journal.pending("objects", self.hashes), self.hashes[3:])
+        self.assertEqual(journal.in_flight("objects"), sorted(self.hashes[3:6]))
+
+        journal.close()
+        self.assertFalse((self.journal_dir / "push-1").exists())
+
+    def test_transfer(self):
+        """Done hashes are skipped and partial downloads are removed"""
+        journal = TransferJournal(self.journal_dir, "fetch-1")
+        journal.start("objects", self.hashes[:2])
+        journal.done("objects", self.hashes[:1])
+        partial = partial_path(self.target.local_paths(self.hashes[1:2], "objects")[0])
+        Path(partial).parent.mkdir(parents=True)
+        Path(partial).write_text("partial")
+
+        transfer(self.source, self.target, self.hashes, "objects", journal=journal)
+        self.assertFalse(Path(partial).exists())
+        self.assertEqual(set(self.target.list_objects()), set(self.hashes[1:]))
+        self.assertEqual(journal.pending("objects", self.hashes), [])
@@ -0,0 +1,160 @@
+"""Test the fan-out layout of storages"""
+import shutil
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from god.storage.backends.local import LocalStorage
+from god.storage.backends.striped import StripedStorage
+from god.storage.backends.tiered import TieredStorage
+from god.storage.layout import LAYOUT_FILE, Layout, relayout
+from god.utils.common import get_string_hash
+
+
+class LayoutTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(Layout().split("abcdef"), ["ab", "cd", "ef"])
+        self.assertEqual(
+            Layout(depth=3, width=1).split("abcdef"), list("abc") + ["def"]
+        )
+        self.assertEqual(Layout(depth=0).split("abcdef"), ["abcdef"])
+
+    def test_shards(self):
+        self.assertEqual(len(Layout(width=1).shards()), 16)
+        self.assertEqual(Layout(depth=0).shards(), [""])
+        moving = Layout(depth=3, width=1, previous=Layout())
+        self.assertEqual(len(moving.shards()), 16 + 256)
+
+    def test_dumps_loads(self):
+        layout = Layout(depth=3, width=1, previous=Layout())
+        loaded = Layout.loads(layout.dumps())
+        self.assertEqual(loaded, layout)
+        self.assertEqual(loaded.previous, Layout())
+
+
+class RelayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/layout").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.patches = [
+            mock.patch(f"{module}.LAYOUT_RELOAD_INTERVAL", 0)
+            for module in ["god.storage.layout", "god.storage.backends.base"]
+        ]
+        for each in self.patches:
+            each.start()
+        self.base_path = self.cache_dir / "storage"
+        self.storage = LocalStorage(f"file://{self.base_path}")
+
+        self.hashes, self.paths = [], []
+        for idx in range(20):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+
+    def tearDown(self):
+        for each in self.patches:
+            each.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _write(self, name):
+        path = self.cache_dir / name
+        path.write_text(name)
+        return str(path), get_string_hash(name)
+
+    def _get(self, storage, hash_values):
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(len(hash_values))]
+        storage.get_objects(hash_values=hash_values, paths=targets)
+        return [Path(each).read_text() for each in targets]
+
+    def test_relayout(self):
+        """Objects move to their new paths and stay readable"""
+        self.assertEqual(relayout(self.storage, depth=3, width=1), 20)
+        hash_value = self.hashes[0]
+        new_path = Path(self.base_path, "objects", *hash_value[:3], hash_value[3:])
+        self.assertTrue(new_path.is_file())
+        self.assertFalse(
+            Path(self.base_path, "objects", hash_value[:2], hash_value[2:4]).exists()
+        )
+
+        # the layout is recorded, so a new instance uses it
+        storage = LocalStorage(f"file://{self.base_path}")
+        self.assertEqual(storage._layout, Layout(depth=3, width=1))
+        self.assertIsNone(storage._layout.previous)
+        self.assertEqual(
+            self._get(storage, self.hashes), [f"object {idx}" for idx in range(20)]
+        )
+        self.assertEqual(sorted(storage.list_objects()), sorted(self.hashes))
+        self.assertEqual(relayout(storage, depth=3, width=1), 0)
+
+    def test_interrupted(self):
+        """During a re-layout, hashes not yet moved are read from their old paths"""
+        moving = Layout(depth=1, width=2, previous=Layout())
+        Path(self.base_path, LAYOUT_FILE).write_text(moving.dumps())
+        storage = LocalStorage(f"file://{self.base_path}")
+
+        self.assertTrue(all(storage.have_objects(self.hashes)))
+        self.assertEqual(
+            self._get(storage, self.hashes[:3]), [f"object {idx}" for idx in range(3)]
+        )
+        self.assertEqual(sorted(storage.list_objects()), sorted(self.hashes))
+
+        with self.assertRaises(RuntimeError):
+            relayout(storage, depth=3, width=1)
+        self.assertEqual(relayout(storage, depth=1, width=2), 20)
+        hash_value = self.hashes[0]
+        self.assertTrue(
+            Path(self.base_path, "objects", hash_value[:2], hash_value[2:]).is_file()
+        )
+
+    def test_running_process(self):
+        """A process that read the layout before the re-layout keeps working"""
+        stale = LocalStorage(f"file://{self.base_path}")
+        relayout(self.storage, depth=3, width=1)
+        self.assertEqual(stale._layout, Layout())
+
+        self.assertEqual(self._get(stale, self.hashes[:2]), ["object 0", "object 1"])
+        self.assertEqual(stale._layout, Layout(depth=3, width=1))
+
+        stale._layout = Layout()
+        path, hash_value = self._write("new object")
+        stale.store_objects(paths=[path], hash_values=[hash_value])
+        self.assertTrue(
+            Path(self.base_path, "objects", *hash_value[:3], hash_value[3:]).is_file()
+        )
+        self.assertTrue(all(self.storage.have_objects([hash_value])))
+
+    def test_striped(self):
+        """Each root of a striped storage is re-laid out"""
+        roots = [self.cache_dir / f"disk{idx}" for idx in range(2)]
+        storage = StripedStorage("striped://" + ",".join(str(each) for each in roots))
+        storage.store_objects(paths=self.paths, hash_values=self.hashes)
+
+        self.assertEqual(relayout(storage, depth=1, width=3), 20)
+        for root in roots:
+            self.assertEqual(
+                LocalStorage(f"file://{root}")._layout, Layout(depth=1, width=3)
+            )
+        storage = StripedStorage("striped://" + ",".join(str(each) for each in roots))
+        self.assertEqual(storage._layout, Layout(depth=1, width=3))
+        self.assertEqual(
+            self._get(storage, self.hashes), [f"object {idx}" for idx in range(20)]
+        )
+
+    def test_tiered(self):
+        """The hot tier of a tiered storage is re-laid out, the cold tier is not"""
+        hot, cold = self.cache_dir / "hot", self.cache_dir / "cold"
+        storage = TieredStorage(f"tiered://file://{hot}?cold=file://{cold}")
+        storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        storage.wait()
+
+        self.assertEqual(relayout(storage, depth=1, width=3), 20)
+        self.assertEqual(storage._layout, Layout(depth=1, width=3))
+        self.assertEqual(LocalStorage(f"file://{cold}")._layout, Layout())
+        self.assertEqual(
+            self._get(storage, self.hashes), [f"object {idx}" for idx in range(20)]
+        )
@@ -0,0 +1,130 @@
+"""Test the local filesystem storage"""
+import shutil
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.storage.backends.base import partial_path, write_verified
+from god.storage.backends.local import LocalStorage
+from god.utils.common import get_string_hash
+from god.utils.exceptions import IntegrityError
+
+
+class LocalStorageListTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/local").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.storage_dir = self.cache_dir / "storage"
+        self.storage_dir.mkdir(parents=True)
+        self.storage = LocalStorage(f"file://{self.storage_dir}")
+
+        self.hashes, paths = [], []
+        for idx in range(50):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.storage.store_objects(paths=paths, hash_values=self.hashes)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_list_objects(self):
+        """List exactly the stored objects, without directories"""
+        (self.storage_dir / "objects" / "ab" / "empty").mkdir(parents=True)
+        result = list(self.storage.list_objects())
+        self.assertEqual(len(result), len(self.hashes))
+        self.assertEqual(set(result), set(self.hashes))
+
+    def test_skip_temporary(self):
+        """Partial downloads and other temporary files are not hashes"""
+        path = self.storage._hash_path(self.hashes[0], prefix="objects")
+        Path(partial_path(path)).write_text("partial")
+        Path(f"{path}.rebalance").write_text("moving")
+        self.assertEqual(set(self.storage.list_objects()), set(self.hashes))
+        self.assertEqual(self.storage.rebuild_index("objects"), len(self.hashes))
+
+    def test_interrupted_store(self):
+        """An interrupted store leaves no file at the storage path, and is redone"""
+        content = "interrupted"
+        hash_value = get_string_hash(content)
+        source = self.cache_dir / "interrupted"
+        source.write_text(content)
+        path = self.storage._hash_path(hash_value, prefix="objects")
+
+        def copy(src, dst):
+            Path(dst).write_text(content[:3])
+            raise KeyboardInterrupt()
+
+        with mock.patch("shutil.copy", side_effect=copy):
+            with self.assertRaises(KeyboardInterrupt):
+                self.storage.store_objects(
+                    paths=[str(source)], hash_values=[hash_value]
+                )
+        self.assertFalse(Path(path).exists())
+        self.assertFalse(Path(partial_path(path)).exists())
+
+        self.storage.store_objects(paths=[str(source)], hash_values=[hash_value])
+        self.assertEqual(Path(path).read_text(), content)
+
+    def test_list_empty(self):
+        """List nothing when the storage has no commits"""
+        self.assertEqual(list(self.storage.list_commits()), [])
+
+
+class LocalStorageGetTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/local-get").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.storage = LocalStorage(f"file://{self.cache_dir / 'storage'}")
+
+        self.hashes, paths = [], []
+        for idx in range(5):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.storage.store_objects(paths=paths, hash_values=self.hashes)
+        self.paths = [str(self.cache_dir / f"out{idx}") for idx in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_verified(self):
+        self.storage.get_objects(hash_values=self.hashes, paths=self.paths)
+        for idx, path in enumerate(self.paths):
+            self.assertEqual(Path(path).read_text(), f"object {idx}")
+
+    def test_get_corrupted(self):
+        """A corrupted object is quarantined instead of written to the target"""
+        stored = self.storage.local_paths(self.hashes[:1], prefix="objects")[0]
+        Path(stored).write_text("corrupted")
+
+        with mock.patch.object(c, "DIR_USER_CACHE", str(self.cache_dir / "user")):
+            with self.assertRaises(IntegrityError):
+                self.storage.get_objects(hash_values=self.hashes, paths=self.paths)
+
+        self.assertFalse(Path(self.paths[0]).exists())
+        quarantine = self.cache_dir / "user" / c.DIR_QUARANTINE / self.hashes[0]
+        self.assertEqual(
+            [each.read_text() for each in quarantine.iterdir()], ["corrupted"]
+        )
+
+    def test_interrupted_write(self):
+        """A failed or interrupted write leaves no partial file"""
+
+        def chunks(error):
+            yield b"object"
+            raise error
+
+        for error in [OSError("reset"), KeyboardInterrupt()]:
+            with self.assertRaises(type(error)):
+                write_verified(self.paths[0], chunks(error), self.hashes[0])
+            self.assertFalse(Path(partial_path(self.paths[0])).exists())
+            self.assertFalse(Path(self.paths[0]).exists())
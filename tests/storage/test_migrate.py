@@ -0,0 +1,69 @@
+"""Test migrating data between storages"""
+import json
+import shutil
+import unittest
+from pathlib import Path
+
+from god.storage.backends.base import partial_path
+from god.storage.backends.local import LocalStorage
+from god.storage.migrate import migrate
+from god.utils.common import get_string_hash
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/migrate").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.source = LocalStorage(f"file://{self.cache_dir / 'source'}")
+        self.target = LocalStorage(f"file://{self.cache_dir / 'target'}")
+        self.checkpoint_file = self.cache_dir / "checkpoint.json"
+
+        self.hashes, paths = [], []
+        for idx in range(30):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.source.store_objects(paths=paths, hash_values=self.hashes)
+        self.source.store_commits(paths=paths[:2], hash_values=self.hashes[:2])
+        self.target.store_objects(paths=paths[:5], hash_values=self.hashes[:5])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_migrate(self):
+        """Only the hashes that target lacks are migrated"""
+        n_migrated = migrate(self.source, self.target, self.checkpoint_file)
+        self.assertEqual(n_migrated, 27)
+        self.assertEqual(set(self.target.list_objects()), set(self.hashes))
+        self.assertEqual(set(self.target.list_commits()), set(self.hashes[:2]))
+        self.assertFalse(self.checkpoint_file.exists())
+
+    def test_resume(self):
+        """Shards recorded in the checkpoint are skipped"""
+        skipped = self.hashes[10][:2]
+        with self.checkpoint_file.open("w") as fo:
+            json.dump([f"objects/{skipped}"], fo)
+
+        migrate(self.source, self.target, self.checkpoint_file)
+        expected = {
+            each
+            for idx, each in enumerate(self.hashes)
+            if idx < 5 or not each.startswith(skipped)
+        }
+        self.assertEqual(set(self.target.list_objects()), expected)
+
+    def test_skip_temporary(self):
+        """Temporary files next to the hashes are not migrated"""
+        path = self.source._hash_path(self.hashes[0], prefix="objects")
+        Path(partial_path(path)).write_text("partial")
+        migrate(self.source, self.target, self.checkpoint_file)
+        self.assertEqual(set(self.target.list_objects()), set(self.hashes))
+        self.assertFalse(
+            Path(
+                partial_path(self.target._hash_path(self.hashes[0], "objects"))
+            ).exists()
+        )
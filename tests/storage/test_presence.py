@@ -0,0 +1,110 @@
+"""Test the persistent presence index"""
+import shutil
+import unittest
+from pathlib import Path
+
+import god.storage.presence as presence
+from god.storage.backends.local import LocalStorage
+from god.storage.presence import PresenceIndex
+from god.utils.common import get_string_hash
+
+
+class PresenceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/presence").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.hashes = [get_string_hash(f"hash {idx}") for idx in range(100)]
+        self.index = PresenceIndex(self.cache_dir, "objects")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_rebuild(self):
+        """The rebuilt index contains exactly the listed hashes"""
+        self.index.rebuild(self.hashes[:50])
+        self.assertTrue(self.index.complete)
+        self.assertEqual(self.index.contains(self.hashes), [True] * 50 + [False] * 50)
+
+    def test_journal(self):
+        """Added and removed hashes are seen by other readers of the index"""
+        self.index.rebuild(self.hashes[:50])
+        self.index.add(self.hashes[50:60])
+        self.index.remove(self.hashes[:10])
+
+        other = PresenceIndex(self.cache_dir, "objects")
+        expected = [False] * 10 + [True] * 50 + [False] * 40
+        self.assertEqual(other.contains(self.hashes), expected)
+
+    def test_compact(self):
+        """Compaction merges the journal into the sorted digests"""
+        self.index.add(self.hashes[:30])
+        self.index.remove(self.hashes[:5])
+        self.index.add(self.hashes[:2])
+
+        original = presence.COMPACT_SIZE
+        presence.COMPACT_SIZE = 1
+        try:
+            self.index.add(self.hashes[30:31])
+        finally:
+            presence.COMPACT_SIZE = original
+
+        self.assertEqual(
+            (self.cache_dir / "objects.journal").stat().st_size, 0, "Not compacted"
+        )
+        expected = [True] * 2 + [False] * 3 + [True] * 26 + [False] * 69
+        self.assertEqual(self.index.contains(self.hashes), expected)
+        self.assertFalse(self.index.complete)
+
+    def test_unindexable(self):
+        """Hashes that are not sha256 hex digests are never in the index"""
+        self.index.add(["abc", "z" * 64])
+        self.assertEqual(self.index.contains(["abc", "z" * 64]), [False, False])
+
+
+class LocalStoragePresenceTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/local_presence").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.storage_dir = self.cache_dir / "storage"
+        self.storage_dir.mkdir(parents=True)
+        self.storage = LocalStorage(f"file://{self.storage_dir}")
+
+        self.hashes, self.paths = [], []
+        for idx in range(10):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_store_delete(self):
+        """Stores and deletes keep the index of a new storage complete"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.storage.delete_objects(self.hashes[:3])
+
+        index = self.storage.presence(self.storage.OBJECTS_PREFIX)
+        self.assertTrue(index.complete)
+        self.assertEqual(index.contains(self.hashes), [False] * 3 + [True] * 7)
+        self.assertEqual(
+            self.storage.have_objects(self.hashes), [False] * 3 + [True] * 7
+        )
+
+    def test_rebuild_index(self):
+        """The index of an existing storage is rebuilt from its listing"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        shutil.rmtree(self.storage_dir / "presence")
+
+        storage = LocalStorage(f"file://{self.storage_dir}")
+        index = storage.presence(storage.OBJECTS_PREFIX)
+        self.assertFalse(index.complete)
+        self.assertEqual(storage.have_objects(self.hashes), [True] * 10)
+
+        self.assertEqual(storage.rebuild_index(storage.OBJECTS_PREFIX), 10)
+        self.assertTrue(index.complete)
+        self.assertEqual(index.contains(self.hashes), [True] * 10)
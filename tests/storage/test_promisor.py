@@ -0,0 +1,63 @@
+"""Test on-demand object fetching for partial clones"""
+import shutil
+import unittest
+from pathlib import Path
+
+from god.init import init
+from god.remote import get_remote_declaration_config_path
+from god.remote.base import set_promisor_remote, set_remote
+from god.storage.backends.local import LocalStorage
+from god.storage.promisor import fetch_missing_objects
+from god.utils.common import get_string_hash
+
+
+class FetchMissingObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/promisor").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.repo_dir = self.cache_dir / "repo"
+        self.remote_dir = self.cache_dir / "remote"
+        self.repo_dir.mkdir(parents=True)
+        self.remote_dir.mkdir(parents=True)
+        init(self.repo_dir)
+
+        self.remote = LocalStorage(f"file://{self.remote_dir}")
+        self.local = LocalStorage(f"file://{self.repo_dir / '.god'}")
+        self.hashes, paths = [], []
+        for idx in range(3):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.remote.store_objects(paths=paths, hash_values=self.hashes)
+        self.local.store_objects(paths=paths[:1], hash_values=self.hashes[:1])
+
+        self.config_path = get_remote_declaration_config_path(str(self.repo_dir))
+        set_remote(
+            name="origin",
+            location=f"file://{self.remote_dir}",
+            remote_config_path=self.config_path,
+            ref_remotes_dir=self.repo_dir / ".god" / "refs" / "remotes",
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_no_promisor(self):
+        """Repo that is not partial clone does not fetch anything"""
+        fetched = fetch_missing_objects(
+            self.local, self.hashes, base_dir=str(self.repo_dir)
+        )
+        self.assertEqual(fetched, [])
+        self.assertEqual(self.local.have_objects(self.hashes), [True, False, False])
+
+    def test_fetch_missing(self):
+        """Only the missing objects are fetched from promisor"""
+        set_promisor_remote(name="origin", remote_config_path=self.config_path)
+        fetched = fetch_missing_objects(
+            self.local, self.hashes, base_dir=str(self.repo_dir)
+        )
+        self.assertCountEqual(fetched, self.hashes[1:])
+        self.assertEqual(self.local.have_objects(self.hashes), [True, True, True])
@@ -0,0 +1,313 @@
+"""Test the S3 storage against a mocked S3
+
+The storage tests need `moto`, they are skipped without it.
+"""
+import contextlib
+import importlib.util
+import io
+import os
+import shutil
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+import god.storage.constants as c
+from god.utils.common import get_string_hash
+
+HAS_MOTO = importlib.util.find_spec("moto") is not None
+BUCKET = "god-test"
+# the key prefix of the objects of the tested storage
+OBJECTS = "repo/objects/"
+
+
+class CountingClient:
+    """Wrap an S3 client, count its calls and optionally replace some of them
+
+    Args:
+        client: the S3 client to wrap
+        overrides: the replacement of each method, called with the real method
+    """
+
+    def __init__(self, client, **overrides):
+        self._client = client
+        self._overrides = overrides
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        override = self._overrides.get(name)
+
+        def call(*args, **kwargs):
+            with self._lock:
+                self.calls.append((name, kwargs))
+            if override is not None:
+                return override(method, *args, **kwargs)
+            return method(*args, **kwargs)
+
+        return call
+
+    def count(self, name: str, prefix: str = "") -> int:
+        """The number of calls of `name`, on keys that start with `prefix`"""
+        return len(self.kwargs(name, prefix))
+
+    def kwargs(self, name: str, prefix: str = "") -> list:
+        """The arguments of each call of `name`, on keys that start with `prefix`"""
+        return [
+            kwargs
+            for each, kwargs in self.calls
+            if each == name and kwargs.get("Key", "").startswith(prefix)
+        ]
+
+
+@unittest.skipUnless(HAS_MOTO, "needs moto")
+class S3StorageTest(unittest.TestCase):
+    def setUp(self):
+        import boto3
+        from moto import mock_aws
+
+        from god.storage.backends.s3 import S3Storage
+
+        self.cache_dir = Path(".cache/tests/storage/s3").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+
+        self.patches = [
+            mock.patch.dict(
+                os.environ,
+                {
+                    "AWS_ACCESS_KEY_ID": "testing",
+                    "AWS_SECRET_ACCESS_KEY": "testing",
+                    "AWS_DEFAULT_REGION": "us-east-1",
+                },
+            ),
+            mock.patch.object(c, "DIR_USER_CACHE", str(self.cache_dir / "user")),
+            mock_aws(),
+        ]
+        for each in self.patches:
+            each.start()
+        self.client = boto3.client("s3")
+        self.client.create_bucket(Bucket=BUCKET)
+        self.storage = S3Storage(f"s3://{BUCKET}/repo")
+
+        self.hashes, self.paths = [], []
+        for idx in range(10):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+    def tearDown(self):
+        for each in reversed(self.patches):
+            each.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _key(self, hash_value: str) -> str:
+        return self.storage._hash_path(hash_value, prefix=self.storage.OBJECTS_PREFIX)
+
+    def _count(self, **overrides) -> CountingClient:
+        """Route the calls of the storage through a counting client"""
+        client = CountingClient(self.client, **overrides)
+        patch = mock.patch.object(self.storage._clients, "get", return_value=client)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return client
+
+    def test_client_pool(self):
+        """The pool has 1 session, and 1 client per thread that is reused"""
+        pool = self.storage._clients
+        self.assertIs(pool.get(), pool.get())
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(pool.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], pool.get())
+
+        with mock.patch("boto3.session.Session") as session:
+            self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        session.assert_not_called()
+        self.assertTrue(all(self.storage.have_objects(self.hashes)))
+
+    def test_progress(self):
+        """Storing shows a progress bar on a terminal, unless GOD_PROGRESS=0"""
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.storage.store_objects(
+                paths=self.paths[:3], hash_values=self.hashes[:3]
+            )
+        self.assertEqual(stderr.getvalue(), "")
+
+        stderr.isatty = lambda: True
+        with mock.patch.dict(os.environ, {"GOD_PROGRESS": "0"}):
+            with contextlib.redirect_stderr(stderr):
+                self.storage.store_objects(
+                    paths=self.paths[3:6], hash_values=self.hashes[3:6]
+                )
+        self.assertEqual(stderr.getvalue(), "")
+
+        with contextlib.redirect_stderr(stderr):
+            self.storage.store_objects(
+                paths=self.paths[6:10], hash_values=self.hashes[6:10]
+            )
+        self.assertIn("4/4", stderr.getvalue())
+
+    def test_conditional_put(self):
+        """Small files are put with IfNoneMatch, an existing key is not replaced"""
+        key = self._key(self.hashes[0])
+        self.client.put_object(Bucket=BUCKET, Key=key, Body=b"stored")
+        client = self._count()
+        self.storage.store_objects(paths=self.paths[:2], hash_values=self.hashes[:2])
+
+        puts = client.kwargs("put_object", OBJECTS)
+        self.assertEqual(len(puts), 2)
+        self.assertTrue(all(each["IfNoneMatch"] == "*" for each in puts))
+        self.assertEqual(client.count("head_object"), 0)
+        body = self.client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+        self.assertEqual(body, b"stored")
+
+    def test_conditional_put_unsupported(self):
+        """Servers that reject IfNoneMatch get a HEAD, then a plain put"""
+
+        def put_object(method, **kwargs):
+            if "IfNoneMatch" in kwargs:
+                raise ClientError(
+                    {
+                        "Error": {"Code": "NotImplemented", "Message": "no"},
+                        "ResponseMetadata": {"HTTPStatusCode": 501},
+                    },
+                    "PutObject",
+                )
+            return method(**kwargs)
+
+        key = self._key(self.hashes[0])
+        self.client.put_object(Bucket=BUCKET, Key=key, Body=b"stored")
+        client = self._count(put_object=put_object)
+        self.storage.store_objects(paths=self.paths[:5], hash_values=self.hashes[:5])
+        self.assertFalse(self.storage._conditional_put)
+        body = self.client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+        self.assertEqual(body, b"stored")
+
+        # later uploads skip the conditional put
+        client.calls = []
+        self.storage.store_objects(paths=self.paths[5:], hash_values=self.hashes[5:])
+        self.assertEqual(client.count("head_object", OBJECTS), 5)
+        self.assertEqual(
+            [each.get("IfNoneMatch") for each in client.kwargs("put_object", OBJECTS)],
+            [None] * 5,
+        )
+        self.assertTrue(all(self.storage.have_objects(self.hashes)))
+
+    def test_delete_batches(self):
+        """Keys are deleted in requests of at most 1000 keys"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        keys = [self._key(each) for each in self.hashes]
+        keys += [f"repo/objects/missing/{idx}" for idx in range(2500)]
+        client = self._count()
+        self.assertEqual(self.storage._delete(keys), {})
+
+        sizes = sorted(
+            len(kwargs["Delete"]["Objects"])
+            for name, kwargs in client.calls
+            if name == "delete_objects"
+        )
+        self.assertEqual(sizes, [510, 1000, 1000])
+        self.assertFalse(any(self.storage._have(keys[: len(self.hashes)])))
+
+    def test_delete_errors(self):
+        """The errors of each key, and of each failed request, are reported"""
+
+        def delete_objects(method, **kwargs):
+            keys = [each["Key"] for each in kwargs["Delete"]["Objects"]]
+            if failed_batch in keys:
+                raise ClientError(
+                    {"Error": {"Code": "InternalError", "Message": "boom"}},
+                    "DeleteObjects",
+                )
+            response = method(**kwargs)
+            response["Errors"] = [
+                {"Key": denied, "Code": "AccessDenied", "Message": "denied"}
+            ]
+            return response
+
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        keys = [self._key(each) for each in self.hashes]
+        denied, failed_batch = keys[0], keys[-1]
+        self._count(delete_objects=delete_objects)
+        with mock.patch("god.storage.backends.s3.DELETE_BATCH_SIZE", 5):
+            errors = self.storage._delete(keys)
+
+        self.assertEqual(errors[denied], "AccessDenied: denied")
+        self.assertEqual(sorted(errors), sorted([denied] + keys[5:]))
+        self.assertTrue(all("InternalError" in errors[each] for each in keys[5:]))
+
+    def test_probe_list_or_head(self):
+        """A shard is listed when that takes fewer requests than its HEADs"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        crowded = [self.hashes[0]] + [
+            self.hashes[0][:-2] + f"{idx:02x}" for idx in range(3)
+        ]
+        keys = [self._key(each) for each in crowded + self.hashes[1:2]]
+        self.assertEqual(len({os.path.dirname(each) for each in keys[:4]}), 1)
+        expected = [True, False, False, False, True]
+
+        # 1 page lists the crowded shard, the lone key gets a HEAD
+        client = self._count()
+        self.assertEqual(self.storage._probe(keys), expected)
+        self.assertEqual(client.count("get_paginator"), 1)
+        self.assertEqual(client.count("head_object"), 1)
+
+        # shards are now expected to need 5 pages, 4 HEADs are cheaper
+        client.calls = []
+        self.storage._shard_size = 5 * 1000
+        self.assertEqual(self.storage._probe(keys), expected)
+        self.assertEqual(client.count("get_paginator"), 0)
+        self.assertEqual(client.count("head_object"), 5)
+
+    def test_probe_empty_storage(self):
+        """An empty storage answers without a request per key, and is asked once"""
+        client = self._count()
+        keys = [self._key(each) for each in self.hashes]
+        self.assertEqual(self.storage._probe(keys), [False] * len(keys))
+        self.assertEqual(self.storage._probe(keys[:2]), [False] * 2)
+        self.assertEqual([name for name, _ in client.calls], ["list_objects_v2"])
+
+        self.storage.store_objects(paths=self.paths[:1], hash_values=self.hashes[:1])
+        client.calls = []
+        self.assertEqual(self.storage._probe(keys[:2]), [True, False])
+        self.assertEqual(client.count("list_objects_v2"), 0)
+
+    def test_present_keys_cap(self):
+        """Only the most recently seen keys are remembered to exist"""
+        with mock.patch("god.storage.backends.s3.MAX_PRESENT_KEYS", 3):
+            self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+            self.assertEqual(len(self.storage._present), 3)
+            self.assertTrue(all(self.storage._have([self._key(self.hashes[0])])))
+            self.assertIn(self._key(self.hashes[0]), self.storage._present)
+            self.assertEqual(len(self.storage._present), 3)
+
+    def test_manifest(self):
+        """Stored, copied and deleted hashes are recorded in the manifest"""
+        from god.storage.backends.s3 import S3Storage
+        from god.storage.manifest import list_segments, read_segments
+
+        def manifest(storage):
+            kind = storage.OBJECTS_PREFIX
+            return read_segments(storage, kind, list_segments(storage, kind))
+
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.assertEqual(manifest(self.storage), (set(self.hashes), set()))
+
+        other = S3Storage(f"s3://{BUCKET}/other")
+        other.copy_hashes(self.storage, self.hashes[:3], other.OBJECTS_PREFIX)
+        self.assertEqual(manifest(other), (set(self.hashes[:3]), set()))
+
+        self.storage.delete_objects(self.hashes[:2])
+        self.assertEqual(
+            manifest(self.storage), (set(self.hashes[2:]), set(self.hashes[:2]))
+        )
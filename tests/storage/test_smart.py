@@ -0,0 +1,214 @@
+"""Test the smart HTTP transport: `god serve` and its client storage"""
+import http.client
+import json
+import os
+import shutil
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.storage.backends.http import HTTPStatusError
+from god.storage.backends.local import LocalStorage
+from god.storage.backends.smart import SmartHTTPStorage
+from god.storage.server import TOKEN_ENV, StorageServer, bitmap, unbitmap
+from god.utils.common import get_string_hash
+
+
+class BitmapTest(unittest.TestCase):
+    def test_roundtrip(self):
+        flags = [True, False, False, True, True, False, True, False, True]
+        self.assertEqual(len(bitmap(flags)), 2)
+        self.assertEqual(unbitmap(bitmap(flags), len(flags)), flags)
+
+
+class SmartHTTPStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/smart").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.local = LocalStorage(f"file://{self.cache_dir / 'served'}")
+        self.refs_dir = self.cache_dir / "refs"
+        self.refs_dir.mkdir()
+
+        self.hashes, self.paths = [], []
+        for idx in range(30):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+        self.user_cache = mock.patch.object(
+            c, "DIR_USER_CACHE", str(self.cache_dir / "user")
+        )
+        self.user_cache.start()
+        self.servers = []
+        self.server, self.storage = self._serve()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.user_cache.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _serve(self, **kwargs):
+        """Start a server over the local storage, and get a client of it"""
+        server = StorageServer(("127.0.0.1", 0), self.local, self.refs_dir, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server, SmartHTTPStorage(self._url(server))
+
+    def _url(self, server: StorageServer) -> str:
+        return f"god+http://127.0.0.1:{server.server_address[1]}"
+
+    def test_objects(self):
+        """Objects are pushed, checked, listed, fetched and deleted in batches"""
+        self.storage.store_objects(paths=self.paths[:20], hash_values=self.hashes[:20])
+        self.assertTrue(all(self.local.have_objects(self.hashes[:20])))
+        self.assertEqual(
+            self.storage.have_objects(self.hashes), [True] * 20 + [False] * 10
+        )
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes[:20]))
+
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(20)]
+        self.storage.get_objects(hash_values=self.hashes[:20], paths=targets)
+        for source, target in zip(self.paths, targets):
+            self.assertEqual(Path(source).read_text(), Path(target).read_text())
+
+        with self.assertRaises(FileNotFoundError):
+            self.storage.get_objects(
+                hash_values=self.hashes[20:21], paths=[str(self.cache_dir / "missing")]
+            )
+
+        self.assertEqual(self.storage.delete_objects(self.hashes[:5]), {})
+        self.assertFalse(any(self.local.have_objects(self.hashes[:5])))
+
+    def test_reject_corrupt(self):
+        """The server verifies pushed objects"""
+        with self.assertRaises(HTTPStatusError) as e:
+            self.storage.store_objects(paths=self.paths[:1], hash_values=["0" * 64])
+        self.assertEqual(e.exception.status, 400)
+        self.assertEqual(self.local.have_objects(["0" * 64]), [False])
+
+    def test_refs(self):
+        ref = self.cache_dir / "main"
+        ref.write_text("commit1")
+        self.storage.store_refs(paths=[str(ref)], refs=["main"])
+        self.assertEqual((self.refs_dir / "main").read_text(), "commit1")
+        self.assertEqual(self.storage.have_refs(["main", "dev"]), [True, False])
+        self.assertEqual(list(self.storage.list_refs()), ["main"])
+
+        target = self.cache_dir / "fetched"
+        self.storage.get_refs(refs=["main"], paths=[str(target)])
+        self.assertEqual(target.read_text(), "commit1")
+
+    def test_swap_ref(self):
+        """Refs are only updated from the expected value"""
+        self.assertTrue(self.storage.swap_ref("main", old=None, new="commit1"))
+        self.assertFalse(self.storage.swap_ref("main", old=None, new="commit2"))
+        self.assertFalse(self.storage.swap_ref("main", old="commit0", new="commit2"))
+        self.assertTrue(self.storage.swap_ref("main", old="commit1", new="commit2"))
+        self.assertEqual((self.refs_dir / "main").read_text(), "commit2")
+        self.assertTrue(self.storage.swap_ref("main", old="commit2", new=None))
+        self.assertFalse((self.refs_dir / "main").exists())
+
+    def test_token(self):
+        """Every request needs the token, deletes and ref updates included"""
+        self.local.store_objects(paths=self.paths[:5], hash_values=self.hashes[:5])
+        (self.refs_dir / "main").write_text("commit1")
+        server, storage = self._serve(token="secret")
+
+        with self.assertRaises(HTTPStatusError) as e:
+            storage.delete_objects(self.hashes[:5])
+        self.assertEqual(e.exception.status, 401)
+        with self.assertRaises(HTTPStatusError) as e:
+            storage.swap_ref("main", old="commit1", new="commit2")
+        self.assertEqual(e.exception.status, 401)
+        with self.assertRaises(HTTPStatusError) as e:
+            storage.have_objects(self.hashes[:5])
+        self.assertEqual(e.exception.status, 401)
+        with mock.patch.dict(os.environ, {TOKEN_ENV: "wrong"}):
+            with self.assertRaises(HTTPStatusError):
+                SmartHTTPStorage(self._url(server)).delete_objects(self.hashes[:5])
+        self.assertTrue(all(self.local.have_objects(self.hashes[:5])))
+        self.assertEqual((self.refs_dir / "main").read_text(), "commit1")
+
+        with mock.patch.dict(os.environ, {TOKEN_ENV: "secret"}):
+            storage = SmartHTTPStorage(self._url(server))
+            self.assertTrue(storage.swap_ref("main", old="commit1", new="commit2"))
+            self.assertEqual(storage.delete_objects(self.hashes[:5]), {})
+        self.assertFalse(any(self.local.have_objects(self.hashes[:5])))
+
+    def test_read_only(self):
+        """A read-only server serves reads, and refuses deletes and ref updates"""
+        self.local.store_objects(paths=self.paths[:5], hash_values=self.hashes[:5])
+        (self.refs_dir / "main").write_text("commit1")
+        _, storage = self._serve(read_only=True)
+
+        self.assertTrue(all(storage.have_objects(self.hashes[:5])))
+        self.assertEqual(storage.have_refs(["main"]), [True])
+        for write in [
+            lambda: storage.delete_objects(self.hashes[:5]),
+            lambda: storage.swap_ref("main", old="commit1", new="commit2"),
+            lambda: storage.delete_refs(["main"]),
+            lambda: storage.store_objects(
+                paths=self.paths[5:6], hash_values=self.hashes[5:6]
+            ),
+        ]:
+            with self.assertRaises(HTTPStatusError) as e:
+                write()
+            self.assertEqual(e.exception.status, 403)
+        self.assertTrue(all(self.local.have_objects(self.hashes[:5])))
+        self.assertEqual(self.local.have_objects(self.hashes[5:6]), [False])
+        self.assertEqual((self.refs_dir / "main").read_text(), "commit1")
+
+    def test_checked_out_branch(self):
+        """The branch that the served repo has checked out is not updated"""
+        head = self.cache_dir / "HEAD"
+        head.write_text(json.dumps({"REFS": "main"}))
+        (self.refs_dir / "main").write_text("commit1")
+        _, storage = self._serve(file_head=head)
+
+        with self.assertRaises(HTTPStatusError) as e:
+            storage.swap_ref("main", old="commit1", new="commit2")
+        self.assertEqual(e.exception.status, 403)
+        self.assertEqual((self.refs_dir / "main").read_text(), "commit1")
+        self.assertTrue(storage.swap_ref("dev", old=None, new="commit2"))
+
+        # the check follows the HEAD of the served repo
+        head.write_text(json.dumps({"REFS": "dev"}))
+        self.assertTrue(storage.swap_ref("main", old="commit1", new="commit2"))
+
+    def test_stream_error(self):
+        """An error inside a streamed response truncates it, with no status inside"""
+        self.local.store_objects(paths=self.paths, hash_values=self.hashes)
+
+        def scan(kind):
+            for idx, hash_value in enumerate(self.hashes):
+                if idx == 10:
+                    raise OSError("disk error")
+                yield hash_value, 1, 0.0
+
+        with mock.patch.object(self.server, "scan", side_effect=scan):
+            with self.assertRaises(http.client.HTTPException):
+                list(self.storage.list_objects())
+
+        pack = self.server.pack
+
+        def broken_pack(hash_values, kind):
+            stream = pack(hash_values, kind)
+            yield next(stream)
+            yield next(stream)
+            raise OSError("disk error")
+
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(2)]
+        with mock.patch.object(self.server, "pack", side_effect=broken_pack):
+            with self.assertRaises((http.client.HTTPException, EOFError)):
+                self.storage.get_objects(hash_values=self.hashes[:2], paths=targets)
+
+        # the connection is dropped, the next request gets a clean one
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes))
@@ -0,0 +1,89 @@
+"""Test the SSH storage
+
+The storage tests need `paramiko` and a server: set GOD_TEST_SSH to a storage config
+on a test server, e.g. `ssh://localhost/tmp/god-test`. Its directory is removed.
+"""
+import importlib.util
+import os
+import shutil
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.storage.backends.ssh import parse_config
+from god.utils.common import get_string_hash
+
+SSH_CONFIG = os.environ.get("GOD_TEST_SSH")
+
+
+class ParseConfigTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(
+            parse_config("ssh://alice@server:2222/data/god/"),
+            ("alice", "server", 2222, "/data/god"),
+        )
+        self.assertEqual(parse_config("ssh://server/"), (None, "server", None, "/"))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_config("sftp://server/data")
+        with self.assertRaises(ValueError):
+            parse_config("ssh://server")
+
+
+@unittest.skipUnless(
+    SSH_CONFIG and importlib.util.find_spec("paramiko"),
+    "Set GOD_TEST_SSH to a test server and install paramiko",
+)
+class SSHStorageTest(unittest.TestCase):
+    def setUp(self):
+        from god.storage.backends.ssh import SSHStorage
+
+        self.cache_dir = Path(".cache/tests/storage/ssh").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.user_cache = mock.patch.object(
+            c, "DIR_USER_CACHE", str(self.cache_dir / "user")
+        )
+        self.user_cache.start()
+        self.storage = SSHStorage(SSH_CONFIG)
+
+        self.hashes, self.paths = [], []
+        for idx in range(30):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+    def tearDown(self):
+        with self.storage._pool.channel() as sftp:
+            for name, _, _ in list(self.storage._scan(self.storage._base_path)):
+                sftp.remove(f"{self.storage._base_path}/{name}")
+        self.storage._pool.close()
+        self.user_cache.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_store_get(self):
+        self.storage.store_objects(paths=self.paths[:20], hash_values=self.hashes[:20])
+        self.assertEqual(
+            self.storage.have_objects(self.hashes), [True] * 20 + [False] * 10
+        )
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes[:20]))
+
+        targets = [str(self.cache_dir / f"out{idx}") for idx in range(20)]
+        self.storage.get_objects(hash_values=self.hashes[:20], paths=targets)
+        for source, target in zip(self.paths, targets):
+            self.assertEqual(Path(source).read_text(), Path(target).read_text())
+
+    def test_delete(self):
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.assertEqual(self.storage.delete_objects(self.hashes[:10]), {})
+        self.assertEqual(
+            self.storage._have(
+                [self.storage._hash_path(each, "objects") for each in self.hashes]
+            ),
+            [False] * 10 + [True] * 20,
+        )
@@ -0,0 +1,71 @@
+"""Test the striped storage"""
+import shutil
+import unittest
+from pathlib import Path
+
+from god.storage.backends.striped import StripedStorage
+from god.utils.common import get_string_hash
+
+
+class StripedStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/striped").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.roots = [self.cache_dir / f"disk{idx}" for idx in range(4)]
+        self.storage = StripedStorage(
+            "striped://" + ",".join(str(each) for each in self.roots[:3])
+        )
+
+        self.hashes, self.paths = [], []
+        for idx in range(60):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _count(self, root):
+        return sum(1 for each in Path(root, "objects").rglob("*") if each.is_file())
+
+    def test_store_get(self):
+        """Objects are spread over the roots, and read back from any of them"""
+        counts = [self._count(each) for each in self.roots[:3]]
+        self.assertEqual(sum(counts), 60)
+        self.assertTrue(all(counts))
+        self.assertTrue(all(self.storage.have_objects(self.hashes)))
+        self.assertFalse(any(self.storage.have_objects([get_string_hash("none")])))
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes))
+
+        outputs = [str(self.cache_dir / f"out{idx}") for idx in range(60)]
+        self.storage.get_objects(hash_values=self.hashes, paths=outputs)
+        for idx, output in enumerate(outputs):
+            self.assertEqual(Path(output).read_text(), f"object {idx}")
+
+    def test_add_root(self):
+        """After adding a root, objects stay readable and rebalance moves some"""
+        storage = StripedStorage(
+            "striped://" + ",".join(str(each) for each in self.roots)
+        )
+        self.assertTrue(all(storage.have_objects(self.hashes)))
+        outputs = [str(self.cache_dir / f"out{idx}") for idx in range(60)]
+        storage.get_objects(hash_values=self.hashes, paths=outputs)
+
+        n_moved = storage.rebalance()
+        self.assertGreater(n_moved, 0)
+        self.assertEqual(self._count(self.roots[3]), n_moved)
+        self.assertEqual(sum(self._count(each) for each in self.roots), 60)
+        self.assertTrue(all(storage.have_objects(self.hashes)))
+        self.assertEqual(storage.rebalance(), 0)
+
+    def test_delete(self):
+        errors = self.storage.delete_objects(self.hashes[:10])
+        self.assertEqual(errors, {})
+        self.assertEqual(
+            self.storage.have_objects(self.hashes[:11]), [False] * 10 + [True]
+        )
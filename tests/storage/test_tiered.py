@@ -0,0 +1,117 @@
+"""Test the tiered storage"""
+import os
+import shutil
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from god.storage.backends.local import LocalStorage
+from god.storage.backends.tiered import FILE_PENDING, TieredStorage
+from god.utils.common import get_string_hash
+
+
+class TieredStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/tiered").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.cold_config = f"file://{self.cache_dir / 'cold'}"
+        self.config = (
+            f"tiered://file://{self.cache_dir / 'hot'}?cold={self.cold_config}"
+        )
+        self.storage = TieredStorage(self.config)
+        self.cold = LocalStorage(self.cold_config)
+
+        self.hashes, self.paths = [], []
+        for idx in range(5):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+    def tearDown(self):
+        self.storage.wait()
+        shutil.rmtree(self.cache_dir)
+
+    def test_store_flush(self):
+        """Stores land on the hot tier and are flushed to the cold tier"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.assertTrue(all(self.storage._hot.have_objects(self.hashes)))
+        self.storage.wait()
+        self.assertTrue(all(self.cold.have_objects(self.hashes)))
+        self.assertEqual(self.storage.flush(), 0)
+
+    def test_get_from_cold(self):
+        """Objects only in the cold tier are read, and kept in the hot tier"""
+        self.cold.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.assertTrue(all(self.storage.have_objects(self.hashes)))
+        self.assertEqual(sorted(self.storage.list_objects()), sorted(self.hashes))
+
+        outputs = [str(self.cache_dir / f"out{idx}") for idx in range(5)]
+        self.storage.get_objects(hash_values=self.hashes, paths=outputs)
+        for idx, output in enumerate(outputs):
+            self.assertEqual(Path(output).read_text(), f"object {idx}")
+        self.assertTrue(all(self.storage._hot.have_objects(self.hashes)))
+
+    def test_demote(self):
+        """Objects not read recently are removed from the hot tier only"""
+        self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+        self.storage.wait()
+        old = time.time() - 10 * 24 * 60 * 60
+        for each in self.storage._hot.local_paths(self.hashes[:2], prefix="objects"):
+            os.utime(each, (old, old))
+
+        self.assertEqual(self.storage.demote(days=1), 2)
+        self.assertEqual(
+            self.storage._hot.have_objects(self.hashes), [False, False] + [True] * 3
+        )
+        self.assertTrue(all(self.storage.have_objects(self.hashes)))
+
+    def test_no_flusher_on_read(self):
+        """Reads start no flush, the queue left by a process is flushed by a write"""
+        self.storage._tiered_dir.mkdir(parents=True, exist_ok=True)
+        self.storage._hot.store_objects(paths=self.paths, hash_values=self.hashes)
+        (self.storage._tiered_dir / FILE_PENDING).write_text(
+            "".join(f"objects {each}\n" for each in self.hashes[:3])
+        )
+
+        reader = TieredStorage(self.config)
+        self.assertTrue(all(reader.have_objects(self.hashes)))
+        outputs = [str(self.cache_dir / f"out{idx}") for idx in range(5)]
+        reader.get_objects(hash_values=self.hashes, paths=outputs)
+        self.assertIsNone(reader._flusher)
+        self.assertFalse(any(self.cold.have_objects(self.hashes)))
+
+        writer = TieredStorage(self.config)
+        writer.store_objects(paths=self.paths[3:], hash_values=self.hashes[3:])
+        writer.wait()
+        self.assertTrue(all(self.cold.have_objects(self.hashes)))
+
+    def test_join_at_exit(self):
+        """At exit the flush is waited for, at most for the timeout"""
+        release = threading.Event()
+        store_hashes = self.storage._cold._store_hashes
+
+        def slow_store(*args, **kwargs):
+            release.wait()
+            return store_hashes(*args, **kwargs)
+
+        with mock.patch("atexit.register") as register, mock.patch.object(
+            self.storage._cold, "_store_hashes", side_effect=slow_store
+        ):
+            self.storage.store_objects(paths=self.paths, hash_values=self.hashes)
+            register.assert_called_once_with(self.storage._join_at_exit)
+
+            start = time.time()
+            self.storage._join_at_exit(timeout=0.1)
+            self.assertLess(time.time() - start, 5)
+            self.assertTrue(self.storage._flusher.is_alive())
+
+            release.set()
+            self.storage._join_at_exit()
+        self.assertFalse(self.storage._flusher.is_alive())
+        self.assertTrue(all(self.cold.have_objects(self.hashes)))
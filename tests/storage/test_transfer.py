@@ -0,0 +1,147 @@
+"""Test transferring hashes between 2 storages, through each path of `transfer`"""
+import importlib.util
+import os
+import shutil
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import god.storage.constants as c
+from god.storage.backends.local import LocalStorage
+from god.storage.backends.smart import SmartHTTPStorage
+from god.storage.server import StorageServer
+from god.storage.transfer import transfer
+from god.utils.common import get_string_hash
+
+HAS_MOTO = importlib.util.find_spec("moto") is not None
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/storage/transfer").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+
+        self.hashes, self.paths = [], []
+        for idx in range(10):
+            content = f"object {idx}"
+            path = self.cache_dir / f"file{idx}"
+            path.write_text(content)
+            self.paths.append(str(path))
+            self.hashes.append(get_string_hash(content))
+
+        self.user_cache = mock.patch.object(
+            c, "DIR_USER_CACHE", str(self.cache_dir / "user")
+        )
+        self.user_cache.start()
+        self.cache_size = mock.patch.dict(os.environ, {"GOD_CACHE_SIZE": "1000000"})
+        self.cache_size.start()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.cache_size.stop()
+        self.user_cache.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def _local(self, name: str) -> LocalStorage:
+        return LocalStorage(f"file://{self.cache_dir / name}")
+
+    def _served(self, name: str):
+        """A storage that is not in local filesystem, and the local storage it serves"""
+        local = self._local(name)
+        refs_dir = self.cache_dir / f"{name}-refs"
+        refs_dir.mkdir()
+        server = StorageServer(("127.0.0.1", 0), local, refs_dir)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return (
+            SmartHTTPStorage(f"god+http://127.0.0.1:{server.server_address[1]}"),
+            local,
+        )
+
+    def _assert_content(self, storage, hash_values):
+        targets = [str(self.cache_dir / f"out-{each}") for each in hash_values]
+        storage.get_objects(hash_values=hash_values, paths=targets)
+        for hash_value, target in zip(hash_values, targets):
+            self.assertEqual(get_string_hash(Path(target).read_text()), hash_value)
+
+    def test_upload_from_local(self):
+        """A local source is uploaded from its storage location"""
+        source = self._local("source")
+        source.store_objects(paths=self.paths, hash_values=self.hashes)
+        target, served = self._served("target")
+
+        with mock.patch.object(source, "_get", side_effect=AssertionError):
+            transfer(source, target, self.hashes, prefix=source.OBJECTS_PREFIX)
+        self.assertTrue(all(served.have_objects(self.hashes)))
+        self._assert_content(served, self.hashes)
+
+    def test_download_into_local(self):
+        """A local target is written in place, with copies that share no file"""
+        source, served = self._served("source")
+        served.store_objects(paths=self.paths, hash_values=self.hashes)
+        target = self._local("target")
+
+        # fetch twice, the second time from the user object cache
+        transfer(source, target, self.hashes[:5], prefix=source.OBJECTS_PREFIX)
+        transfer(source, target, self.hashes, prefix=source.OBJECTS_PREFIX)
+        self.assertTrue(all(target.have_objects(self.hashes)))
+        self.assertTrue(
+            all(target.presence(target.OBJECTS_PREFIX).contains(self.hashes))
+        )
+
+        target_paths = target.local_paths(self.hashes, prefix=target.OBJECTS_PREFIX)
+        for path in target_paths:
+            self.assertEqual(os.stat(path).st_nlink, 1)
+
+        # changing the source and the cache in place leaves the target intact
+        for path in served.local_paths(self.hashes, prefix=served.OBJECTS_PREFIX):
+            Path(path).write_text("changed")
+        for path in (self.cache_dir / "user").rglob("*"):
+            if path.is_file() and "." not in path.name:
+                path.write_text("changed")
+        self._assert_content(target, self.hashes)
+
+    def test_copy_inside_provider(self):
+        """The target copies from the source without downloading"""
+        if not HAS_MOTO:
+            self.skipTest("needs moto")
+        import boto3
+        from moto import mock_aws
+
+        from god.storage.backends.s3 import S3Storage
+
+        env = {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_DEFAULT_REGION": "us-east-1",
+        }
+        with mock.patch.dict(os.environ, env), mock_aws():
+            boto3.client("s3").create_bucket(Bucket="god")
+            source = S3Storage("s3://god/source")
+            target = S3Storage("s3://god/target")
+            source.store_objects(paths=self.paths, hash_values=self.hashes)
+
+            with mock.patch.object(source, "_get", side_effect=AssertionError):
+                transfer(source, target, self.hashes, prefix=source.OBJECTS_PREFIX)
+            self.assertTrue(all(target.have_objects(self.hashes)))
+            self._assert_content(target, self.hashes)
+
+    def test_staging(self):
+        """Neither storage is local nor can copy, the files are staged"""
+        source, served_source = self._served("source")
+        served_source.store_dirs(paths=self.paths, hash_values=self.hashes)
+        target, served_target = self._served("target")
+
+        transfer(source, target, self.hashes, prefix=source.DIRS_PREFIX)
+        self.assertTrue(all(served_target.have_dirs(self.hashes)))
+        for hash_value, path in zip(
+            self.hashes,
+            served_target.local_paths(self.hashes, prefix=served_target.DIRS_PREFIX),
+        ):
+            self.assertEqual(get_string_hash(Path(path).read_text()), hash_value)
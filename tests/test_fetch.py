@@ -0,0 +1,232 @@
+"""Test fetching commits, dirs and objects between storages"""
+import os
+import shutil
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import yaml
+
+import god.fetch
+import god.storage.constants as sc
+import god.utils.constants as c
+from god.fetch import _fetch_commits, _fetch_trees, fetch_object_storage
+from god.porcelain import clone_cmd
+from god.storage.backends.local import LocalStorage
+from god.storage.server import StorageServer
+from god.utils.common import get_string_hash
+from god.utils.exceptions import RepoExisted
+
+
+class HistoryTestCase(unittest.TestCase):
+    """A remote storage with a linear history of 10 commits"""
+
+    CACHE_DIR = ".cache/tests/fetch"
+
+    def setUp(self):
+        self.cache_dir = Path(self.CACHE_DIR).resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.temp_dir = self.cache_dir / "temp"
+        for each in ["commits", "dirs", "objects"]:
+            (self.temp_dir / each).mkdir(parents=True)
+        self.remote = LocalStorage(f"file://{self.cache_dir / 'remote'}")
+        self.local = LocalStorage(f"file://{self.cache_dir / 'local'}")
+
+        # a linear history of 10 commits, each adding 1 file into "sub" dir
+        self.commits, self.objects = [], []
+        prev, lines = "", []
+        for idx in range(10):
+            obj = self._store("objects", f"content {idx}")
+            self.objects.append(obj)
+            lines.append(f"file{idx},f,{obj}")
+            sub_dir = self._store("dirs", "\n".join(lines))
+            root_dir = self._store("dirs", f"sub,d,{sub_dir}")
+            prev = self._store(
+                "commits",
+                yaml.dump({"prev": prev, "tracks": {"files": root_dir}}),
+            )
+            self.commits.append(prev)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, kind: str, content: str) -> str:
+        hash_value = get_string_hash(content)
+        path = self.cache_dir / hash_value
+        path.write_text(content)
+        getattr(self.remote, f"store_{kind}")([str(path)], [hash_value])
+        path.unlink()
+        return hash_value
+
+
+class FetchTest(HistoryTestCase):
+    def test_fetch_all(self):
+        dirs, shallow, _ = _fetch_commits(
+            self.remote, self.local, self.commits[-1], "", 0, str(self.temp_dir)
+        )
+        self.assertEqual(shallow, [])
+        self.assertTrue(all(self.local.have_commits(self.commits)))
+
+        _fetch_trees(self.remote, self.local, dirs, str(self.temp_dir), False)
+        self.assertTrue(all(self.local.have_objects(self.objects)))
+
+    def test_fetch_depth(self):
+        dirs, shallow, _ = _fetch_commits(
+            self.remote, self.local, self.commits[-1], "", 2, str(self.temp_dir)
+        )
+        self.assertEqual(shallow, [self.commits[-2]])
+        self.assertEqual(
+            self.local.have_commits(self.commits), [False] * 8 + [True] * 2
+        )
+
+        _fetch_trees(self.remote, self.local, dirs, str(self.temp_dir), False)
+        self.assertEqual(self.local.have_objects(self.objects), [True] * 10)
+
+    def test_fetch_since_current(self):
+        dirs, _, _ = _fetch_commits(
+            self.remote,
+            self.local,
+            self.commits[-1],
+            self.commits[5],
+            0,
+            str(self.temp_dir),
+        )
+        self.assertEqual(
+            self.local.have_commits(self.commits), [False] * 6 + [True] * 4
+        )
+
+    def test_filter_objects(self):
+        dirs, _, _ = _fetch_commits(
+            self.remote, self.local, self.commits[-1], "", 0, str(self.temp_dir)
+        )
+        _fetch_trees(self.remote, self.local, dirs, str(self.temp_dir), True)
+        self.assertEqual(len(list(self.local.list_dirs())), 20)
+        self.assertFalse(any(self.local.have_objects(self.objects)))
+
+    def test_deepen(self):
+        """A deeper fetch moves the shallow boundary down"""
+        _, shallow, _ = _fetch_commits(
+            self.remote, self.local, self.commits[-1], "", 2, str(self.temp_dir)
+        )
+        dirs, shallow, deepened = _fetch_commits(
+            self.remote,
+            self.local,
+            self.commits[-1],
+            self.commits[-1],
+            5,
+            str(self.temp_dir),
+            shallow_commits=set(shallow),
+        )
+        self.assertEqual(deepened, [self.commits[-2]])
+        self.assertEqual(shallow, [self.commits[-5]])
+        self.assertEqual(
+            self.local.have_commits(self.commits), [False] * 5 + [True] * 5
+        )
+
+        # the commits at the limit whose parents are present are not boundary
+        _, shallow, deepened = _fetch_commits(
+            self.remote,
+            self.local,
+            self.commits[-1],
+            self.commits[-1],
+            0,
+            str(self.temp_dir),
+            shallow_commits=set(shallow),
+        )
+        self.assertEqual((shallow, deepened), ([], [self.commits[-5]]))
+        self.assertTrue(all(self.local.have_commits(self.commits)))
+
+
+class Interrupt(Exception):
+    pass
+
+
+def interrupt_once(fn):
+    """Make `fn` raise on its first call, and work afterward"""
+    calls = []
+
+    def wrapped(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise Interrupt()
+        return fn(*args, **kwargs)
+
+    return wrapped
+
+
+class ResumeTest(HistoryTestCase):
+    """Interrupted fetches and clones finish when they are run again"""
+
+    CACHE_DIR = ".cache/tests/fetch-resume"
+
+    def setUp(self):
+        super().setUp()
+        refs_dir = self.cache_dir / "refs"
+        refs_dir.mkdir()
+        (refs_dir / "main").write_text(self.commits[-1])
+        self.server = StorageServer(("127.0.0.1", 0), self.remote, refs_dir)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"god+http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.user_cache = mock.patch.object(
+            sc, "DIR_USER_CACHE", str(self.cache_dir / "user")
+        )
+        self.user_cache.start()
+        self.cwd = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.user_cache.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def test_resume_fetch(self):
+        ref_dir = self.cache_dir / "remotes"
+        journal_dir = self.cache_dir / "transfers"
+
+        def fetch():
+            return fetch_object_storage(
+                branch="main",
+                ref_remotes_dir=ref_dir,
+                remote_path=self.url,
+                local_path=f"file://{self.cache_dir / 'local'}",
+                journal_dir=journal_dir,
+            )
+
+        # interrupted after the commits are stored, then in the middle of objects
+        for name in ["_fetch_trees", "_fetch_objects"]:
+            fn = interrupt_once(getattr(god.fetch, name))
+            with mock.patch.object(god.fetch, name, fn), self.assertRaises(Interrupt):
+                fetch()
+            self.assertFalse((ref_dir / "main").exists())
+        self.assertTrue(all(self.local.have_commits(self.commits)))
+
+        self.assertTrue(fetch())
+        self.assertEqual((ref_dir / "main").read_text(), self.commits[-1])
+        self.assertTrue(all(self.local.have_objects(self.objects)))
+        self.assertEqual(len(list(self.local.list_dirs())), 20)
+        self.assertEqual(list(journal_dir.iterdir()), [])
+
+    def test_resume_clone(self):
+        clone = self.cache_dir / "clone"
+        fn = interrupt_once(god.fetch._fetch_objects)
+        with mock.patch.object(god.fetch, "_fetch_objects", fn):
+            with self.assertRaises(Interrupt):
+                clone_cmd(clone, self.url, "file://")
+        self.assertFalse((clone / c.DIR_REFS_HEADS / "main").exists())
+        with self.assertRaises(RuntimeError):
+            clone_cmd(clone, self.url, "file://", depth=1)
+
+        clone_cmd(clone, self.url, "file://")
+        self.assertEqual(
+            (clone / c.DIR_REFS_HEADS / "main").read_text(), self.commits[-1]
+        )
+        self.assertEqual((clone / "sub" / "file9").read_text(), "content 9")
+        self.assertEqual(list((clone / c.DIR_TRANSFERS).iterdir()), [])
+
+        # a finished clone is not resumed, the directory is taken
+        with self.assertRaises(RepoExisted):
+            clone_cmd(clone, self.url, "file://")
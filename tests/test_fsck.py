@@ -0,0 +1,152 @@
+"""Test verifying the integrity of a storage"""
+import shutil
+import unittest
+from pathlib import Path
+
+import yaml
+
+from god.commits.base import calculate_commit_hash
+from god.fsck import Fsck, in_sample
+from god.storage.backends.local import LocalStorage
+from god.storage.journal import TransferJournal
+from god.utils.common import get_string_hash
+
+
+class FsckTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/fsck").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.storage = LocalStorage(f"file://{self.cache_dir / 'storage'}")
+        self.problems = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, kind: str, content: str, hash_value: str = "") -> str:
+        hash_value = hash_value or get_string_hash(content)
+        path = self.cache_dir / hash_value
+        path.write_text(content)
+        getattr(self.storage, f"store_{kind}")([str(path)], [hash_value])
+        path.unlink()
+        return hash_value
+
+    def _commit(self, prev: str, files: dict) -> str:
+        lines = []
+        for name, content in sorted(files.items()):
+            lines.append(f"{name},f,{self._store('objects', content)}")
+        root = self._store("dirs", "\n".join(lines))
+        commit_obj = {"prev": prev, "tracks": {"files": root}}
+        return self._store(
+            "commits", yaml.dump(commit_obj), calculate_commit_hash(commit_obj)
+        )
+
+    def _local_path(self, kind: str, hash_value: str) -> Path:
+        return Path(
+            self.storage._local_path(self.storage._hash_path(hash_value, prefix=kind))
+        )
+
+    def _fsck(self, **kwargs):
+        return Fsck(self.storage, self.problems.append, n_processes=2, **kwargs).run()
+
+    def test_clean(self):
+        commit1 = self._commit("", {"a": "1"})
+        self._commit(commit1, {"a": "1", "b": "2"})
+        summary = self._fsck()
+        self.assertEqual(summary["problems"], 0)
+        self.assertEqual(summary["checked"], {"objects": 2, "dirs": 2, "commits": 2})
+
+    def test_corrupt_and_missing(self):
+        commit1 = self._commit("", {"a": "1"})
+        commit2 = self._commit(commit1, {"a": "1", "b": "2"})
+        self._local_path("objects", get_string_hash("2")).write_text("3")
+        self.storage.delete_commits([commit1])
+
+        summary = Fsck(
+            self.storage, self.problems.append, n_processes=2, shallow=set()
+        ).run(roots=[commit2, "0" * 64])
+        self.assertEqual(summary["problems"], 3)
+        self.assertCountEqual(
+            [(each["kind"], each["hash"], each["problem"]) for each in self.problems],
+            [
+                ("commits", "0" * 64, "missing"),
+                ("objects", get_string_hash("2"), "corrupt"),
+                ("commits", commit1, "missing"),
+            ],
+        )
+        corrupt = [each for each in self.problems if each["problem"] == "corrupt"]
+        self.assertEqual(corrupt[0]["actual"], get_string_hash("3"))
+
+        # the parents of shallow boundary commits may be absent
+        self.problems = []
+        self._fsck(shallow={commit2})
+        self.assertEqual(len(self.problems), 1)
+
+    def test_sample(self):
+        self.assertTrue(in_sample("00" * 32, 0.01))
+        self.assertFalse(in_sample("ff" * 32, 0.01))
+        self.assertTrue(in_sample("ff" * 32, 1))
+
+        hashes = [self._store("objects", str(idx)) for idx in range(50)]
+        fsck = Fsck(self.storage, self.problems.append, sample=0.5, n_processes=2)
+        summary = fsck.run()
+        self.assertEqual(
+            summary["checked"]["objects"],
+            len([each for each in hashes if in_sample(each, 0.5, fsck.salt)]),
+        )
+
+    def test_sample_salt(self):
+        """A resumed run samples the same hashes, a new run samples other hashes"""
+        hashes = [get_string_hash(str(idx)) for idx in range(200)]
+        journal = TransferJournal(self.cache_dir / "transfers", "fsck")
+        first = Fsck(self.storage, self.problems.append, sample=0.5, journal=journal)
+        resumed = Fsck(
+            self.storage,
+            self.problems.append,
+            sample=0.5,
+            journal=TransferJournal(self.cache_dir / "transfers", "fsck"),
+        )
+        self.assertEqual(resumed.salt, first.salt)
+
+        journal.close()
+        new = Fsck(
+            self.storage,
+            self.problems.append,
+            sample=0.5,
+            journal=TransferJournal(self.cache_dir / "transfers", "fsck"),
+        )
+        self.assertNotEqual(new.salt, first.salt)
+        self.assertNotEqual(
+            [in_sample(each, 0.5, first.salt) for each in hashes],
+            [in_sample(each, 0.5, new.salt) for each in hashes],
+        )
+
+    def test_resume(self):
+        """Finished shards are skipped and their problems are reported again"""
+        hashes = [self._store("objects", str(idx)) for idx in range(20)]
+        self._local_path("objects", hashes[0]).write_text("corrupt")
+        shard = hashes[0][:2]
+
+        journal = TransferJournal(self.cache_dir / "transfers", "fsck")
+        journal.done("objects", self.storage._shards())
+        journal.done("problems", ['{"hash": "x", "problem": "corrupt"}'])
+        journal = TransferJournal(self.cache_dir / "transfers", "fsck")
+        summary = self._fsck(journal=journal)
+        self.assertEqual(summary["checked"], {})
+        self.assertEqual(self.problems, [{"hash": "x", "problem": "corrupt"}])
+        self.assertFalse((self.cache_dir / "transfers" / "fsck").exists())
+
+        self.problems = []
+        journal = TransferJournal(self.cache_dir / "transfers", "fsck")
+        journal.done(
+            "objects", [each for each in self.storage._shards() if each != shard]
+        )
+        summary = self._fsck(
+            journal=TransferJournal(self.cache_dir / "transfers", "fsck")
+        )
+        self.assertEqual(
+            summary["checked"]["objects"],
+            len([each for each in hashes if each.startswith(shard)]),
+        )
+        self.assertEqual([each["hash"] for each in self.problems], [hashes[0]])
@@ -0,0 +1,155 @@
+"""Test collecting unreachable objects, dirs and commits"""
+import json
+import os
+import shutil
+import sqlite3
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import yaml
+
+from god.gc import gc, index_objects, root_commits
+from god.index.utils import COLUMNS
+from god.storage.backends.local import LocalStorage
+from god.storage.backends.tiered import TieredStorage
+from god.utils.common import get_string_hash
+
+
+class GCTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/gc").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.storage = LocalStorage(f"file://{self.cache_dir / 'storage'}")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, kind: str, content: str, age: float = 30) -> str:
+        """Store `content`, last modified `age` days ago"""
+        hash_value = get_string_hash(content)
+        path = self.cache_dir / hash_value
+        path.write_text(content)
+        getattr(self.storage, f"store_{kind}")([str(path)], [hash_value])
+        path.unlink()
+        mtime = time.time() - age * 24 * 3600
+        storage_path = self.storage._hash_path(hash_value, prefix=kind)
+        os.utime(self.storage._local_path(storage_path), (mtime, mtime))
+        return hash_value
+
+    def _commit(self, prev: str, files: dict) -> str:
+        lines = []
+        for name, content in sorted(files.items()):
+            lines.append(f"{name},f,{self._store('objects', content)}")
+        data_dir = self._store("dirs", "\n".join(lines))
+        root = self._store("dirs", f"data,d,{data_dir}")
+        return self._store(
+            "commits", yaml.dump({"prev": prev, "tracks": {"files": root}})
+        )
+
+    def test_sweep_unreachable(self):
+        commit1 = self._commit("", {"a": "1"})
+        commit2 = self._commit(commit1, {"a": "1", "b": "2"})
+        abandoned = self._commit(commit1, {"a": "1", "c": "3"})
+
+        report = gc(self.storage, commits=[commit2], objects=[], dry_run=True)
+        self.assertEqual(report["commits"]["count"], 1)
+        self.assertEqual(report["dirs"]["count"], 2)
+        self.assertEqual(report["objects"]["count"], 1)
+        self.assertEqual(report["objects"]["bytes"], 1)
+        self.assertTrue(self.storage.have_commits([abandoned])[0])
+
+        gc(self.storage, commits=[commit2], objects=[])
+        self.assertEqual(
+            self.storage.have_commits([commit1, commit2, abandoned]),
+            [True, True, False],
+        )
+        self.assertEqual(
+            self.storage.have_objects([get_string_hash(each) for each in "123"]),
+            [True, True, False],
+        )
+        self.assertEqual(len(list(self.storage.list_dirs())), 4)
+
+    def test_grace_period_and_index(self):
+        commit = self._commit("", {"a": "1"})
+        recent = self._store("objects", "recent", age=1)
+        staged = self._store("objects", "staged")
+        old = self._store("objects", "old")
+
+        report = gc(self.storage, commits=[commit], objects=[staged])
+        self.assertEqual(report["objects"]["count"], 1)
+        self.assertEqual(
+            self.storage.have_objects([recent, staged, old]), [True, True, False]
+        )
+
+    def test_shallow(self):
+        """The parents of shallow boundary commits are not walked"""
+        commit1 = self._commit("", {"a": "1"})
+        commit2 = self._commit(commit1, {"a": "2"})
+        self.storage.delete_commits([commit1])
+
+        gc(self.storage, commits=[commit2], objects=[], shallow={commit2})
+        self.assertTrue(self.storage.have_commits([commit2])[0])
+        self.assertEqual(
+            self.storage.have_objects([get_string_hash("1"), get_string_hash("2")]),
+            [False, True],
+        )
+
+    def test_refuse_remote(self):
+        """Storages outside local filesystem are only swept when allowed"""
+        commit = self._commit("", {"a": "1"})
+        old = self._store("objects", "old")
+        with mock.patch.object(self.storage, "_local_path", return_value=None):
+            with self.assertRaises(RuntimeError):
+                gc(self.storage, commits=[commit], objects=[])
+            self.assertTrue(self.storage.have_objects([old])[0])
+            gc(self.storage, commits=[commit], objects=[], allow_remote=True)
+        self.assertFalse(self.storage.have_objects([old])[0])
+
+    def test_tiered(self):
+        """Only the hot tier is swept, the cold tier keeps every hash"""
+        commit = self._commit("", {"a": "1"})
+        old = self._store("objects", "old")
+        cold = LocalStorage(f"file://{self.cache_dir / 'cold'}")
+        hashes = list(self.storage.list_objects())
+        cold.store_objects(
+            self.storage.local_paths(hashes, prefix=self.storage.OBJECTS_PREFIX),
+            hashes,
+        )
+        tiered = TieredStorage(
+            f"tiered://file://{self.cache_dir / 'storage'}"
+            f"?cold=file://{self.cache_dir / 'cold'}"
+        )
+
+        report = gc(tiered, commits=[commit], objects=[])
+        self.assertEqual(report["objects"]["count"], 1)
+        self.assertFalse(self.storage.have_objects([old])[0])
+        self.assertTrue(cold.have_objects([old])[0])
+
+    def test_roots(self):
+        heads = self.cache_dir / "heads"
+        remotes = self.cache_dir / "remotes" / "origin"
+        heads.mkdir()
+        remotes.mkdir(parents=True)
+        (heads / "main").write_text("commit1")
+        (remotes / "main").write_text("commit2")
+        head = self.cache_dir / "HEAD"
+        head.write_text(json.dumps({"COMMITS": "commit3"}))
+        self.assertEqual(
+            root_commits([heads, self.cache_dir / "remotes"], head),
+            ["commit1", "commit2", "commit3"],
+        )
+        self.assertEqual(root_commits([heads], head), ["commit1", "commit3"])
+
+        indices = self.cache_dir / "indices"
+        indices.mkdir()
+        con = sqlite3.connect(str(indices / "files"))
+        con.execute(f'CREATE TABLE main({", ".join(" ".join(e) for e in COLUMNS)})')
+        con.execute("INSERT INTO main (name, hash, mhash) VALUES ('a', 'h1', 'h2')")
+        con.execute("INSERT INTO main (name, hash) VALUES ('b', 'h1')")
+        con.commit()
+        con.close()
+        self.assertEqual(index_objects(indices), ["h1", "h2"])
@@ -0,0 +1,92 @@
+"""Test planning what to push to remote storage"""
+import shutil
+import unittest
+from pathlib import Path
+
+import yaml
+
+from god.push import plan_push
+from god.storage.backends.local import LocalStorage
+from god.utils.common import get_string_hash
+
+
+class PlanPushTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/push").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.cache_dir.mkdir(parents=True)
+        self.local = LocalStorage(f"file://{self.cache_dir / 'local'}")
+        self.remote = LocalStorage(f"file://{self.cache_dir / 'remote'}")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _store(self, storage, kind: str, content: str) -> str:
+        hash_value = get_string_hash(content)
+        path = self.cache_dir / hash_value
+        path.write_text(content)
+        getattr(storage, f"store_{kind}")([str(path)], [hash_value])
+        path.unlink()
+        return hash_value
+
+    def _commit(self, storage, prev: str, files: dict) -> str:
+        """Store a commit with 1 unchanged and 1 changing sub-directory"""
+        static = self._store(storage, "objects", "static")
+        static_dir = self._store(storage, "dirs", f"static,f,{static}")
+        lines = []
+        for name, content in sorted(files.items()):
+            lines.append(f"{name},f,{self._store(storage, 'objects', content)}")
+        data_dir = self._store(storage, "dirs", "\n".join(lines))
+        root = self._store(storage, "dirs", f"data,d,{data_dir}\nstatic,d,{static_dir}")
+        return self._store(
+            storage, "commits", yaml.dump({"prev": prev, "tracks": {"files": root}})
+        )
+
+    def test_plan_new_remote(self):
+        commit1 = self._commit(self.local, "", {"a": "1"})
+        commit2 = self._commit(self.local, commit1, {"a": "1", "b": "2"})
+        objects, dir_levels, commits = plan_push(self.local, self.remote, commit2, "")
+        self.assertCountEqual(commits, [commit1, commit2])
+        self.assertEqual(len(objects), 3)
+        self.assertEqual([len(each) for each in dir_levels], [2, 3])
+
+    def test_plan_only_missing(self):
+        commit1 = self._commit(self.remote, "", {"a": "1"})
+        self._commit(self.local, "", {"a": "1"})
+        commit2 = self._commit(self.local, commit1, {"a": "1", "b": "2"})
+        objects, dir_levels, commits = plan_push(
+            self.local, self.remote, commit2, commit1
+        )
+        self.assertEqual(commits, [commit2])
+        self.assertEqual(objects, [get_string_hash("2")])
+        self.assertEqual([len(each) for each in dir_levels], [1, 1])
+
+    def test_plan_shared_subtree(self):
+        """A subtree shared at different depths is uploaded before its parents"""
+        obj = self._store(self.local, "objects", "shared")
+        shared = self._store(self.local, "dirs", f"file,f,{obj}")
+        root1 = self._store(self.local, "dirs", f"shared,d,{shared}")
+        middle = self._store(self.local, "dirs", f"shared,d,{shared}\nx,f,{obj}")
+        top = self._store(self.local, "dirs", f"middle,d,{middle}")
+        root2 = self._store(self.local, "dirs", f"top,d,{top}")
+        commit1 = self._store(
+            self.local, "commits", yaml.dump({"prev": "", "tracks": {"a": root1}})
+        )
+        commit2 = self._store(
+            self.local, "commits", yaml.dump({"prev": commit1, "tracks": {"a": root2}})
+        )
+
+        _, dir_levels, _ = plan_push(self.local, self.remote, commit2, "")
+        uploaded = {}
+        for order, dirs in enumerate(reversed(dir_levels)):
+            for each in dirs:
+                uploaded[each] = order
+        self.assertEqual(len(uploaded), 5)
+        for parent, child in [
+            (root1, shared),
+            (middle, shared),
+            (top, middle),
+            (root2, top),
+        ]:
+            self.assertLess(uploaded[child], uploaded[parent])
@@ -0,0 +1,94 @@
+"""Test shallow history: the boundary file, and `god clone/fetch --depth`"""
+import shutil
+import subprocess
+import threading
+import unittest
+from pathlib import Path
+
+import god.utils.constants as c
+from god.core.shallow import get_shallow_commits, read_shallow, update_shallow
+from god.storage.backends.local import LocalStorage
+from god.storage.server import StorageServer
+
+
+def god(*args, cwd):
+    return subprocess.run(
+        ["god", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout
+
+
+class ShallowFileTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/shallow").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        (self.cache_dir / c.DIR_GOD).mkdir(parents=True)
+        self.shallow_file = self.cache_dir / c.FILE_SHALLOW
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_update(self):
+        self.assertEqual(read_shallow(self.shallow_file), set())
+        update_shallow(self.shallow_file, add=["b", "a"])
+        self.assertEqual(self.shallow_file.read_text(), "a\nb\n")
+        update_shallow(self.shallow_file, add=["c"], remove=["a"])
+        self.assertEqual(read_shallow(self.shallow_file), {"b", "c"})
+
+        # the file is removed when the history is complete
+        update_shallow(self.shallow_file, remove=["b", "c"])
+        self.assertFalse(self.shallow_file.exists())
+
+
+class ShallowCloneTest(unittest.TestCase):
+    """Clone and fetch with `--depth` from a repo served by `god serve`"""
+
+    def setUp(self):
+        self.cache_dir = Path(".cache/tests/shallow-clone").resolve()
+        if self.cache_dir.is_dir():
+            shutil.rmtree(self.cache_dir)
+        self.source = self.cache_dir / "source"
+        self.source.mkdir(parents=True)
+
+        god("init", ".", cwd=self.source)
+        god("configs", "set", "user.name", "tester", cwd=self.source)
+        god("configs", "set", "user.email", "tester@example.com", cwd=self.source)
+        self.commits = []
+        for idx in range(3):
+            (self.source / f"file{idx}.txt").write_text(f"content {idx}")
+            god("add", f"file{idx}.txt", cwd=self.source)
+            god("commit", "-m", f"commit {idx}", cwd=self.source)
+            self.commits.append(
+                (self.source / c.DIR_REFS_HEADS / "main").read_text().strip()
+            )
+
+        self.server = StorageServer(
+            ("127.0.0.1", 0),
+            LocalStorage(f"file://{self.source / c.DIR_GOD}"),
+            self.source / c.DIR_REFS_HEADS,
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"god+http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_clone_then_deepen(self):
+        god("clone", "clone", self.url, "--local", "--depth", "1", cwd=self.cache_dir)
+        clone = self.cache_dir / "clone"
+        self.assertEqual(get_shallow_commits(clone), {self.commits[-1]})
+        self.assertEqual((clone / "file2.txt").read_text(), "content 2")
+        self.assertIn("(shallow)", god("log", cwd=clone))
+
+        god("fetch", "--depth", "2", cwd=clone)
+        self.assertEqual(get_shallow_commits(clone), {self.commits[1]})
+
+        god("fetch", "--depth", "3", cwd=clone)
+        self.assertEqual(get_shallow_commits(clone), set())
+        self.assertFalse((clone / c.FILE_SHALLOW).exists())
+        log = god("log", cwd=clone)
+        self.assertNotIn("(shallow)", log)
+        for commit in self.commits:
+            self.assertIn(commit, log)